@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.abspath(os.curdir))
+
+import argparse
+import numpy as np
+import shutil
+import tempfile
+import tracemalloc
+import ujson as json
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from benchmark import synthetic
+from benchmark.bench_prepare_data import run_prepare_data
+from modules import dedup
+
+
+def find_duplicates(signatures: np.ndarray, threshold: float) -> np.ndarray:
+    duplicate_index = dedup.DuplicateIndex()
+    duplicate_index.add(np.arange(len(signatures), dtype=np.uint64), signatures, [1] * len(signatures))
+    dup_of, _ = duplicate_index.find_duplicates(threshold)
+    return dup_of
+
+
+def check_clustering():
+    """
+    Near duplicates sharing a band bucket are found whatever item comes first in the bucket, and clusters are transitive.
+    """
+    rng = np.random.default_rng(0)
+    rows = dedup.NUM_PERM // dedup.NUM_BANDS
+    head = rng.integers(0, 2 ** 32, size=dedup.NUM_PERM, dtype=np.uint32)
+    # Items 1 and 2 only share the first band, where item 0 heads the bucket, but differ in one value of every other band.
+    pair = rng.integers(0, 2 ** 32, size=dedup.NUM_PERM, dtype=np.uint32)
+    pair[:rows] = head[:rows]
+    signatures = np.stack([head, pair, pair.copy()])
+    signatures[2, rows::rows] += 1
+    assert find_duplicates(signatures, dedup.DEFAULT_THRESHOLD).tolist() == [-1, -1, 1], "Missed a near duplicate behind a dissimilar bucket head!"
+
+    # A ~ B and B ~ C, but A and C are too far apart to be compared as a pair.
+    a = rng.integers(0, 2 ** 32, size=dedup.NUM_PERM, dtype=np.uint32)
+    b, c = a.copy(), a.copy()
+    b[:dedup.NUM_PERM // 8] += 1
+    c[:dedup.NUM_PERM // 4] += 1
+    signatures = np.stack([a, b, c])
+    assert find_duplicates(signatures, 0.85).tolist() == [-1, 0, 0], "Near duplicates are not clustered transitively!"
+
+
+def check_signature_memory(n_lists: int, n_tokens: int):
+    """
+    The temporaries of minhash_signatures stay a few bytes per shingle plus a fixed block, whatever the chunk size.
+    """
+    rng = np.random.default_rng(0)
+    token_lists = [rng.integers(0, 100000, size=n_tokens).tolist() for _ in range(n_lists)]
+    shingles_bytes = n_lists * max(n_tokens - dedup.SHINGLE_SIZE + 1, 1) * 8
+    tracemalloc.start()
+    try:
+        dedup.minhash_signatures(token_lists)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    max_bytes = 8 * shingles_bytes + 4 * dedup.SIGNATURE_BLOCK * dedup.NUM_PERM * 8
+    assert peak <= max_bytes, f"minhash_signatures peaked at {peak / 2 ** 20:.1f} MB for {n_lists} x {n_tokens} tokens, more than {max_bytes / 2 ** 20:.1f} MB!"
+    return peak
+
+
+def run_one(raw_data_file: str, output_dir: str, extra_args=()):
+    """
+    Run prepare_data.py, return (elapsed seconds, peak RSS in MB) read from its own profile report.
+    """
+    report_file = f"{output_dir}.json"
+    elapsed, _ = run_prepare_data(raw_data_file, output_dir, [*extra_args, f"--profile_report={report_file}"])
+    with open(report_file, "r", encoding="utf-8") as fin:
+        # ru_maxrss of the child also counts the peak of this process, the report has the child's VmHWM on Linux.
+        peak_rss_mb = json.load(fin)["peak_rss_bytes"] / (1024 * 1024)
+    os.remove(report_file)
+    shutil.rmtree(output_dir)
+    return elapsed, peak_rss_mb
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="prepare_data.py --dedup Peak RSS And Throughput Benchmark")
+    parser.add_argument("--size_mb", type=int, help="size of the synthetic QA file", default=64)
+    parser.add_argument("--workdir", type=str, help="scratch dir, must hold the QA file plus its output", default=None)
+    parser.add_argument("--languages", type=str, help=f"comma-separated languages mixed pair by pair: {' | '.join(synthetic.LANGUAGES)}", default="en,zh")
+    parser.add_argument("--length_distribution", type=str, help=f"distribution of question and answer lengths: {' | '.join(synthetic.LENGTH_DISTRIBUTIONS)}", default="lognormal")
+    parser.add_argument("--max_extra_rss_mb", type=float, help="max peak RSS --dedup may add over a plain run", default=128.0)
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    args = parser.parse_args()
+
+    check_clustering()
+    print(f"{Fore.GREEN}-> Near duplicate clustering checks passed.\n{Style.RESET_ALL}")
+    for n_tokens in (256, 1024, 4096):
+        peak = check_signature_memory(512, n_tokens)
+        print(f"{Fore.GREEN}-> minhash_signatures of 512 x {n_tokens} tokens: peak {peak / 2 ** 20:.1f} MB{Style.RESET_ALL}")
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        raw_data_file = os.path.join(workdir, f"qa_{args.size_mb}mb.txt")
+        synthetic.write_qa_corpus(raw_data_file, args.size_mb, tuple(args.languages.split(",")), args.length_distribution, seed=args.seed)
+        plain_elapsed, plain_rss_mb = run_one(raw_data_file, os.path.join(workdir, "data_plain"))
+        dedup_elapsed, dedup_rss_mb = run_one(raw_data_file, os.path.join(workdir, "data_dedup"), ["--dedup"])
+    finally:
+        shutil.rmtree(workdir)
+
+    print(f"{Fore.GREEN}-> plain: {plain_elapsed:.2f}s, peak RSS {plain_rss_mb:.1f} MB{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}-> dedup: {dedup_elapsed:.2f}s, peak RSS {dedup_rss_mb:.1f} MB{Style.RESET_ALL}")
+    # The signatures are computed in bounded blocks, --dedup must only add the index of the kept fingerprints.
+    assert dedup_rss_mb <= plain_rss_mb + args.max_extra_rss_mb, f"--dedup added {dedup_rss_mb - plain_rss_mb:.1f} MB of peak RSS, more than {args.max_extra_rss_mb:.1f} MB!"
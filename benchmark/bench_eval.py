@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.abspath(os.curdir))
+
+import argparse
+import contextlib
+import io
+import openai
+import random
+import shutil
+import tempfile
+import ujson as json
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from benchmark import mock_openai
+from modules import evaluate
+
+
+def write_eval_file(path: str, n_examples: int, seed: int):
+    """
+    Write n_examples held-out examples in the prepare_data.py --eval_output format, return (question, answer) pairs.
+    """
+    rnd = random.Random(seed)
+    words = ["fine", "tune", "model", "token", "budget", "training", "example", "data", "check", "openai", "模型", "数据", "微调"]
+    pairs = []
+    with open(path, "w", encoding="utf-8") as fout:
+        for idx in range(n_examples):
+            question = f"{idx}: {' '.join(rnd.choices(words, k=rnd.randint(5, 40)))}?"
+            answer = " ".join(rnd.choices(words, k=rnd.randint(20, 200)))
+            messages = [{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+            fout.write(json.dumps({"messages": messages}, ensure_ascii=False) + "\n")
+            pairs.append((question, answer))
+    return pairs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Eval Harness Throughput Benchmark Against A Local Mock API")
+    parser.add_argument("--port", type=int, help="port of the in-process mock server", default=8769)
+    parser.add_argument("--examples", type=int, help="number of held-out examples", default=200)
+    parser.add_argument("--concurrency", type=str, help="comma-separated numbers of in-flight requests", default="1,8,32")
+    parser.add_argument("--latency_ms", type=float, help="latency the mock adds to every response", default=50)
+    parser.add_argument("--ms_per_token", type=float, help="generation time the mock spends per completion token", default=1)
+    parser.add_argument("--correct_rate", type=float, help="fraction of questions the mock answers with the reference answer", default=0.7)
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    args = parser.parse_args()
+
+    app = mock_openai.run_in_background(args.port, latency_ms=args.latency_ms, completion_ms_per_token=args.ms_per_token)
+    openai.api_base = f"http://127.0.0.1:{args.port}/v1"
+    openai.api_key = "sk-mock"
+
+    workdir = tempfile.mkdtemp()
+    try:
+        eval_file = os.path.join(workdir, "eval.jsonl")
+        pairs = write_eval_file(eval_file, args.examples, args.seed)
+        rnd = random.Random(args.seed)
+        n_correct = 0
+        for question, answer in pairs:
+            if rnd.random() < args.correct_rate:
+                app["chat_answers"][question] = answer
+                n_correct += 1
+            else:
+                app["chat_answers"][question] = answer.upper()[::-1]
+
+        for concurrency in [int(x) for x in args.concurrency.split(",")]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                report = evaluate.evaluate_model(eval_file, "ft:gpt-3.5-turbo-0613:mock", concurrency=concurrency)
+            assert report["n_failed"] == 0, "Some eval requests failed!"
+            assert abs(report["exact_match"] - n_correct / args.examples) < 1e-9, "Exact match does not count the mock's correct answers!"
+            print(f"{Fore.GREEN}-> concurrency {concurrency}: {report['elapsed_s']:.2f}s, {report['requests_per_s']:.1f} requests/s, "
+                  f"{report['completion_tokens_per_s']:.0f} tokens/s, p50 {report['latency_s']['p50'] * 1000:.0f}ms, p99 {report['latency_s']['p99'] * 1000:.0f}ms, "
+                  f"exact match {report['exact_match']:.2%}, token F1 {report['token_f1']:.2%}, ~${report['cost_usd']:.4f}{Style.RESET_ALL}")
+    finally:
+        shutil.rmtree(workdir)
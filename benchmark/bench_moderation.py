@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.abspath(os.curdir))
+
+import argparse
+import openai
+import random
+import time
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from benchmark import mock_openai
+from modules import moderation
+
+
+def legacy_check_moderation(items):
+    # The previous implementation: blocking 32-item batches, one data file after another.
+    flagged = {}
+    by_file = {}
+    for key, index, content in items:
+        by_file.setdefault(key, []).append((index, content))
+    for key, messages in by_file.items():
+        for batch_start in range(0, len(messages), 32):
+            batch = messages[batch_start:batch_start + 32]
+            results = openai.Moderation.create(input=[content for _, content in batch])["results"]
+            for (index, _), result in zip(batch, results):
+                if result["flagged"]:
+                    flagged.setdefault(key, []).append(index)
+    return flagged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Moderation Pipeline Benchmark Against A Local Stub Server")
+    parser.add_argument("--port", type=int, help="port of the in-process stub server", default=8765)
+    parser.add_argument("--files", type=int, help="number of synthetic data files", default=200)
+    parser.add_argument("--messages", type=int, help="messages per data file", default=5)
+    parser.add_argument("--latency_ms", type=float, help="stub server latency per request", default=50)
+    parser.add_argument("--rate_limit_rate", type=float, help="fraction of requests answered with 429", default=0.05)
+    parser.add_argument("--concurrency", type=int, help="max in-flight moderation requests", default=16)
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    args = parser.parse_args()
+
+    app = mock_openai.run_in_background(args.port, latency_ms=args.latency_ms, rate_limit_rate=args.rate_limit_rate)
+    openai.api_base = f"http://127.0.0.1:{args.port}/v1"
+    openai.api_key = "sk-mock"
+
+    rnd = random.Random(args.seed)
+    items = []
+    expected = {}
+    for i in range(args.files):
+        data_file = f"fine_tune_instructions_{i + 1:04d}.json"
+        for j in range(args.messages):
+            content = f"message {j} of {data_file}"
+            if rnd.random() < 0.02:
+                content += f" {mock_openai.FLAG_MARKER}"
+                expected.setdefault(data_file, []).append(j)
+            items.append((data_file, j, content))
+
+    # The legacy path does not retry, so it runs against a well-behaved server.
+    app["options"]["rate_limit_rate"] = 0.0
+    st = time.perf_counter()
+    legacy = legacy_check_moderation(items)
+    legacy_elapsed = time.perf_counter() - st
+
+    app["options"]["rate_limit_rate"] = args.rate_limit_rate
+    st = time.perf_counter()
+    flagged = moderation.check_moderation_batch(items, concurrency=args.concurrency, base_delay=0.05)
+    async_elapsed = time.perf_counter() - st
+
+    assert legacy == expected, "Legacy moderation attributed flagged messages wrongly!"
+    assert {k: [r["index"] for r in v] for k, v in flagged.items()} == expected, "Async moderation attributed flagged messages wrongly!"
+    print(f"{Fore.GREEN}-> legacy : {legacy_elapsed:.3f}s, {len(items) / legacy_elapsed:.1f} messages/s{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}-> async  : {async_elapsed:.3f}s, {len(items) / async_elapsed:.1f} messages/s (429 rate {args.rate_limit_rate}){Style.RESET_ALL}")
+    print(f"{Fore.GREEN}-> speedup: {legacy_elapsed / async_elapsed:.2f}x, stub server stats: {app['stats']}{Style.RESET_ALL}")
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.abspath(os.curdir))
+
+import argparse
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import ujson as json
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from benchmark import mock_openai, synthetic
+from typing import Dict, List, Optional
+
+STAGES = ("prepare", "convert", "check")
+REPO_DIR = os.path.abspath(os.curdir)
+
+
+def stage_commands(workdir: str, raw_data_file: str, args) -> Dict[str, List[str]]:
+    """
+    prepare -> convert -> check on one raw data file, every stage writing its profiling report next to its outputs.
+    """
+    examples_dir, jsonl_dir = os.path.join(workdir, "examples"), os.path.join(workdir, "jsonl")
+    return {
+        "prepare": [
+            sys.executable, os.path.join(REPO_DIR, "prepare_data.py"), f"--raw_data={raw_data_file}", f"--output={examples_dir}", f"--max_tokens={args.max_tokens}",
+            f"--base_system_instruction={os.path.join(REPO_DIR, 'test', 'raw_data', 'fine_tune_instructions_base.json')}"
+        ],
+        "convert": [
+            sys.executable, os.path.join(REPO_DIR, "json2jsonl.py"), f"--input={examples_dir}", f"--output={jsonl_dir}", f"--workers={args.workers}",
+            # One training file however big, so that the check stage sees the whole corpus.
+            "--max_mb=1000000", f"--manifest={os.path.join(workdir, '.tmp', 'json2jsonl_manifest.json')}"
+        ],
+        "check": [
+            sys.executable, os.path.join(REPO_DIR, "fine_tune.py"), "--action=check", "--check_jsonl", f"--jsonl_file={os.path.join(jsonl_dir, 'fine_tune_instructions.jsonl')}",
+            f"--workers={args.workers}", f"--moderation_concurrency={args.moderation_concurrency}", "--no_cache"
+        ]
+    }
+
+
+def run_stage(command: List[str], workdir: str, profile_file: str) -> Dict:
+    """
+    Run a stage in a child process with profiling on, return its wall time and profiling report.
+    """
+    st = time.perf_counter()
+    proc = subprocess.run([*command, f"--profile_report={profile_file}"], cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - st
+    if proc.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(command[1])} failed with exit code {proc.returncode}:\n{proc.stderr[-2000:]}")
+    with open(profile_file, "r", encoding="utf-8") as fin:
+        return {"seconds": elapsed, "profile": json.load(fin)}
+
+
+def summarize_stage(stage: str, size_mb: float, corpus: Dict, run: Dict) -> Dict:
+    profile = run["profile"]
+    counters = profile["counters"]
+    tokens = counters.get("prepare.tokens", None) or counters.get("check.tokens", None)
+    return {
+        "size_mb": size_mb,
+        "stage": stage,
+        "seconds": run["seconds"],
+        "mb_per_s": corpus["n_bytes"] / (1024 * 1024) / run["seconds"],
+        "qa_pairs_per_s": corpus["n_pairs"] / run["seconds"],
+        "tokens_per_s": tokens / run["seconds"] if tokens else None,
+        "peak_rss_mb": profile["peak_rss_bytes"] / (1024 * 1024),
+        "worker_peak_rss_mb": profile["peak_rss_children_bytes"] / (1024 * 1024),
+        "stage_seconds": {name: stage_report["seconds"] for name, stage_report in profile["stages"].items()},
+        "counters": counters
+    }
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(), "commit": commit}
+
+
+def compare_to_baseline(results: List[Dict], baseline: Dict, tolerance: float) -> int:
+    """
+    Print the change of every (size, stage) against the baseline run, return the number of regressions beyond tolerance.
+    """
+    baseline_results = {(result["size_mb"], result["stage"]): result for result in baseline["results"]}
+    n_regressions = 0
+    for result in results:
+        before = baseline_results.get((result["size_mb"], result["stage"]), None)
+        if before is None:
+            continue
+        time_ratio = result["seconds"] / before["seconds"]
+        rss_ratio = result["peak_rss_mb"] / before["peak_rss_mb"] if before["peak_rss_mb"] else 1.0
+        regressed = time_ratio > 1 + tolerance or rss_ratio > 1 + tolerance
+        n_regressions += regressed
+        color = Fore.RED if regressed else Fore.GREEN
+        print(f"{color}-> {result['stage']} @ {result['size_mb']:g} MB: {before['seconds']:.2f}s -> {result['seconds']:.2f}s ({time_ratio - 1:+.1%}), "
+              f"peak RSS {before['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB ({rss_ratio - 1:+.1%}){Style.RESET_ALL}")
+    return n_regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="prepare -> convert -> check Pipeline Benchmark On Synthetic QA Corpora")
+    parser.add_argument("--sizes_mb", type=str, help="comma-separated sizes of the synthetic raw data files", default="16,64,256")
+    parser.add_argument("--languages", type=str, help=f"comma-separated languages mixed pair by pair: {' | '.join(synthetic.LANGUAGES)}", default="en,zh")
+    parser.add_argument("--length_distribution", type=str, help=f"distribution of question and answer lengths: {' | '.join(synthetic.LENGTH_DISTRIBUTIONS)}", default="lognormal")
+    parser.add_argument("--question_words", type=float, help="mean question length in words (characters for zh/ja)", default=20)
+    parser.add_argument("--answer_words", type=float, help="mean answer length in words (characters for zh/ja)", default=120)
+    parser.add_argument("--max_tokens", type=int, help="token budget of the packed examples", default=4000)
+    parser.add_argument("--workers", type=int, help="worker processes of the convert and check stages", default=os.cpu_count())
+    parser.add_argument("--moderation_concurrency", type=int, help="max in-flight moderation requests per check worker", default=16)
+    parser.add_argument("--port", type=int, help="port of the in-process mock server stubbing the moderation API", default=8770)
+    parser.add_argument("--workdir", type=str, help="scratch dir, must hold the corpus plus its examples and training file", default=None)
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    parser.add_argument("--output_json", type=str, help="write the results to this JSON file, pass it as --baseline of a later run", default="./.tmp/bench_pipeline.json")
+    parser.add_argument("--baseline", type=str, help="results of an earlier run to compare with", default=None)
+    parser.add_argument("--tolerance", type=float, help="max relative slowdown or peak RSS growth over the baseline before it counts as a regression", default=0.2)
+    args = parser.parse_args()
+
+    baseline: Optional[Dict] = None
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf-8") as fin:
+            baseline = json.load(fin)
+    config = {key: getattr(args, key) for key in ("languages", "length_distribution", "question_words", "answer_words", "max_tokens", "workers", "seed")}
+    if baseline is not None and baseline["config"] != config:
+        print(f"{Fore.YELLOW}-> The baseline ran with {baseline['config']}, not with {config}, timings may not be comparable.{Style.RESET_ALL}")
+
+    # Moderation goes to a local stub, so the check stage measures this code rather than the network.
+    mock_openai.run_in_background(args.port)
+    results = []
+    for size_mb in [float(x) for x in args.sizes_mb.split(",")]:
+        workdir = tempfile.mkdtemp(dir=args.workdir)
+        try:
+            with open(os.path.join(workdir, ".env"), "w") as fout:
+                fout.write(f"OPENAI_API_KEY=sk-mock\nOPENAI_API_HTTP_PROXY=\nOPENAI_API_BASE=http://127.0.0.1:{args.port}/v1\n")
+            raw_data_file = os.path.join(workdir, "qa.txt")
+            st = time.perf_counter()
+            corpus = synthetic.write_qa_corpus(raw_data_file, size_mb, tuple(args.languages.split(",")), args.length_distribution,
+                                               args.question_words, args.answer_words, args.seed)
+            print(f"{Fore.GREEN}-> {size_mb:g} MB: generated {corpus['n_pairs']} QA pairs in {time.perf_counter() - st:.1f}s.{Style.RESET_ALL}")
+            for stage, command in stage_commands(workdir, raw_data_file, args).items():
+                result = summarize_stage(stage, size_mb, corpus, run_stage(command, workdir, os.path.join(workdir, f"{stage}_profile.json")))
+                results.append(result)
+                tokens = f", {result['tokens_per_s']:.0f} tokens/s" if result["tokens_per_s"] else ""
+                print(f"{Fore.GREEN}-> {size_mb:g} MB {stage}: {result['seconds']:.2f}s, {result['mb_per_s']:.1f} MB/s, {result['qa_pairs_per_s']:.0f} QA pairs/s{tokens}, "
+                      f"peak RSS {result['peak_rss_mb']:.0f} MB (workers {result['worker_peak_rss_mb']:.0f} MB){Style.RESET_ALL}")
+        finally:
+            shutil.rmtree(workdir)
+
+    output_dir = os.path.dirname(os.path.abspath(args.output_json))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output_json, "w", encoding="utf-8") as fout:
+        json.dump({"environment": environment(), "config": config, "results": results}, fout, indent=2)
+    print(f"{Fore.GREEN}-> Wrote the results to {args.output_json}.{Style.RESET_ALL}")
+
+    if baseline is not None:
+        n_regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if n_regressions > 0:
+            print(f"{Fore.RED}-> {n_regressions} stages regressed by more than {args.tolerance:.0%} against {args.baseline}.{Style.RESET_ALL}")
+            exit(-1)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.abspath(os.curdir))
+
+import argparse
+import shutil
+import subprocess
+import tempfile
+import time
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from benchmark import synthetic
+
+
+def run_prepare_data(raw_data_file: str, output_dir: str, extra_args=()):
+    """
+    Run prepare_data.py in a child process, return (elapsed seconds, peak RSS in MB) of that child only.
+    """
+    st = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "prepare_data.py", f"--raw_data={raw_data_file}", f"--output={output_dir}", *extra_args],
+        stdout=subprocess.DEVNULL
+    )
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - st
+    assert os.waitstatus_to_exitcode(status) == 0, "prepare_data.py failed!"
+    # ru_maxrss is in KB on Linux and in bytes on macOS.
+    peak_rss_mb = rusage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return elapsed, peak_rss_mb
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="prepare_data.py Peak RSS And Throughput Benchmark")
+    parser.add_argument("--sizes_mb", type=str, help="comma-separated sizes of the synthetic QA files", default="256,1024,2048")
+    parser.add_argument("--workdir", type=str, help="scratch dir, must hold the QA file plus its output", default=None)
+    parser.add_argument("--languages", type=str, help=f"comma-separated languages mixed pair by pair: {' | '.join(synthetic.LANGUAGES)}", default="en,zh")
+    parser.add_argument("--length_distribution", type=str, help=f"distribution of question and answer lengths: {' | '.join(synthetic.LENGTH_DISTRIBUTIONS)}", default="lognormal")
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        for size_mb in [int(x) for x in args.sizes_mb.split(",")]:
+            raw_data_file = os.path.join(workdir, f"qa_{size_mb}mb.txt")
+            output_dir = os.path.join(workdir, f"data_{size_mb}mb")
+            synthetic.write_qa_corpus(raw_data_file, size_mb, tuple(args.languages.split(",")), args.length_distribution, seed=args.seed)
+            elapsed, peak_rss_mb = run_prepare_data(raw_data_file, output_dir)
+            print(f"{Fore.GREEN}-> {size_mb} MB: {elapsed:.2f}s, {size_mb / elapsed:.1f} MB/s, peak RSS {peak_rss_mb:.1f} MB{Style.RESET_ALL}")
+            os.remove(raw_data_file)
+            shutil.rmtree(output_dir)
+    finally:
+        shutil.rmtree(workdir)
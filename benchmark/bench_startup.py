@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.abspath(os.curdir))
+
+import argparse
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import ujson as json
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from benchmark import mock_openai
+from modules.registry import Registry
+
+FINE_TUNE = os.path.abspath("fine_tune.py")
+HEAVY_MODULES = ("numpy", "tiktoken", "openai", "aiohttp")
+ACTIONS = {
+    "upload": ["--action=upload"],
+    "start": ["--action=start", "--n_epochs=3", "--force"],
+    "status": ["--action=status"],
+    "status_active": ["--action=status"],
+    "watch": ["--action=watch", "--min_interval=0.1"],
+    "check": ["--action=check", "--workers=1"]
+}
+
+
+def setup_workdir(workdir: str, port: int):
+    """
+    Lay out what fine_tune.py reads from its working dir: .env pointing at the mock, a training file and a data check example.
+    """
+    with open(os.path.join(workdir, ".env"), "w") as fout:
+        fout.write(f"OPENAI_API_KEY=sk-mock\nOPENAI_API_HTTP_PROXY=\nOPENAI_API_BASE=http://127.0.0.1:{port}/v1\n")
+    os.makedirs(os.path.join(workdir, "data"))
+    example = {"messages": [{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": "Q"}, {"role": "assistant", "content": "A"}]}
+    with open(os.path.join(workdir, "data", "fine_tune_instructions_0.json"), "w") as fout:
+        json.dump(example, fout)
+    with open(os.path.join(workdir, "data", "fine_tune_instructions.jsonl"), "w") as fout:
+        fout.write((json.dumps(example) + "\n") * 100)
+
+
+def seed_registry(workdir: str, action: str):
+    """
+    Put the registry into the state the action is timed in: only finished jobs for `status`,
+    one unfinished job (already done on the mock) for `status_active` and `watch`.
+    """
+    registry = Registry(os.path.join(workdir, ".tmp", "registry.db"))
+    for job in registry.list_jobs():
+        registry.update_job(job["job_id"], "succeeded", fine_tuned_model="ft:gpt-3.5-turbo-0613:mock")
+    if action in ("status_active", "watch"):
+        import openai
+        job = openai.FineTuningJob.create(training_file="file-mock", model="gpt-3.5-turbo-0613", hyperparameters={"n_epochs": 3})
+        registry.record_job(job["id"], "default", "file-mock", "gpt-3.5-turbo-0613", "queued", n_epochs=3)
+    registry.close()
+
+
+def run_fine_tune(workdir: str, action_args, importtime: bool = False):
+    """
+    Run fine_tune.py in its working dir, return (elapsed seconds, exit code, stderr).
+    """
+    command = [sys.executable, *(["-X", "importtime"] if importtime else []), FINE_TUNE, *action_args]
+    st = time.perf_counter()
+    proc = subprocess.run(command, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    return time.perf_counter() - st, proc.returncode, proc.stderr
+
+
+def parse_importtime(stderr: str):
+    """
+    Return the total import time in seconds and the heavy modules that got imported, from the `-X importtime` output.
+    """
+    total_us, loaded = 0, set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            total_us += int(cumulative)
+        if name.strip() in HEAVY_MODULES:
+            loaded.add(name.strip())
+    return total_us / 1e6, sorted(loaded)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fine_tune.py Startup Time Benchmark Per Action Against A Local Mock API")
+    parser.add_argument("--port", type=int, help="port of the in-process mock server", default=8768)
+    parser.add_argument("--actions", type=str, help="comma-separated actions to time", default=",".join(ACTIONS))
+    parser.add_argument("--runs", type=int, help="runs per action, the median is reported", default=5)
+    args = parser.parse_args()
+
+    import openai
+    app = mock_openai.run_in_background(args.port, job_duration_s=0, job_n_steps=2)
+    app["files"]["file-mock"] = {"id": "file-mock", "object": "file", "purpose": "fine-tune", "status": "processed"}
+    openai.api_base = f"http://127.0.0.1:{args.port}/v1"
+    openai.api_key = "sk-mock"
+
+    workdir = tempfile.mkdtemp()
+    try:
+        setup_workdir(workdir, args.port)
+        # `start` needs an uploaded training file, `status` a tracked job.
+        run_fine_tune(workdir, ACTIONS["upload"])
+        run_fine_tune(workdir, ACTIONS["start"])
+        for action in args.actions.split(","):
+            elapsed = []
+            for _ in range(args.runs):
+                seed_registry(workdir, action)
+                seconds, returncode, stderr = run_fine_tune(workdir, ACTIONS[action])
+                elapsed.append(seconds)
+            seed_registry(workdir, action)
+            _, returncode, stderr = run_fine_tune(workdir, ACTIONS[action], importtime=True)
+            import_s, loaded = parse_importtime(stderr)
+            color = Fore.GREEN if returncode == 0 else Fore.RED
+            print(f"{color}-> {action}: {statistics.median(elapsed):.3f}s median of {args.runs}, imports {import_s:.3f}s, "
+                  f"heavy modules: {', '.join(loaded) or 'none'}{'' if returncode == 0 else f', exit code {returncode}'}{Style.RESET_ALL}")
+    finally:
+        shutil.rmtree(workdir)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.abspath(os.curdir))
+
+import argparse
+import random
+import tiktoken
+import time
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from modules import data_check
+
+
+def legacy_num_tokens(messages, model="gpt-3.5-turbo-0613"):
+    # The previous implementation: load the encoder and encode message by message on every call.
+    encoding = tiktoken.encoding_for_model(model)
+    num_tokens = 0
+    for message in messages:
+        num_tokens += 3
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(value))
+            if key == "name":
+                num_tokens += 1
+    num_tokens += 3
+    return num_tokens
+
+
+def legacy_num_assistant_tokens(messages, model="gpt-3.5-turbo-0613"):
+    encoding = tiktoken.encoding_for_model(model)
+    num_tokens = 0
+    for message in messages:
+        if message["role"] == "assistant":
+            num_tokens += len(encoding.encode(message["content"]))
+    return num_tokens
+
+
+def make_examples(n_examples, n_turns, seed):
+    rnd = random.Random(seed)
+    words = ["fine", "tune", "model", "token", "budget", "training", "example", "data", "check", "openai", "模型", "数据"]
+    examples = []
+    for _ in range(n_examples):
+        messages = [{"role": "system", "content": "You are a helpful assistant."}]
+        for _ in range(n_turns):
+            messages.append({"role": "user", "content": " ".join(rnd.choices(words, k=rnd.randint(5, 60)))})
+            messages.append({"role": "assistant", "content": " ".join(rnd.choices(words, k=rnd.randint(10, 200)))})
+        examples.append(messages)
+    return examples
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokenizer Throughput Benchmark")
+    parser.add_argument("--examples", type=int, help="number of synthetic examples", default=20000)
+    parser.add_argument("--turns", type=int, help="user/assistant turns per example", default=2)
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    args = parser.parse_args()
+
+    examples = make_examples(args.examples, args.turns, args.seed)
+    # Warm up tiktoken's on-disk BPE cache so that neither side pays the first download.
+    tiktoken.encoding_for_model("gpt-3.5-turbo-0613")
+
+    st = time.perf_counter()
+    legacy = [(legacy_num_tokens(m), legacy_num_assistant_tokens(m)) for m in examples]
+    legacy_elapsed = time.perf_counter() - st
+
+    st = time.perf_counter()
+    batched = []
+    for chunk_start in range(0, len(examples), data_check.TOKENIZE_CHUNK_SIZE):
+        batched.extend(data_check.num_tokens_from_messages_batch(examples[chunk_start:chunk_start + data_check.TOKENIZE_CHUNK_SIZE]))
+    batched_elapsed = time.perf_counter() - st
+
+    assert legacy == batched, "Token counts differ between legacy and batched tokenization!"
+    print(f"{Fore.GREEN}-> legacy : {legacy_elapsed:.3f}s, {len(examples) / legacy_elapsed:.1f} examples/s{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}-> batched: {batched_elapsed:.3f}s, {len(examples) / batched_elapsed:.1f} examples/s{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}-> speedup: {legacy_elapsed / batched_elapsed:.2f}x{Style.RESET_ALL}")
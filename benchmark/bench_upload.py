@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.abspath(os.curdir))
+
+import argparse
+import openai
+import shutil
+import tempfile
+import time
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from benchmark import mock_openai
+from modules import upload
+from modules.registry import Registry
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunked Upload Benchmark Against A Local Mock Upload Server")
+    parser.add_argument("--port", type=int, help="port of the in-process mock server", default=8766)
+    parser.add_argument("--size_mb", type=int, help="size of the synthetic training file", default=64)
+    parser.add_argument("--part_mb", type=int, help="size of each part", default=4)
+    parser.add_argument("--parallel", type=str, help="comma-separated numbers of parallel connections", default="1,4,8")
+    parser.add_argument("--latency_ms", type=float, help="mock server latency per request", default=100)
+    args = parser.parse_args()
+
+    app = mock_openai.run_in_background(args.port, latency_ms=args.latency_ms)
+    openai.api_base = f"http://127.0.0.1:{args.port}/v1"
+    openai.api_key = "sk-mock"
+
+    workdir = tempfile.mkdtemp()
+    try:
+        data_file = os.path.join(workdir, "fine_tune_instructions.jsonl")
+        with open(data_file, "wb") as fout:
+            fout.write(os.urandom(args.size_mb * 1024 * 1024))
+        part_size = args.part_mb * 1024 * 1024
+
+        for parallel in [int(x) for x in args.parallel.split(",")]:
+            tmp_dir = os.path.join(workdir, f"tmp_{parallel}")
+            st = time.perf_counter()
+            file_id = upload.upload_file(data_file, tmp_dir, parallel=parallel, part_size=part_size)
+            elapsed = time.perf_counter() - st
+            print(f"{Fore.GREEN}-> parallel={parallel}: {elapsed:.2f}s, {args.size_mb / elapsed:.1f} MB/s <fid: {file_id}>{Style.RESET_ALL}")
+
+        # Interrupt an upload by dropping every connection after a third of the parts, then resume it.
+        tmp_dir = os.path.join(workdir, "tmp_resume")
+        n_parts = -(-args.size_mb // args.part_mb)
+        parts_before = app["stats"]["upload_parts"]
+        app["options"]["part_failure_rate"] = 1.0
+        original_read_part = upload._read_part
+
+        def _read_part_then_fail(path, part_size, idx):
+            # Let the first third of the parts through before the "proxy" starts dropping connections.
+            app["options"]["part_failure_rate"] = 0.0 if idx < n_parts // 3 else 1.0
+            return original_read_part(path, part_size, idx)
+
+        upload._read_part = _read_part_then_fail
+        try:
+            upload.upload_file(data_file, tmp_dir, parallel=1, part_size=part_size, max_retries=0)
+            raise AssertionError("The interrupted upload should have failed!")
+        except upload.UploadError:
+            pass
+        upload._read_part = original_read_part
+        app["options"]["part_failure_rate"] = 0.0
+        interrupted_parts = app["stats"]["upload_parts"] - parts_before
+        file_id = upload.upload_file(data_file, tmp_dir, parallel=4, part_size=part_size)
+        resumed_parts = app["stats"]["upload_parts"] - parts_before - interrupted_parts
+        assert interrupted_parts + resumed_parts == n_parts, "The resumed upload re-sent parts that were already uploaded!"
+        print(f"{Fore.GREEN}-> resume: {interrupted_parts} parts before the interruption, {resumed_parts} after <fid: {file_id}>{Style.RESET_ALL}")
+
+        # Same content on the same account, no new parts.
+        registry = Registry(os.path.join(workdir, "registry.db"))
+        file_id = upload.upload_file(data_file, tmp_dir, parallel=4, part_size=part_size, registry=registry)
+        parts_before = app["stats"]["upload_parts"]
+        assert upload.upload_file(data_file, tmp_dir, parallel=4, part_size=part_size, registry=registry) == file_id
+        assert app["stats"]["upload_parts"] == parts_before, "Already uploaded content was uploaded again!"
+        registry.close()
+    finally:
+        shutil.rmtree(workdir)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append(os.path.abspath(os.curdir))
+
+import argparse
+import contextlib
+import io
+import openai
+import shutil
+import tempfile
+import time
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from benchmark import mock_openai
+from concurrent.futures import ThreadPoolExecutor
+from modules import jobs
+from modules.registry import TERMINAL_STATUSES, Registry
+
+
+def legacy_poll(job_id: str, interval: float):
+    """
+    What a shell loop around the old status action does: retrieve plus the last 10 events, every interval.
+    """
+    seen = set()
+    while True:
+        status = openai.FineTuningJob.retrieve(job_id)["status"]
+        seen.update(event["id"] for event in openai.FineTuningJob.list_events(id=job_id, limit=10)["data"])
+        if status in TERMINAL_STATUSES:
+            return seen
+        time.sleep(interval)
+
+
+def create_jobs(registry: Registry, n_jobs: int):
+    created = []
+    for _ in range(n_jobs):
+        job = openai.FineTuningJob.create(training_file="file-mock", model="gpt-3.5-turbo-0613", hyperparameters={"n_epochs": 3})
+        registry.record_job(job["id"], "default", "file-mock", "gpt-3.5-turbo-0613", job["status"], n_epochs=3)
+        created.append(registry.get_job(job["id"]))
+    return created
+
+
+def requests_since(app, before):
+    return app["stats"]["job_retrievals"] + app["stats"]["event_requests"] - before
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fine-Tune Job Watcher Benchmark Against A Local Mock API")
+    parser.add_argument("--port", type=int, help="port of the in-process mock server", default=8767)
+    parser.add_argument("--jobs", type=int, help="number of concurrently watched jobs", default=20)
+    parser.add_argument("--duration_s", type=float, help="seconds until each mock job succeeds", default=10)
+    parser.add_argument("--steps", type=int, help="training step events per mock job", default=200)
+    parser.add_argument("--interval", type=float, help="legacy polling interval and watcher min interval", default=0.5)
+    args = parser.parse_args()
+
+    app = mock_openai.run_in_background(args.port, job_duration_s=args.duration_s, job_n_steps=args.steps)
+    app["files"]["file-mock"] = {"id": "file-mock", "object": "file", "purpose": "fine-tune", "status": "processed"}
+    openai.api_base = f"http://127.0.0.1:{args.port}/v1"
+    openai.api_key = "sk-mock"
+    n_job_events = 4 + args.steps + 2
+
+    workdir = tempfile.mkdtemp()
+    try:
+        registry = Registry(os.path.join(workdir, "registry.db"))
+
+        legacy_jobs = create_jobs(registry, args.jobs)
+        before, st = requests_since(app, 0), time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            seen = list(executor.map(lambda job: legacy_poll(job["job_id"], args.interval), legacy_jobs))
+        missed = args.jobs * n_job_events - sum(len(ids) for ids in seen)
+        print(f"{Fore.GREEN}-> legacy: {time.perf_counter() - st:.2f}s, {requests_since(app, before)} requests, {missed} of {args.jobs * n_job_events} events missed{Style.RESET_ALL}")
+
+        watched_jobs = create_jobs(registry, args.jobs)
+        hook_file = os.path.join(workdir, "finished.txt")
+        before, st = requests_since(app, 0), time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            n_events = jobs.watch_jobs(registry, watched_jobs, {"default": openai.api_key}, concurrency=8,
+                                       min_interval=args.interval, max_interval=args.interval * 8, on_terminal=f"echo $FINE_TUNE_JOB_ID >> {hook_file}")
+        missed = args.jobs * n_job_events - sum(n_events.values())
+        print(f"{Fore.GREEN}-> watch: {time.perf_counter() - st:.2f}s, {requests_since(app, before)} requests, {missed} of {args.jobs * n_job_events} events missed{Style.RESET_ALL}")
+        with open(hook_file, "r") as fin:
+            assert sorted(fin.read().split()) == sorted(job["job_id"] for job in watched_jobs), "The terminal hook did not run once per job!"
+
+        # Watching again resumes from the persisted cursors: no event is shown twice and finished jobs do not fire the hook again.
+        with contextlib.redirect_stdout(io.StringIO()):
+            n_events = jobs.watch_jobs(registry, [registry.get_job(job["job_id"]) for job in watched_jobs], {"default": openai.api_key},
+                                       on_terminal=f"echo $FINE_TUNE_JOB_ID >> {hook_file}")
+        assert sum(n_events.values()) == 0, "Events before the cursor were fetched again!"
+        with open(hook_file, "r") as fin:
+            assert len(fin.read().split()) == args.jobs, "The terminal hook ran again for already finished jobs!"
+        print(f"{Fore.GREEN}-> watch again: 0 events repeated, hook not re-run{Style.RESET_ALL}")
+        registry.close()
+    finally:
+        shutil.rmtree(workdir)
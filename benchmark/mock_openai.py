@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import hashlib
+import random
+import threading
+import time
+
+from aiohttp import web
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from typing import Dict, List
+
+# Any content containing this marker gets flagged by the stub moderation endpoint.
+FLAG_MARKER = "[[FLAG]]"
+
+
+def _error(status: int, message: str, headers=None) -> web.Response:
+    return web.json_response({"error": {"message": message, "type": "mock_error", "param": None, "code": None}}, status=status, headers=headers)
+
+
+@web.middleware
+async def _chaos_middleware(request: web.Request, handler):
+    """
+    Emulate network latency and the 429/5xx responses the real API sends under load.
+    """
+    options = request.app["options"]
+    if options["latency_ms"] > 0:
+        await asyncio.sleep(options["latency_ms"] / 1000)
+    roll = random.random()
+    if roll < options["rate_limit_rate"]:
+        return _error(429, "Rate limit reached (mock).", headers={"Retry-After": "0.05"})
+    if roll < options["rate_limit_rate"] + options["server_error_rate"]:
+        return _error(503, "The server is overloaded (mock).")
+    return await handler(request)
+
+
+async def _moderations(request: web.Request) -> web.Response:
+    body = await request.json()
+    contents = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    request.app["stats"]["moderation_requests"] += 1
+    request.app["stats"]["moderation_inputs"] += len(contents)
+    results = []
+    for content in contents:
+        flagged = FLAG_MARKER in content
+        results.append({
+            "flagged": flagged,
+            "categories": {"harassment": flagged, "violence": False},
+            "category_scores": {"harassment": 0.99 if flagged else 0.001, "violence": 0.001}
+        })
+    return web.json_response({"id": f"modr-{int(time.time() * 1000)}", "model": "text-moderation-006", "results": results})
+
+
+async def _create_upload(request: web.Request) -> web.Response:
+    body = await request.json()
+    upload_id = f"upload_{len(request.app['uploads']) + 1:08d}"
+    request.app["uploads"][upload_id] = {"bytes": body["bytes"], "filename": body["filename"], "purpose": body["purpose"], "parts": {}, "status": "pending"}
+    return web.json_response({"id": upload_id, "object": "upload", "bytes": body["bytes"], "filename": body["filename"], "purpose": body["purpose"], "status": "pending"})
+
+
+async def _add_upload_part(request: web.Request) -> web.Response:
+    upload = request.app["uploads"].get(request.match_info["upload_id"], None)
+    if upload is None or upload["status"] != "pending":
+        return _error(404, "No such pending upload (mock).")
+    if random.random() < request.app["options"]["part_failure_rate"]:
+        # Emulate a connection dropped by a flaky proxy halfway through a part.
+        request.transport.close()
+        return web.Response(status=503)
+    form = await request.post()
+    part_id = f"part_{len(request.app['parts']) + 1:08d}"
+    request.app["parts"][part_id] = form["data"].file.read()
+    upload["parts"][part_id] = True
+    request.app["stats"]["upload_parts"] += 1
+    return web.json_response({"id": part_id, "object": "upload.part", "upload_id": request.match_info["upload_id"]})
+
+
+async def _complete_upload(request: web.Request) -> web.Response:
+    upload = request.app["uploads"].get(request.match_info["upload_id"], None)
+    if upload is None or upload["status"] != "pending":
+        return _error(404, "No such pending upload (mock).")
+    body = await request.json()
+    if any(part_id not in upload["parts"] for part_id in body["part_ids"]):
+        return _error(400, "Unknown part id (mock).")
+    content = b"".join(request.app["parts"][part_id] for part_id in body["part_ids"])
+    if len(content) != upload["bytes"]:
+        return _error(400, f"Expected {upload['bytes']} bytes, got {len(content)} (mock).")
+    md5 = hashlib.md5(content).hexdigest()
+    if body.get("md5", None) not in (None, md5):
+        return _error(400, "Checksum mismatch (mock).")
+    upload["status"] = "completed"
+    file_id = f"file-{md5[:24]}"
+    request.app["files"][file_id] = {"id": file_id, "object": "file", "bytes": len(content), "filename": upload["filename"], "purpose": upload["purpose"], "status": "processed"}
+    return web.json_response({"id": request.match_info["upload_id"], "object": "upload", "status": "completed", "file": request.app["files"][file_id]})
+
+
+def _job_view(app: web.Application, job: Dict) -> Dict:
+    """
+    Jobs validate their files for a tenth of job_duration_s, run for the rest of it and then succeed.
+    """
+    elapsed = time.time() - job["created_at"]
+    duration = app["options"]["job_duration_s"]
+    if elapsed >= duration:
+        status, fine_tuned_model = "succeeded", f"ft:{job['model']}:mock::{job['id'][-8:]}"
+    else:
+        status, fine_tuned_model = "validating_files" if elapsed < duration / 10 else "running", None
+    return {**job, "status": status, "fine_tuned_model": fine_tuned_model, "finished_at": int(job["created_at"] + duration) if fine_tuned_model else None}
+
+
+def _job_events(app: web.Application, job: Dict) -> List[Dict]:
+    """
+    The events the job emitted so far, oldest first: validation, job_n_steps training steps, completion.
+    """
+    duration, n_steps = app["options"]["job_duration_s"], app["options"]["job_n_steps"]
+    timeline = [(0, "Created fine-tuning job"), (0, "Validating training file"),
+                (duration / 10, "Files validated, moving job to queued state"), (duration / 10, "Fine-tuning job started")]
+    timeline += [(duration / 10 + duration * 0.9 * step / (n_steps + 1), f"Step {step}/{n_steps}: training loss={2.0 / step:.4f}") for step in range(1, n_steps + 1)]
+    timeline += [(duration, "New fine-tuned model created"), (duration, "The job has successfully completed")]
+    elapsed = time.time() - job["created_at"]
+    return [
+        {"id": f"ftevent-{job['id'][-8:]}-{seq:04d}", "object": "fine_tuning.job.event", "created_at": int(job["created_at"] + offset), "level": "info", "message": message}
+        for seq, (offset, message) in enumerate(timeline) if offset <= elapsed
+    ]
+
+
+async def _list_job_events(request: web.Request) -> web.Response:
+    job = request.app["jobs"].get(request.match_info["job_id"], None)
+    if job is None:
+        return _error(404, "No such fine-tuning job (mock).")
+    request.app["stats"]["event_requests"] += 1
+    # Newest first, "after" is the id of the last event of the previous page.
+    events = _job_events(request.app, job)[::-1]
+    if "after" in request.query:
+        ids = [event["id"] for event in events]
+        events = events[ids.index(request.query["after"]) + 1:] if request.query["after"] in ids else []
+    limit = int(request.query.get("limit", 20))
+    return web.json_response({"object": "list", "data": events[:limit], "has_more": len(events) > limit})
+
+
+async def _create_job(request: web.Request) -> web.Response:
+    body = await request.json()
+    if body["training_file"] not in request.app["files"]:
+        return _error(400, f"Invalid file id {body['training_file']} (mock).")
+    job_id = f"ftjob-{len(request.app['jobs']) + 1:08d}"
+    request.app["jobs"][job_id] = {
+        "id": job_id,
+        "object": "fine_tuning.job",
+        "model": body["model"],
+        "training_file": body["training_file"],
+        "validation_file": body.get("validation_file", None),
+        "hyperparameters": body.get("hyperparameters", {}),
+        "created_at": time.time()
+    }
+    request.app["stats"]["jobs_created"] += 1
+    return web.json_response({**_job_view(request.app, request.app["jobs"][job_id]), "status": "created"})
+
+
+async def _list_jobs(request: web.Request) -> web.Response:
+    limit = int(request.query.get("limit", 20))
+    jobs = sorted(request.app["jobs"].values(), key=lambda job: job["created_at"], reverse=True)[:limit]
+    return web.json_response({"object": "list", "data": [_job_view(request.app, job) for job in jobs], "has_more": len(request.app["jobs"]) > limit})
+
+
+async def _retrieve_job(request: web.Request) -> web.Response:
+    job = request.app["jobs"].get(request.match_info["job_id"], None)
+    if job is None:
+        return _error(404, "No such fine-tuning job (mock).")
+    request.app["stats"]["job_retrievals"] += 1
+    return web.json_response(_job_view(request.app, job))
+
+
+def _approx_tokens(text: str) -> int:
+    # About 4 characters per token for English text, good enough for usage numbers.
+    return max(1, len(text) // 4)
+
+
+async def _chat_completion(request: web.Request) -> web.Response:
+    """
+    Answer with the reply registered in app["chat_answers"] for the last user message, or echo that message,
+    after completion_ms_per_token per completion token to emulate generation speed.
+    """
+    body = await request.json()
+    question = next((message["content"] for message in reversed(body["messages"]) if message["role"] == "user"), "")
+    answer = request.app["chat_answers"].get(question, question)
+    completion_tokens = min(_approx_tokens(answer), body.get("max_tokens", None) or 4096)
+    options = request.app["options"]
+    if options["completion_ms_per_token"] > 0:
+        await asyncio.sleep(completion_tokens * options["completion_ms_per_token"] / 1000)
+    request.app["stats"]["chat_completions"] += 1
+    prompt_tokens = sum(4 + _approx_tokens(message["content"]) for message in body["messages"]) + 3
+    return web.json_response({
+        "id": f"chatcmpl-{request.app['stats']['chat_completions']:08d}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+    })
+
+
+def create_app(latency_ms: float = 0, rate_limit_rate: float = 0, server_error_rate: float = 0, part_failure_rate: float = 0,
+               job_duration_s: float = 60, job_n_steps: int = 20, completion_ms_per_token: float = 0) -> web.Application:
+    app = web.Application(middlewares=[_chaos_middleware], client_max_size=1024 ** 3)
+    app["options"] = {"latency_ms": latency_ms, "rate_limit_rate": rate_limit_rate, "server_error_rate": server_error_rate, "part_failure_rate": part_failure_rate,
+                      "job_duration_s": job_duration_s, "job_n_steps": job_n_steps, "completion_ms_per_token": completion_ms_per_token}
+    app["stats"] = {"moderation_requests": 0, "moderation_inputs": 0, "upload_parts": 0, "jobs_created": 0, "job_retrievals": 0, "event_requests": 0, "chat_completions": 0}
+    app["uploads"], app["parts"], app["files"], app["jobs"], app["chat_answers"] = {}, {}, {}, {}, {}
+    app.router.add_post("/v1/moderations", _moderations)
+    app.router.add_post("/v1/uploads", _create_upload)
+    app.router.add_post("/v1/uploads/{upload_id}/parts", _add_upload_part)
+    app.router.add_post("/v1/uploads/{upload_id}/complete", _complete_upload)
+    app.router.add_post("/v1/fine_tuning/jobs", _create_job)
+    app.router.add_get("/v1/fine_tuning/jobs", _list_jobs)
+    app.router.add_get("/v1/fine_tuning/jobs/{job_id}", _retrieve_job)
+    app.router.add_get("/v1/fine_tuning/jobs/{job_id}/events", _list_job_events)
+    app.router.add_post("/v1/chat/completions", _chat_completion)
+    return app
+
+
+def run_in_background(port: int, **options) -> web.Application:
+    """
+    Serve the mock API from a daemon thread, return the app so callers can inspect app["stats"].
+    """
+    app = create_app(**options)
+    ready = threading.Event()
+
+    def _serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=_serve, daemon=True).start()
+    ready.wait()
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Stub Server Emulating The OpenAI API")
+    parser.add_argument("--port", type=int, help="port to listen on", default=8000)
+    parser.add_argument("--latency_ms", type=float, help="latency added to every response", default=50)
+    parser.add_argument("--rate_limit_rate", type=float, help="fraction of requests answered with 429", default=0.0)
+    parser.add_argument("--server_error_rate", type=float, help="fraction of requests answered with 503", default=0.0)
+    parser.add_argument("--part_failure_rate", type=float, help="fraction of upload parts whose connection gets dropped", default=0.0)
+    parser.add_argument("--job_duration_s", type=float, help="seconds until a fine-tuning job succeeds", default=60)
+    parser.add_argument("--job_n_steps", type=int, help="number of training step events per fine-tuning job", default=20)
+    parser.add_argument("--completion_ms_per_token", type=float, help="generation time per completion token of a chat completion", default=0)
+    args = parser.parse_args()
+
+    print(f"{Fore.GREEN}-> Serving mock OpenAI API on http://127.0.0.1:{args.port}/v1, set OPENAI_API_BASE to it in .env.{Style.RESET_ALL}")
+    web.run_app(create_app(args.latency_ms, args.rate_limit_rate, args.server_error_rate, args.part_failure_rate, args.job_duration_s, args.job_n_steps, args.completion_ms_per_token), host="127.0.0.1", port=args.port, print=None)
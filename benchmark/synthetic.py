@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import argparse
+import numpy as np
+import os
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+LANGUAGES = ("en", "zh", "ja", "ko")
+LENGTH_DISTRIBUTIONS = ("lognormal", "uniform", "fixed")
+# A sentence ends after this many words (characters in Chinese and Japanese) on average.
+SENTENCE_WORDS = 12
+_ENGLISH_WORDS = (
+    "the of and to a in is you that it he was for on are as with his they be at one have this from or had by hot word but what some we can "
+    "out other were all there when up use your how said an each she which do their time if will way about many then them write would like "
+    "so these her long make thing see him two has look more day could go come did number sound no most people my over know water than call "
+    "first who may down side been now find model token training data example budget check answer question fine tune file dataset epoch"
+).split()
+_SYLLABLES = ("ka", "lo", "mi", "re", "sa", "to", "ne", "vi", "ra", "pe", "di", "mo", "lu", "ta", "shi", "ber", "con", "ex", "pro", "tion", "ing", "er")
+
+
+@lru_cache(maxsize=None)
+def _vocab(language: str, size: int = 3000, seed: int = 7) -> Tuple[np.ndarray, str]:
+    """
+    Return the words of a language, most frequent first, and the separator joining them.
+    """
+    rng = np.random.default_rng(seed)
+    if language == "en":
+        # Common words first, then made-up ones for the long tail.
+        made_up = {"".join(rng.choice(_SYLLABLES, size=rng.integers(2, 5))) for _ in range(size * 2)}
+        return np.array(list(dict.fromkeys(_ENGLISH_WORDS + sorted(made_up)))[:size]), " "
+    if language == "zh":
+        return np.array([chr(0x4E00 + int(i)) for i in rng.permutation(0x9FA5 - 0x4E00)[:size]]), ""
+    if language == "ja":
+        kana = [chr(c) for c in range(0x3041, 0x3097)] + [chr(c) for c in range(0x30A1, 0x30FB)]
+        kanji = [chr(0x4E00 + int(i)) for i in rng.permutation(0x9FA5 - 0x4E00)[:size - len(kana)]]
+        # Kana are the most frequent characters of Japanese text.
+        return np.array(kana + kanji), ""
+    if language == "ko":
+        syllables = np.array([chr(0xAC00 + int(i)) for i in rng.permutation(11172)[:size]])
+        return np.array(["".join(rng.choice(syllables, size=rng.integers(1, 5))) for _ in range(size)]), " "
+    raise ValueError(f"unknown language {language}, expected one of {', '.join(LANGUAGES)}")
+
+
+@lru_cache(maxsize=None)
+def _zipf_cdf(size: int, exponent: float = 1.1) -> np.ndarray:
+    weights = 1.0 / np.arange(1, size + 1) ** exponent
+    return np.cumsum(weights / weights.sum())
+
+
+def _sample_lengths(rng: np.random.Generator, n: int, mean: float, distribution: str) -> np.ndarray:
+    if distribution == "lognormal":
+        # sigma 0.8: most texts are short, a few are several times the mean, like real chat logs.
+        sigma = 0.8
+        lengths = rng.lognormal(np.log(mean) - sigma ** 2 / 2, sigma, size=n)
+    elif distribution == "uniform":
+        lengths = rng.uniform(1, 2 * mean, size=n)
+    elif distribution == "fixed":
+        lengths = np.full(n, mean)
+    else:
+        raise ValueError(f"unknown length distribution {distribution}, expected one of {', '.join(LENGTH_DISTRIBUTIONS)}")
+    return np.maximum(1, np.rint(lengths)).astype(np.int64)
+
+
+def _texts(rng: np.random.Generator, language: str, lengths: np.ndarray, end: str) -> List[str]:
+    """
+    Draw Zipf-distributed words for texts of the given lengths, one vectorized draw for all of them.
+    """
+    vocab, separator = _vocab(language)
+    words = vocab[np.searchsorted(_zipf_cdf(len(vocab)), rng.random(int(lengths.sum())))]
+    stop = "。" if language in ("zh", "ja") else "."
+    texts, start = [], 0
+    for length in lengths:
+        text_words = words[start:start + length].tolist()
+        start += length
+        for idx in range(SENTENCE_WORDS - 1, len(text_words) - 1, SENTENCE_WORDS):
+            text_words[idx] += stop
+        texts.append(separator.join(text_words) + end)
+    return texts
+
+
+def generate_qa_pairs(n_pairs: int, languages: Tuple[str, ...] = ("en",), length_distribution: str = "lognormal",
+                      question_words: float = 20, answer_words: float = 120, seed: int = 42, batch_size: int = 10000):
+    """
+    Yield n_pairs synthetic (question, answer) pairs in batches of lists, each pair in a language drawn from languages.
+    Words follow a Zipf distribution and lengths (in words, or characters for Chinese and Japanese) the given distribution.
+    """
+    rng = np.random.default_rng(seed)
+    for batch_start in range(0, n_pairs, batch_size):
+        n = min(batch_size, n_pairs - batch_start)
+        pair_languages = rng.integers(0, len(languages), size=n)
+        questions, answers = [None] * n, [None] * n
+        for language_idx, language in enumerate(languages):
+            idx = np.nonzero(pair_languages == language_idx)[0]
+            if len(idx) == 0:
+                continue
+            question_texts = _texts(rng, language, _sample_lengths(rng, len(idx), question_words, length_distribution), "？" if language in ("zh", "ja") else "?")
+            answer_texts = _texts(rng, language, _sample_lengths(rng, len(idx), answer_words, length_distribution), "。" if language in ("zh", "ja") else ".")
+            for i, question, answer in zip(idx.tolist(), question_texts, answer_texts):
+                questions[i], answers[i] = question, answer
+        yield list(zip(questions, answers))
+
+
+def write_qa_corpus(path: str, size_mb: float, languages: Tuple[str, ...] = ("en",), length_distribution: str = "lognormal",
+                    question_words: float = 20, answer_words: float = 120, seed: int = 42) -> Dict[str, int]:
+    """
+    Write a "Q:"/"A:" raw data file of about size_mb MB (UTF-8), return its number of QA pairs and bytes.
+    """
+    target_bytes = int(size_mb * 1024 * 1024)
+    n_pairs, n_bytes = 0, 0
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8", buffering=1024 * 1024) as fout:
+        # Generate in rounds until the size is reached, the number of pairs per MB depends on the languages and lengths.
+        round_seed = seed
+        while n_bytes < target_bytes:
+            for batch in generate_qa_pairs(10000, languages, length_distribution, question_words, answer_words, seed=round_seed):
+                for question, answer in batch:
+                    chunk = f"Q:{question}\nA:{answer}\n\n"
+                    fout.write(chunk)
+                    n_pairs += 1
+                    n_bytes += len(chunk.encode("utf-8"))
+                    if n_bytes >= target_bytes:
+                        break
+            round_seed += 1
+    return {"n_pairs": n_pairs, "n_bytes": n_bytes}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic QA Corpus Generator")
+    parser.add_argument("--output", type=str, help="raw data file to write", default="./data/synthetic_qa.txt")
+    parser.add_argument("--size_mb", type=float, help="approximate size of the raw data file", default=64)
+    parser.add_argument("--languages", type=str, help=f"comma-separated languages mixed pair by pair: {' | '.join(LANGUAGES)}", default="en,zh")
+    parser.add_argument("--length_distribution", type=str, help=f"distribution of question and answer lengths: {' | '.join(LENGTH_DISTRIBUTIONS)}", default="lognormal")
+    parser.add_argument("--question_words", type=float, help="mean question length in words (characters for zh/ja)", default=20)
+    parser.add_argument("--answer_words", type=float, help="mean answer length in words (characters for zh/ja)", default=120)
+    parser.add_argument("--seed", type=int, help="random seed", default=42)
+    args = parser.parse_args()
+
+    stats = write_qa_corpus(args.output, args.size_mb, tuple(args.languages.split(",")), args.length_distribution, args.question_words, args.answer_words, args.seed)
+    print(f"{Fore.GREEN}-> Wrote {stats['n_pairs']} QA pairs ({stats['n_bytes'] / (1024 * 1024):.1f} MB) to {args.output}.{Style.RESET_ALL}")
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import argparse
+import glob
+import io
+import math
+import os
+import time
+import ujson as json
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from json2jsonl import merge_json_files
+from modules import config, data_check, profiling
+from modules.cache import ResultCache, content_hash
+from modules.jsonl import MAX_UPLOAD_BYTES
+from modules.registry import Registry
+from modules.upload import file_digests
+from prepare_data import IO_BUFFER_SIZE, example_prefix_suffix, iter_packed_examples, iter_qa_pair_tokens, iter_qa_pairs, write_example
+from typing import Dict, List, Optional
+
+tmp_dir = "./.tmp"
+
+
+def load_build_manifest(manifest_file: str) -> Dict:
+    try:
+        with open(manifest_file, "r", encoding="utf-8") as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_build_manifest(manifest_file: str, manifest: Dict):
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    if not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(manifest_file + ".tmp", "w", encoding="utf-8") as fout:
+        json.dump(manifest, fout)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def build_examples(raw_data_file: str, base_instructions: Dict, examples_dir: str, model: str, pairs_per_example: int,
+                   max_tokens: Optional[int], cache: Optional[ResultCache]) -> List[str]:
+    """
+    Stream the QA pairs into example files named after the hash of their content, return the example files in corpus order.
+
+    Examples end after content-defined QA pairs, so adding QA pairs only yields new example files around them,
+    every other example keeps its content, its file name and its mtime, and is not written again.
+    """
+    prefix, suffix = example_prefix_suffix(base_instructions)
+    if max_tokens is None:
+        budget = math.inf
+    else:
+        budget = max_tokens - data_check.num_tokens_from_messages(base_instructions.get("messages", []), model)
+        if budget <= 0:
+            raise ValueError(f"the base instruction alone does not fit into {max_tokens} tokens")
+
+    example_files, n_written = [], 0
+    with open(raw_data_file, "r", encoding="utf-8", buffering=IO_BUFFER_SIZE) as fin:
+        qa_pairs = iter_qa_pairs(fin)
+        # Without a token budget there is nothing to count, the content-defined cuts alone size the examples.
+        qa_pair_tokens = iter_qa_pair_tokens(qa_pairs, model, cache) if max_tokens is not None else ((question, answer, 0) for question, answer in qa_pairs)
+        for example, _ in iter_packed_examples(qa_pair_tokens, budget, "greedy", cut_every=pairs_per_example):
+            buffer = io.StringIO()
+            write_example(buffer, prefix, suffix, example)
+            content = buffer.getvalue().encode("utf-8")
+            example_file = os.path.join(examples_dir, f"example_{content_hash(content)[:16]}.json")
+            if not os.path.exists(example_file):
+                with open(example_file + ".tmp", "wb") as fout:
+                    fout.write(content)
+                os.replace(example_file + ".tmp", example_file)
+                n_written += 1
+            example_files.append(example_file)
+
+    # Example files of earlier builds that are no longer part of the corpus.
+    current = set(example_files)
+    stale = [example_file for example_file in glob.glob(os.path.join(examples_dir, "example_*.json")) if example_file not in current]
+    for example_file in stale:
+        os.remove(example_file)
+    print(f"{Fore.GREEN}-> {len(example_files)} examples, {n_written} new, {len(stale)} stale ones removed.{Style.RESET_ALL}")
+    return example_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental Fine-Tuning-Dataset Build: prepare -> merge -> check")
+    parser.add_argument("--raw_data", type=str, help="raw data file", default="./test/raw_data/qa.txt")
+    parser.add_argument("--base_system_instruction", type=str, help="system instruction should appear in every example", default="./test/raw_data/fine_tune_instructions_base.json")
+    parser.add_argument("--examples_dir", type=str, help="dir to store the content-addressed example files", default="./data/examples")
+    parser.add_argument("--output", type=str, help="final JSONL training file", default="./data/fine_tune_instructions.jsonl")
+    parser.add_argument("--pairs_per_example", type=int, help="average number of QA pairs per example, examples end at content-defined QA pairs", default=50)
+    parser.add_argument("--max_tokens", type=int, help="also cap examples at this many tokens, system prompt included", default=None)
+    parser.add_argument("--model", type=str, help="model whose tokenizer is used to count tokens", default="gpt-3.5-turbo-0613")
+    parser.add_argument("--max_mb", type=float, help="size limit of each training file, bigger outputs roll over to extra shards", default=MAX_UPLOAD_BYTES / (1024 * 1024))
+    parser.add_argument("--workers", type=int, help="number of worker processes merging and checking changed examples", default=os.cpu_count())
+    parser.add_argument("--moderation_concurrency", type=int, help="max in-flight moderation requests per worker", default=8)
+    parser.add_argument("--skip_check", action="store_true", help="stop after merging, without the data check")
+    parser.add_argument("--report_json", type=str, help="write the data check statistics and cost estimate to this JSON file", default=None)
+    parser.add_argument("--manifest", type=str, help="manifest of the previous build", default=os.path.join(tmp_dir, "build_manifest.json"))
+    parser.add_argument("--force", action="store_true", help="run every stage even if its inputs did not change")
+    parser.add_argument("--profile_report", type=str, help="write stage timings, counters and peak memory to this JSON file, or Prometheus textfile if it ends with .prom", default=None)
+    parser.add_argument("--cprofile", type=str, help="dump cProfile stats of the main process to this file", default=None)
+    args = parser.parse_args()
+    profiling.start("build", args.profile_report, args.cprofile)
+
+    if not os.path.exists(args.examples_dir):
+        os.makedirs(args.examples_dir)
+    manifest = {} if args.force else load_build_manifest(args.manifest)
+    cache_path = os.path.join(tmp_dir, "check_cache.sqlite3")
+    cache = ResultCache(cache_path)
+
+    # STAGE 1: prepare, skipped when the raw data, the base instruction and the packing settings are unchanged.
+    st = time.perf_counter()
+    with open(args.base_system_instruction, "r", encoding="utf-8") as fin:
+        base_instructions = json.loads(fin.read())
+    prepare_inputs = {
+        "raw_data": file_digests(args.raw_data)[0],
+        "base_system_instruction": content_hash(json.dumps(base_instructions, sort_keys=True, ensure_ascii=False)),
+        "examples_dir": os.path.abspath(args.examples_dir),
+        "pairs_per_example": args.pairs_per_example,
+        "max_tokens": args.max_tokens,
+        "model": args.model
+    }
+    prepare = manifest.get("prepare", {})
+    if prepare.get("inputs") == prepare_inputs and all(os.path.exists(example_file) for example_file in prepare["examples"]):
+        example_files = prepare["examples"]
+        print(f"{Fore.GREEN}-> prepare: {args.raw_data} is unchanged, reusing {len(example_files)} examples.{Style.RESET_ALL}")
+    else:
+        example_files = build_examples(args.raw_data, base_instructions, args.examples_dir, args.model, args.pairs_per_example, args.max_tokens, cache)
+        manifest["prepare"] = {"inputs": prepare_inputs, "examples": example_files}
+        manifest.pop("check", None)
+        save_build_manifest(args.manifest, manifest)
+    cache.close()
+    print(f"{Fore.GREEN}-> prepare: {time.perf_counter() - st:.2f}s.\n{Style.RESET_ALL}")
+
+    # STAGE 2: merge, only new examples are serialized, the others are copied from the previous output.
+    st = time.perf_counter()
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    shards = merge_json_files(example_files, args.output, os.path.join(tmp_dir, "build_merge_manifest.json"), args.workers, int(args.max_mb * 1024 * 1024))
+    shard_hashes = {shard: file_digests(shard)[0] for shard in shards}
+    print(f"{Fore.GREEN}-> merge: {time.perf_counter() - st:.2f}s, {', '.join(shards)}.\n{Style.RESET_ALL}")
+
+    # STAGE 3: check, skipped when the merged output is unchanged, otherwise only new examples miss the check cache.
+    if not args.skip_check:
+        st = time.perf_counter()
+        check = manifest.get("check", {})
+        if check.get("shards") == shard_hashes and args.report_json is None:
+            n_epochs = check["n_epochs"]
+            print(f"{Fore.GREEN}-> check: the training file is unchanged, {n_epochs} epochs suggested by the last check.{Style.RESET_ALL}")
+        else:
+            config.success()
+            n_epochs = data_check.check_data_formatting(
+                args.examples_dir,
+                model=args.model,
+                workers=args.workers,
+                moderation_concurrency=args.moderation_concurrency,
+                cache_path=cache_path,
+                report_file=args.report_json,
+                data_files=example_files
+            )
+            manifest["check"] = {"shards": shard_hashes, "n_epochs": n_epochs}
+            save_build_manifest(args.manifest, manifest)
+            # Let fine_tune.py --action=start pick up the epochs for these very files.
+            registry = Registry(os.path.join(tmp_dir, "registry.db"))
+            registry.set_setting("last_n_epochs", str(n_epochs))
+            for shard, sha256 in shard_hashes.items():
+                registry.record_dataset(sha256, shard, n_epochs)
+            registry.close()
+        print(f"{Fore.GREEN}-> check: {time.perf_counter() - st:.2f}s.\n{Style.RESET_ALL}")
@@ -4,116 +4,267 @@ import sys
 sys.path.append(os.path.join(os.path.abspath(os.curdir), "modules"))
 
 import argparse
-import asyncio
-# More info: https://github.com/aio-libs/aiohttp/discussions/6044.
-setattr(asyncio.sslproto._SSLProtocolTransport, "_start_tls_compatible", True)
 import datetime
-import openai
 
 from colorama import Fore, Style
-from modules import data_check, config
-config.success()
+from functools import partial
+from modules import config, key, profiling
+from modules.registry import TERMINAL_STATUSES, Registry
+from typing import Dict, List, Optional
+# The heavy modules (openai, numpy, tiktoken) are imported by the actions needing them, `status` on finished jobs loads none.
 
 tmp_dir = "./.tmp"
 if not os.path.exists(tmp_dir):
     os.makedirs(tmp_dir)
 
 
-def upload_data(data_file: str):
-    try:
-        response = openai.File.create(
-            file=open(data_file, "rb"),
-            purpose="fine-tune"
-        )
-        if "status" in response and response["status"] == "uploaded":
-            print(f"{Fore.GREEN}-> Uploaded a data file <fid: {response['id']}> for fine-tune!\n{Style.RESET_ALL}")
-            with open(os.path.join(tmp_dir, "file_id.txt"), "w") as f:
-                f.write(response["id"])
-        else:
-            print(f"{Fore.RED}-> Failed to upload the data file <fn: {data_file}> for fine-tune, err:{response}.\n{Style.RESET_ALL}")
-    except Exception as e:
-        print(f"{Fore.RED}-> Failed to upload the data file <fn: {data_file}> for fine-tune, err:{e}.\n{Style.RESET_ALL}")
-
-
-def start_fine_tune(n_epochs: int, model: str = "gpt-3.5-turbo-0613"):
-    with open(os.path.join(tmp_dir, "file_id.txt"), "r") as f:
-        fid = f.read()
-    print(f"{Fore.GREEN}-> Use uploaded data file <fid: {fid}> to start a fine-tune job...\n{Style.RESET_ALL}")
-
-    try:
-        response = openai.FineTuningJob.create(
-            training_file=fid,
-            model=model,
-            hyperparameters={"n_epochs": n_epochs}
-        )
-        if "status" in response and response["status"] == "created":
-            print(f"{Fore.GREEN}-> Started a fine-tune job <job_id:{response['id']}>!\n{Style.RESET_ALL}")
-            with open(os.path.join(tmp_dir, "ft_id.txt"), "w") as f:
-                f.write(response["id"])
-        else:
-            print(f"{Fore.RED}-> Failed to start the fine-tune job, err:{response}.\n{Style.RESET_ALL}")
-    except Exception as e:
-        print(f"{Fore.RED}-> Failed to start the fine-tune job, err:{e}.\n{Style.RESET_ALL}")
-
-
-def check_fine_tune():
-    try:
-        ft_id = open(os.path.join(tmp_dir, "ft_id.txt"), "r").read()
-        if len(ft_id) < 5:
-            raise
-    except Exception:
-        print(f"{Fore.YELLOW}-> Failed to get job-id from local file {os.path.join(tmp_dir, 'ft_id.txt')}, try to get the newest one from OpenAI instead.\n{Style.RESET_ALL}")
-        ft_id = openai.FineTuningJob.list(limit=1)["data"][0]["id"]
-    
-    try:
-        job = openai.FineTuningJob.retrieve(ft_id)
-        status = job["status"]
+def upload_data(registry: Registry, data_file: str, accounts: List[str], api_keys: Dict[str, str], parallel: int = 4, part_size: int = 8 * 1024 * 1024):
+    from modules import upload
+
+    for account in accounts:
+        try:
+            fid = upload.upload_file(data_file, tmp_dir, parallel=parallel, part_size=part_size, api_key=api_keys[account], account=account, registry=registry)
+            print(f"{Fore.GREEN}-> Uploaded a data file <fid: {fid}> for fine-tune to account {account}!\n{Style.RESET_ALL}")
+        except Exception as e:
+            print(f"{Fore.RED}-> Failed to upload the data file <fn: {data_file}> for fine-tune to account {account}, err:{e}.\n{Style.RESET_ALL}")
+
+
+def start_fine_tune(registry: Registry, data_files: List[str], accounts: List[str], api_keys: Dict[str, str], model: str = "gpt-3.5-turbo-0613",
+                    n_epochs: Optional[int] = None, concurrency: int = 4, force: bool = False, validation_files: Optional[List[str]] = None):
+    from modules import jobs, upload
+
+    launches = []
+    for data_file, validation_file in zip(data_files, validation_files or [None] * len(data_files)):
+        dataset_hash, _ = upload.file_digests(data_file)
+        validation_hash = upload.file_digests(validation_file)[0] if validation_file is not None else None
+        dataset = registry.get_dataset(dataset_hash)
+        # The epochs of a check on this very file win over those of the last check, whatever it checked.
+        dataset_n_epochs = n_epochs or (dataset or {}).get("n_epochs", None) or registry.get_setting("last_n_epochs")
+        if dataset_n_epochs is None:
+            print(f"{Fore.RED}-> No n_epochs known for {data_file}, run the check action first or pass --n_epochs.\n{Style.RESET_ALL}")
+            continue
+        for account in accounts:
+            uploaded = registry.find_file(dataset_hash, account)
+            if uploaded is None:
+                print(f"{Fore.RED}-> {data_file} was not uploaded to account {account} yet, run the upload action first.\n{Style.RESET_ALL}")
+                continue
+            uploaded_validation = registry.find_file(validation_hash, account) if validation_hash is not None else None
+            if validation_hash is not None and uploaded_validation is None:
+                print(f"{Fore.RED}-> {validation_file} was not uploaded to account {account} yet, run the upload action with --validation_file first.\n{Style.RESET_ALL}")
+                continue
+            active = registry.list_jobs(account=account, dataset_hash=dataset_hash, active_only=True)
+            if active and not force:
+                print(f"{Fore.YELLOW}-> The fine-tune job <job_id:{active[0]['job_id']}> on {data_file} is still {active[0]['status']} for account {account}, skip it (--force starts another one).\n{Style.RESET_ALL}")
+                continue
+            print(f"{Fore.GREEN}-> Use uploaded data file <fid: {uploaded['file_id']}> to start a fine-tune job for account {account}...\n{Style.RESET_ALL}")
+            if uploaded_validation is not None:
+                print(f"{Fore.GREEN}-> Validate it on uploaded data file <fid: {uploaded_validation['file_id']}>.\n{Style.RESET_ALL}")
+            launches.append({"account": account, "training_file": uploaded["file_id"], "validation_file": (uploaded_validation or {}).get("file_id", None),
+                             "dataset_hash": dataset_hash, "model": model, "n_epochs": int(dataset_n_epochs)})
+
+    started = jobs.launch_jobs(registry, launches, api_keys, concurrency=concurrency)
+    print(f"{Fore.GREEN}-> Started {sum(job is not None for job in started)}/{len(launches)} fine-tune jobs.\n{Style.RESET_ALL}")
+
+
+def check_fine_tune(registry: Registry, accounts: List[str], api_keys: Dict[str, str], job_id: Optional[str] = None, limit: int = 20, concurrency: int = 4):
+    if job_id is not None:
+        tracked = [job for job in [registry.get_job(job_id)] if job is not None]
+    else:
+        tracked = [job for account in accounts for job in registry.list_jobs(account=account, limit=limit)]
+    # Finished jobs never change, the registry answers for them without a single request.
+    needs_api = job_id is not None or not tracked or any(job["status"] not in TERMINAL_STATUSES for job in tracked)
+    if needs_api:
+        config.success()
+        import openai
+        from modules import jobs, retry
+    if not tracked and job_id is None:
+        print(f"{Fore.YELLOW}-> No fine-tune job in the registry {registry.path}, try to get the newest one from OpenAI instead.\n{Style.RESET_ALL}")
+        try:
+            job = retry.call_with_retries_sync(partial(openai.FineTuningJob.list, limit=1, api_key=api_keys[accounts[0]]), what="Fine-tuning", max_retries=5)["data"][0]
+            registry.record_job(job["id"], accounts[0], job["training_file"], job["model"], job["status"], fine_tuned_model=job.get("fine_tuned_model", None))
+            tracked = [registry.get_job(job["id"])]
+        except Exception as e:
+            print(f"{Fore.RED}-> Failed to get the newest fine-tune job, err:{e}.\n{Style.RESET_ALL}")
+            return
+    if needs_api:
+        tracked = jobs.refresh_jobs(registry, tracked, api_keys, concurrency=concurrency)
+
+    for job in sorted(tracked, key=lambda job: job["created_at"]):
+        ft_id, status = job["job_id"], job["status"]
         if status == "succeeded":
-            print(f"{Fore.GREEN}-> The fine-tune job <job_id:{ft_id}> is done! The created fine-tune model name is {job['fine_tuned_model']}.\n{Style.RESET_ALL}")
+            print(f"{Fore.GREEN}-> The fine-tune job <job_id:{ft_id}> of account {job['account']} is done! The created fine-tune model name is {job['fine_tuned_model']}.\n{Style.RESET_ALL}")
         elif status in ["failed", "cancelled"]:
-            print(f"{Fore.RED}-> The fine-tune job <job_id:{ft_id}> failed or got cancelled, no clue why.\n{Style.RESET_ALL}")
+            print(f"{Fore.RED}-> The fine-tune job <job_id:{ft_id}> of account {job['account']} failed or got cancelled, no clue why.\n{Style.RESET_ALL}")
         else:
-            print(f"{Fore.BLUE}-> The fine-tuning job <job_id:{ft_id}> is {status}.\n{Style.RESET_ALL}")
-        
-        print(f"{Fore.GREEN}-> Last 10 events from current fine-tuning job <job_id:{ft_id}>:\n{Style.RESET_ALL}")
-        events = openai.FineTuningJob.list_events(id=ft_id, limit=10)
-        sorted_events = sorted(events["data"], key=lambda x: x["created_at"])
-        for event in sorted_events:
-            date = datetime.datetime.fromtimestamp(event["created_at"])
-            print(f"{date} - {event['message']}")
-    except Exception as e:
-        print(f"{Fore.RED}-> Failed to check the fine-tune job <job_id:{ft_id}>, err:{e}.\n{Style.RESET_ALL}")
+            print(f"{Fore.BLUE}-> The fine-tuning job <job_id:{ft_id}> of account {job['account']} is {status}.\n{Style.RESET_ALL}")
+
+    if job_id is not None and tracked:
+        try:
+            print(f"{Fore.GREEN}-> Last 10 events from current fine-tuning job <job_id:{job_id}>:\n{Style.RESET_ALL}")
+            events = retry.call_with_retries_sync(partial(openai.FineTuningJob.list_events, id=job_id, limit=10, api_key=api_keys.get(tracked[0]["account"], None)),
+                                                  what="Fine-tuning", max_retries=5)
+            sorted_events = sorted(events["data"], key=lambda x: x["created_at"])
+            for event in sorted_events:
+                date = datetime.datetime.fromtimestamp(event["created_at"])
+                print(f"{date} - {event['message']}")
+        except Exception as e:
+            print(f"{Fore.RED}-> Failed to list the events of the fine-tune job <job_id:{job_id}>, err:{e}.\n{Style.RESET_ALL}")
+    elif job_id is not None:
+        print(f"{Fore.RED}-> The fine-tune job <job_id:{job_id}> is not in the registry {registry.path}.\n{Style.RESET_ALL}")
+
+
+def watch_fine_tune(registry: Registry, accounts: List[str], api_keys: Dict[str, str], job_id: Optional[str] = None, concurrency: int = 4,
+                    min_interval: float = 5.0, max_interval: float = 300.0, on_terminal: Optional[str] = None):
+    if job_id is not None:
+        watched = [job for job in [registry.get_job(job_id)] if job is not None]
+        if not watched:
+            print(f"{Fore.RED}-> The fine-tune job <job_id:{job_id}> is not in the registry {registry.path}.\n{Style.RESET_ALL}")
+            return
+    else:
+        watched = [job for account in accounts for job in registry.list_jobs(account=account, active_only=True)]
+    if not watched:
+        print(f"{Fore.YELLOW}-> No unfinished fine-tune job to watch in the registry {registry.path}.\n{Style.RESET_ALL}")
+        return
+
+    config.success()
+    from modules import jobs
+
+    print(f"{Fore.GREEN}-> Watching {len(watched)} fine-tune jobs...\n{Style.RESET_ALL}")
+    n_events = jobs.watch_jobs(registry, watched, api_keys, concurrency=concurrency, min_interval=min_interval, max_interval=max_interval, on_terminal=on_terminal)
+    print(f"{Fore.GREEN}-> Got {sum(n_events.values())} new events from {len(n_events)} fine-tune jobs.\n{Style.RESET_ALL}")
+
+
+def eval_fine_tune(registry: Registry, accounts: List[str], api_keys: Dict[str, str], eval_file: str, model: Optional[str] = None,
+                   job_id: Optional[str] = None, concurrency: int = 4, limit: Optional[int] = None, max_tokens: int = 512,
+                   percentiles: Optional[List[float]] = None, report_file: Optional[str] = None, results_file: Optional[str] = None):
+    account = accounts[0]
+    if model is None:
+        # The model of the given job, or the newest fine-tuned model of the accounts.
+        if job_id is not None:
+            candidates = [job for job in [registry.get_job(job_id)] if job is not None]
+        else:
+            candidates = sorted((job for name in accounts for job in registry.list_jobs(account=name)), key=lambda job: job["created_at"], reverse=True)
+        done = [job for job in candidates if job["status"] == "succeeded" and job["fine_tuned_model"]]
+        if not done:
+            print(f"{Fore.RED}-> No succeeded fine-tune job in the registry {registry.path}, run the status action first or pass --eval_model.\n{Style.RESET_ALL}")
+            return
+        model, account = done[0]["fine_tuned_model"], done[0]["account"]
+    config.success()
+    from modules import evaluate
+
+    evaluate.evaluate_model(eval_file, model, api_key=api_keys[account], concurrency=concurrency, limit=limit, max_tokens=max_tokens,
+                            percentiles=percentiles or (50, 90, 99), report_file=report_file, results_file=results_file)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="ChatGPT Model Fine-Tuning Utility")
-    parser.add_argument("--action", type=str, help="action to perform: check | upload | start | status", required=True)
+    parser.add_argument("--action", type=str, help="action to perform: check | upload | start | status | watch | eval", required=True)
     parser.add_argument("--json_dir", type=str, help="dir to store JSON-structured example files", default="./data")
-    parser.add_argument("--jsonl_file", type=str, help="JSONL-structured file for fine-tuning", default="./data/fine_tune_instructions.jsonl")
+    parser.add_argument("--jsonl_file", type=str, help="JSONL-structured file for fine-tuning, comma-separated files to upload and start several datasets", default="./data/fine_tune_instructions.jsonl")
+    parser.add_argument("--validation_file", type=str, help="JSONL validation file written by split_data.py, comma-separated files paired one by one with --jsonl_file, uploaded and started with it", default=None)
+    parser.add_argument("--workers", type=int, help="number of worker processes used by the data check", default=1)
+    parser.add_argument("--moderation_concurrency", type=int, help="max in-flight moderation requests per worker", default=8)
+    parser.add_argument("--no_cache", action="store_true", help="tokenize and moderate everything again instead of using the check cache")
+    parser.add_argument("--cache_max_mb", type=int, help="size limit of the check cache in MB", default=1024)
+    parser.add_argument("--check_jsonl", action="store_true", help="check every JSONL file given by --jsonl_file instead of the JSON files in --json_dir")
+    parser.add_argument("--mmap", action="store_true", help="memory-map the JSONL file while checking it")
+    parser.add_argument("--percentiles", type=str, help="comma-separated percentiles reported by the data check", default="5,95")
+    parser.add_argument("--histogram_bins", type=int, help="number of histogram bins in the data check report", default=20)
+    parser.add_argument("--report_json", type=str, help="write the data check statistics and cost estimate, or the eval report, to this JSON file", default=None)
+    parser.add_argument("--dedup", action="store_true", help="also report exact and near-duplicate QA pairs and the billed tokens they cost")
+    parser.add_argument("--dedup_threshold", type=float, help="min estimated Jaccard similarity of token shingles for near duplicates", default=0.8)
+    parser.add_argument("--upload_parallel", type=int, help="number of parallel connections uploading parts of the training file", default=4)
+    parser.add_argument("--upload_part_mb", type=int, help="size of each uploaded part in MB", default=8)
+    parser.add_argument("--accounts", type=str, help="comma-separated accounts to upload to and start jobs on, OPENAI_API_KEY_<NAME> in .env is account <name>", default="default")
+    parser.add_argument("--model", type=str, help="base model to fine-tune", default="gpt-3.5-turbo-0613")
+    parser.add_argument("--n_epochs", type=int, help="override the number of epochs suggested by the data check", default=None)
+    parser.add_argument("--concurrency", type=int, help="max in-flight fine-tuning or eval API requests", default=4)
+    parser.add_argument("--force", action="store_true", help="start a job even if the same dataset still has an unfinished one on the account")
+    parser.add_argument("--job_id", type=str, help="only show this fine-tune job, with its last events", default=None)
+    parser.add_argument("--limit", type=int, help="number of most recent jobs shown per account", default=20)
+    parser.add_argument("--min_interval", type=float, help="seconds between polls of a job while it makes progress", default=5.0)
+    parser.add_argument("--max_interval", type=float, help="max seconds between polls of a job while nothing happens", default=300.0)
+    parser.add_argument("--on_terminal", type=str, help="shell command run when a watched job finishes, with FINE_TUNE_JOB_ID, FINE_TUNE_STATUS, FINE_TUNE_ACCOUNT and FINE_TUNED_MODEL set", default=None)
+    parser.add_argument("--eval_file", type=str, help="held-out QA pairs written by prepare_data.py --eval_output", default="./data/eval.jsonl")
+    parser.add_argument("--eval_model", type=str, help="model to evaluate, the newest fine-tuned model of the accounts (or of --job_id) by default", default=None)
+    parser.add_argument("--eval_limit", type=int, help="only replay the first N held-out examples", default=None)
+    parser.add_argument("--eval_max_tokens", type=int, help="max completion tokens per eval answer", default=512)
+    parser.add_argument("--latency_percentiles", type=str, help="comma-separated latency percentiles reported by the eval", default="50,90,99")
+    parser.add_argument("--eval_results", type=str, help="write every eval answer with its scores to this JSONL file", default=None)
+    parser.add_argument("--profile_report", type=str, help="write stage timings, counters and peak memory of the action to this JSON file, or Prometheus textfile if it ends with .prom", default=None)
+    parser.add_argument("--cprofile", type=str, help="dump cProfile stats of the main process to this file", default=None)
     args = parser.parse_args()
     action = args.action
+    profiling.start(f"fine_tune_{action}", args.profile_report, args.cprofile)
     json_dir = args.json_dir
-    jsonl_file = args.jsonl_file
+    jsonl_files = args.jsonl_file.split(",")
+    validation_files = args.validation_file.split(",") if args.validation_file else None
+    if validation_files is not None and len(validation_files) != len(jsonl_files):
+        print(f"{Fore.RED}-> Got {len(validation_files)} validation files for {len(jsonl_files)} training files, pass one per training file.\n{Style.RESET_ALL}")
+        exit(-1)
+
+    accounts = args.accounts.split(",")
+    api_keys = key.accounts()
+    unknown_accounts = [account for account in accounts if account not in api_keys]
+    if unknown_accounts:
+        print(f"{Fore.RED}-> No API key found in .env file for accounts: {', '.join(unknown_accounts)}\n{Style.RESET_ALL}")
+        exit(-1)
+    registry = Registry(os.path.join(tmp_dir, "registry.db"))
+    registry.import_legacy_state(tmp_dir)
     
     if action == "check":
         print(f"{Fore.GREEN}-> Performing action: {action}\n{Style.RESET_ALL}")
-        n_epochs = data_check.check_data_formatting(json_dir)
-        with open(os.path.join(tmp_dir, "n_epochs.txt"), "w") as f:
-            f.write(f"{n_epochs}")
+        config.success()
+        from modules import data_check, upload
+        # Every JSONL file is a dataset of its own, with its own report and n_epochs.
+        for checked_file in jsonl_files if args.check_jsonl else [None]:
+            report_file = args.report_json
+            if report_file is not None and checked_file is not None and len(jsonl_files) > 1:
+                root, ext = os.path.splitext(report_file)
+                report_file = f"{root}.{os.path.splitext(os.path.basename(checked_file))[0]}{ext}"
+            n_epochs = data_check.check_data_formatting(
+                json_dir,
+                workers=args.workers,
+                moderation_concurrency=args.moderation_concurrency,
+                cache_path=None if args.no_cache else os.path.join(tmp_dir, "check_cache.sqlite3"),
+                cache_max_bytes=args.cache_max_mb * 1024 * 1024,
+                jsonl_file=checked_file,
+                use_mmap=args.mmap,
+                percentiles=[float(p) for p in args.percentiles.split(",")],
+                histogram_bins=args.histogram_bins,
+                report_file=report_file,
+                dedup_threshold=args.dedup_threshold if args.dedup else None
+            )
+            registry.set_setting("last_n_epochs", str(n_epochs))
+            if checked_file is not None:
+                registry.record_dataset(upload.file_digests(checked_file)[0], checked_file, n_epochs)
         print(f"{Fore.GREEN}-> Done action: {action}\n{Style.RESET_ALL}")
     elif action == "upload":
         print(f"{Fore.GREEN}-> Performing action: {action}\n{Style.RESET_ALL}")
-        upload_data(jsonl_file)
+        config.success()
+        for data_file in jsonl_files + (validation_files or []):
+            upload_data(registry, data_file, accounts, api_keys, parallel=args.upload_parallel, part_size=args.upload_part_mb * 1024 * 1024)
         print(f"{Fore.GREEN}-> Done action: {action}\n{Style.RESET_ALL}")
     elif action == "start":
         print(f"{Fore.GREEN}-> Performing action: {action}\n{Style.RESET_ALL}")
-        with open(os.path.join(tmp_dir, "n_epochs.txt"), "r") as f:
-            n_epochs = int(f.read())
-        start_fine_tune(n_epochs)
+        config.success()
+        start_fine_tune(registry, jsonl_files, accounts, api_keys, model=args.model, n_epochs=args.n_epochs, concurrency=args.concurrency, force=args.force,
+                        validation_files=validation_files)
         print(f"{Fore.GREEN}-> Done action: {action}\n{Style.RESET_ALL}")
     elif action == "status":
         print(f"{Fore.GREEN}-> Performing action: {action}\n{Style.RESET_ALL}")
-        check_fine_tune()
+        check_fine_tune(registry, accounts, api_keys, job_id=args.job_id, limit=args.limit, concurrency=args.concurrency)
+        print(f"{Fore.GREEN}-> Done action: {action}\n{Style.RESET_ALL}")
+    elif action == "watch":
+        print(f"{Fore.GREEN}-> Performing action: {action}\n{Style.RESET_ALL}")
+        watch_fine_tune(registry, accounts, api_keys, job_id=args.job_id, concurrency=args.concurrency,
+                        min_interval=args.min_interval, max_interval=args.max_interval, on_terminal=args.on_terminal)
+        print(f"{Fore.GREEN}-> Done action: {action}\n{Style.RESET_ALL}")
+    elif action == "eval":
+        print(f"{Fore.GREEN}-> Performing action: {action}\n{Style.RESET_ALL}")
+        eval_fine_tune(registry, accounts, api_keys, args.eval_file, model=args.eval_model, job_id=args.job_id, concurrency=args.concurrency,
+                       limit=args.eval_limit, max_tokens=args.eval_max_tokens, percentiles=[float(p) for p in args.latency_percentiles.split(",")],
+                       report_file=args.report_json, results_file=args.eval_results)
         print(f"{Fore.GREEN}-> Done action: {action}\n{Style.RESET_ALL}")
     else:
         print(f"{Fore.RED}-> Unknown action: {action}\n{Style.RESET_ALL}")
@@ -6,27 +6,144 @@ import ujson as json
 
 from colorama import just_fix_windows_console, Fore, Style
 just_fix_windows_console()
+from concurrent.futures import ProcessPoolExecutor
+from modules import profiling
+from modules.jsonl import MAX_UPLOAD_BYTES, JsonlShardWriter
+from typing import Dict, List
+
+
+def serialize_data_file(data_file: str) -> bytes:
+    with open(data_file, "r", encoding="utf-8") as fin:
+        entry = json.load(fin)
+    return (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class _SerialExecutor:
+    """
+    Stand-in for ProcessPoolExecutor when there is nothing worth sending to other processes.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def map(self, fn, iterable, chunksize=1):
+        return map(fn, iterable)
+
+
+def shard_stat(shard: str) -> Dict[str, int]:
+    stat = os.stat(shard)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _shards_unchanged(manifest: Dict) -> bool:
+    shards, shard_stats = manifest.get("shards", []), manifest.get("shard_stats", [])
+    if len(shards) != len(shard_stats):
+        return False
+    try:
+        return all(shard_stat(shard) == expected for shard, expected in zip(shards, shard_stats))
+    except OSError:
+        return False
+
+
+def load_manifest(manifest_file: str, output_file: str) -> Dict:
+    """
+    Return the manifest of the previous merge into output_file, or an empty one if its shards are gone or were
+    rewritten since (e.g. by prepare_data.py --jsonl_output), their byte ranges cannot be copied over then.
+    """
+    try:
+        with open(manifest_file, "r", encoding="utf-8") as fin:
+            manifest = json.load(fin)
+    except (OSError, ValueError):
+        return {"output": output_file, "shards": [], "files": {}}
+    if manifest.get("output") != output_file or not _shards_unchanged(manifest):
+        return {"output": output_file, "shards": [], "files": {}}
+    return manifest
+
+
+def merge_json_files(data_files: List[str], output_file: str, manifest_file: str, workers: int = 1, max_bytes: int = MAX_UPLOAD_BYTES) -> List[str]:
+    """
+    Merge the data files into output_file (plus rollover shards), one example per line, and return the shard paths.
+
+    Data files whose mtime/size match the manifest of the previous merge are copied over from the previous
+    shards byte for byte, only the new or changed ones get parsed and re-serialized, in parallel with workers > 1.
+    """
+    manifest = load_manifest(manifest_file, output_file)
+    stats = {data_file: os.stat(data_file) for data_file in data_files}
+
+    def _unchanged(data_file):
+        entry = manifest["files"].get(data_file, None)
+        return entry is not None and entry["mtime_ns"] == stats[data_file].st_mtime_ns and entry["size"] == stats[data_file].st_size
+
+    changed_files = [data_file for data_file in data_files if not _unchanged(data_file)]
+    if not changed_files and list(manifest["files"]) == data_files and manifest.get("max_bytes") == max_bytes:
+        print(f"{Fore.GREEN}-> {output_file} is up to date with {len(data_files)} data files.{Style.RESET_ALL}")
+        return manifest["shards"]
+    print(f"{Fore.GREEN}-> Merging {len(data_files)} data files, {len(changed_files)} new or changed.{Style.RESET_ALL}")
+
+    old_shards = [open(shard, "rb") for shard in manifest["shards"]]
+    new_files = {}
+    writer = JsonlShardWriter(output_file, max_bytes)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(changed_files) > 1 else _SerialExecutor() as executor:
+            serialized = executor.map(serialize_data_file, changed_files, chunksize=64)
+            for data_file in data_files:
+                if _unchanged(data_file):
+                    with profiling.stage("merge.copy"):
+                        entry = manifest["files"][data_file]
+                        old_shards[entry["shard"]].seek(entry["offset"])
+                        line = old_shards[entry["shard"]].read(entry["length"])
+                    profiling.count("merge.files_copied")
+                else:
+                    # With workers this is the wait for the next serialized file, parsing itself happens in the workers.
+                    with profiling.stage("merge.serialize"):
+                        line = next(serialized)
+                    profiling.count("merge.files_serialized")
+                with profiling.stage("merge.write"):
+                    shard, offset = writer.write_line(line)
+                profiling.count("merge.bytes_written", len(line))
+                new_files[data_file] = {
+                    "mtime_ns": stats[data_file].st_mtime_ns,
+                    "size": stats[data_file].st_size,
+                    "shard": shard,
+                    "offset": offset,
+                    "length": len(line)
+                }
+    finally:
+        for fin in old_shards:
+            fin.close()
+    shards = writer.close()
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    if not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    with open(manifest_file, "w", encoding="utf-8") as fout:
+        json.dump({"output": output_file, "max_bytes": max_bytes, "shards": shards, "shard_stats": [shard_stat(shard) for shard in shards], "files": new_files}, fout)
+    return shards
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fine-Tuning-Data-Post-Processing Utility")
     parser.add_argument("--input", type=str, help="dir to store JSON-structured data files", default="./data")
     parser.add_argument("--output", type=str, help="dir to store final training file", default="./data")
+    parser.add_argument("--workers", type=int, help="number of worker processes parsing changed data files", default=os.cpu_count())
+    parser.add_argument("--max_mb", type=float, help="size limit of each training file, bigger outputs roll over to extra shards", default=MAX_UPLOAD_BYTES / (1024 * 1024))
+    parser.add_argument("--manifest", type=str, help="mtime/size manifest of the previous merge", default="./.tmp/json2jsonl_manifest.json")
+    parser.add_argument("--profile_report", type=str, help="write stage timings, counters and peak memory to this JSON file, or Prometheus textfile if it ends with .prom", default=None)
+    parser.add_argument("--cprofile", type=str, help="dump cProfile stats of the run to this file", default=None)
     args = parser.parse_args()
+    profiling.start("json2jsonl", args.profile_report, args.cprofile)
     input_dir = args.input
     output_dir = args.output
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    with open(os.path.join(output_dir, "fine_tune_instructions.jsonl"), "w", encoding="utf-8") as jsonl_wt:
-        data_files = glob.glob(os.path.join(input_dir, "*.json"))
-        data_files = sorted(data_files)
-        
-        for data_file in data_files:
-            with open(data_file, "r", encoding="utf-8") as fin:
-                entry = json.load(fin)
-                json.dump(entry, jsonl_wt, ensure_ascii=False)
-                jsonl_wt.write('\n')
-
-        print(f"{Fore.GREEN}-> Generated {os.path.join(output_dir, 'fine_tune_instructions.jsonl')}.{Style.RESET_ALL}")
+    data_files = glob.glob(os.path.join(input_dir, "*.json"))
+    data_files = sorted(data_files)
+
+    shards = merge_json_files(data_files, os.path.join(output_dir, "fine_tune_instructions.jsonl"), args.manifest, args.workers, int(args.max_mb * 1024 * 1024))
+    for shard in shards:
+        print(f"{Fore.GREEN}-> Generated {shard}.{Style.RESET_ALL}")
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import sqlite3
+import time
+
+from collections import Counter
+from typing import Dict, Iterable, Union
+
+# SQLite limits the number of host parameters per statement.
+_QUERY_CHUNK_SIZE = 500
+
+
+def content_hash(*parts: Union[str, bytes]) -> str:
+    """
+    Return the sha256 hex digest of the parts, NUL-separated so that ("ab", "c") != ("a", "bc").
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else part.encode("utf-8", errors="surrogatepass"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache for check results, evicting the least recently used entries above max_bytes.
+
+    Entries are grouped by namespace (e.g. "tokens", "moderation") for the hit/miss statistics,
+    keys are expected to already contain the content hash plus the model/encoding it depends on.
+    Several worker processes may open the same cache file at once.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._conn.commit()
+
+    def get_many(self, namespace: str, keys: Iterable[str]) -> Dict[str, str]:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        for chunk_start in range(0, len(keys), _QUERY_CHUNK_SIZE):
+            chunk = keys[chunk_start:chunk_start + _QUERY_CHUNK_SIZE]
+            rows = self._conn.execute(
+                f"SELECT key, value FROM entries WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            found.update(rows)
+        if found:
+            now = time.time()
+            self._conn.executemany("UPDATE entries SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+            self._conn.commit()
+        self.stats[f"{namespace}_hits"] += len(found)
+        self.stats[f"{namespace}_misses"] += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, str]):
+        if not items:
+            return
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+            [(key, value, len(key) + len(value), now) for key, value in items.items()]
+        )
+        self._conn.commit()
+
+    def evict(self) -> int:
+        """
+        Drop the least recently used entries until the cache fits in max_bytes, return the number of dropped entries.
+        """
+        total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return 0
+        n_evicted = 0
+        while total_size > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT ?", (_QUERY_CHUNK_SIZE,)).fetchall()
+            if not rows:
+                break
+            evicted_keys = []
+            for key, size in rows:
+                if total_size <= self.max_bytes:
+                    break
+                evicted_keys.append((key,))
+                total_size -= size
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", evicted_keys)
+            n_evicted += len(evicted_keys)
+        self._conn.commit()
+        return n_evicted
+
+    def close(self):
+        self._conn.close()
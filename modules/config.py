@@ -1,22 +1,30 @@
 # -*- coding: utf-8 -*-
-import openai
-
 from colorama import just_fix_windows_console, Fore, Style
 just_fix_windows_console()
-from dotenv import dotenv_values
 from modules import key
+from typing import Dict, Optional
+
 
+def success(envs: Optional[Dict[str, Optional[str]]] = None):
+    # Imported here, actions that never talk to the API load the configuration without the openai package.
+    import asyncio
+    import openai
+    # More info: https://github.com/aio-libs/aiohttp/discussions/6044.
+    setattr(asyncio.sslproto._SSLProtocolTransport, "_start_tls_compatible", True)
 
-def success():
-    key.success()
+    envs = envs if envs is not None else key.load_envs()
+    key.success(envs)
 
-    envs = dotenv_values(".env")
     if "OPENAI_API_HTTP_PROXY" not in envs:
         print(f"{Fore.RED}-> No env 'OPENAI_API_HTTP_PROXY' found in .env file\n{Style.RESET_ALL}")
         exit(-1)
     else:
         openai.proxy = envs["OPENAI_API_HTTP_PROXY"]
         print(f"{Fore.YELLOW}-> Loaded openai api http proxy:{openai.proxy}\n{Style.RESET_ALL}")
+    if "OPENAI_API_BASE" in envs:
+        # Optional, point the utility to a local stub server such as benchmark/mock_openai.py.
+        openai.api_base = envs["OPENAI_API_BASE"]
+        print(f"{Fore.YELLOW}-> Loaded openai api base:{openai.api_base}\n{Style.RESET_ALL}")
     openai.log = "info"
 
     print(f"{Fore.GREEN}-> Loaded default settings\n{Style.RESET_ALL}")
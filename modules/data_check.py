@@ -1,26 +1,49 @@
 # -*- coding: utf-8 -*-
 import glob
+import math
+import mmap
 import numpy as np
 import openai
 import os
 import tiktoken
 import ujson as json
 
-from collections import defaultdict
+from array import array
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from colorama import Fore, Style
-from typing import Dict, List
-
-
-def num_tokens_from_messages(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0613") -> int:
+from functools import lru_cache
+from itertools import islice
+from modules import dedup, moderation, profiling
+from modules.cache import ResultCache, content_hash
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Number of data files whose messages are tokenized together in one batched tiktoken call.
+TOKENIZE_CHUNK_SIZE = 512
+# Number of examples per chunk handed to a worker process when the total number of examples is unknown.
+WORKER_CHUNK_SIZE = 64
+# Examples longer than this are truncated during fine-tuning.
+MAX_TOKENS_PER_EXAMPLE = 4096
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str) -> tiktoken.Encoding:
     """
-    Return the number of tokens used by a list of messages.
+    Return the tiktoken encoding for the model, loaded once per process.
     """
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
         print(f"{Fore.YELLOW}-> Warning: Model not found. Using cl100k_base encoding.\n{Style.RESET_ALL}")
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
+
 
+@lru_cache(maxsize=None)
+def _get_message_token_params(model: str) -> Tuple[str, int, int]:
+    """
+    Return (resolved_model, tokens_per_message, tokens_per_name) for the model.
+    """
     if model in {
             "gpt-3.5-turbo-0613",
             "gpt-3.5-turbo-16k-0613",
@@ -30,74 +53,103 @@ def num_tokens_from_messages(messages: List[Dict[str, str]], model: str = "gpt-3
             "gpt-4-32k-0613"
         }:
 
-        tokens_per_message = 3
-        tokens_per_name = 1
+        return model, 3, 1
     elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4
-        tokens_per_name = -1
+        return model, 4, -1
     elif "gpt-3.5-turbo" in model:
         print(f"{Fore.YELLOW}-> Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.\n{Style.RESET_ALL}")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
+        return _get_message_token_params("gpt-3.5-turbo-0613")
     elif "gpt-4" in model:
         print(f"{Fore.YELLOW}-> Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.\n{Style.RESET_ALL}")
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
+        return _get_message_token_params("gpt-4-0613")
     else:
         raise NotImplementedError(
             f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
         )
 
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    # every reply is primed with <|start|>assistant<|message|>
-    num_tokens += 3
-    return num_tokens
+
+def _dict_messages(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    return [message for message in messages if isinstance(message, dict)]
+
+
+def _moderation_items(label: str, messages: List[Dict[str, str]]) -> List[Tuple[str, int, str]]:
+    """
+    The (label, index, content) of every message with text content, the others cannot be moderated.
+    """
+    return [(label, index, message["content"]) for index, message in enumerate(messages) if isinstance(message, dict) and isinstance(message.get("content", None), str)]
+
+
+def num_tokens_from_messages_batch(messages_list: List[List[Dict[str, str]]], model: str = "gpt-3.5-turbo-0613") -> List[Tuple[int, int]]:
+    """
+    Return (total_tokens, assistant_tokens) for every list of messages in a single pass.
+
+    All message values go through one batched tiktoken call, so the encoder work
+    is spread over tiktoken's thread pool instead of one encode() per message.
+    """
+    model, tokens_per_message, tokens_per_name = _get_message_token_params(model)
+    encoding = _get_encoding(model)
+
+    texts = []
+    for messages in messages_list:
+        # Messages that are not objects count no tokens, check_format_errors reports them.
+        for message in _dict_messages(messages):
+            for value in message.values():
+                texts.append(value if isinstance(value, str) else "")
+    lengths = iter([len(tokens) for tokens in encoding.encode_batch(texts)])
+
+    results = []
+    for messages in messages_list:
+        num_tokens = 0
+        num_assistant_tokens = 0
+        for message in _dict_messages(messages):
+            num_tokens += tokens_per_message
+            is_assistant = message.get("role", None) == "assistant"
+            for key in message:
+                n = next(lengths)
+                num_tokens += n
+                if key == "name":
+                    num_tokens += tokens_per_name
+                elif key == "content" and is_assistant:
+                    num_assistant_tokens += n
+        # every reply is primed with <|start|>assistant<|message|>
+        num_tokens += 3
+        results.append((num_tokens, num_assistant_tokens))
+    return results
+
+
+def num_tokens_from_messages(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0613") -> int:
+    """
+    Return the number of tokens used by a list of messages.
+    """
+    return num_tokens_from_messages_batch([messages], model)[0][0]
 
 
 def num_assistant_tokens_from_messages(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0613") -> int:
     """
     Return the number of tokens used by a list of assistant-messages.
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print(f"{Fore.YELLOW}-> Warning: model not found. Using cl100k_base encoding.\n{Style.RESET_ALL}")
-        encoding = tiktoken.get_encoding("cl100k_base")
-
-    num_tokens = 0
-    for message in messages:
-        if message["role"] == "assistant":
-            num_tokens += len(encoding.encode(message["content"]))
-    return num_tokens
+    return num_tokens_from_messages_batch([messages], model)[0][1]
 
 
-def check_moderation(data_file: str, messages: List[Dict[str, str]]):
+def check_moderation(data_file: str, messages: List[Dict[str, str]], concurrency: int = 8) -> List[Dict]:
     """
     To check whether content complies with the OpenAI content policy, https://openai.com/policies/usage-policies.
+
+    Return the flagged messages as compact records, use print_moderation_results to report them.
     """
-    batch_size = 32
+    items = _moderation_items(data_file, messages)
+    return moderation.check_moderation_batch(items, concurrency=concurrency).get(data_file, [])
 
-    for batch_start in range(0, len(messages), batch_size):
-        batches = messages[batch_start:batch_start + batch_size]
-        contents = [message["content"] for message in batches]
-        
-        mod_check = openai.Moderation.create(input=contents)["results"]
-        for i, result in enumerate(mod_check):
-            # 'flagged' will be set to true if the model classifies the content as violating OpenAI's usage policies.
-            if result["flagged"]:
-                global_index = batch_start + i
-                print(f"{Fore.RED}-> Message {global_index} in file {data_file} got flagged!\n{Style.RESET_ALL}")
-                print(f"Message contents (truncated): {messages[global_index]['content'][:50]}...")
-                for name, flagged in result["categories"].items():
-                    if flagged:
-                        print(f"{Fore.RED}-> Flagged category {name} with the score {result['category_scores'][name]}.\n{Style.RESET_ALL}")
+
+def print_moderation_results(data_file: str, flagged_results: List[Dict]):
+    for flagged_result in flagged_results:
+        print(f"{Fore.RED}-> Message {flagged_result['index']} in file {data_file} got flagged!\n{Style.RESET_ALL}")
+        print(f"Message contents (truncated): {flagged_result['content']}...")
+        for name, score in flagged_result["categories"].items():
+            print(f"{Fore.RED}-> Flagged category {name} with the score {score}.\n{Style.RESET_ALL}")
 
 
-def check_format_errors(data_file: str, messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0613") -> Dict[str, int]:
+def check_format_errors(data_file: str, messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0613", convo_len: Optional[int] = None) -> Dict[str, int]:
     """
     To check to make sure the formatting is correct and matches the Chat completions message structure.
     Also need to ensure that the length does not exceed the 4096 token limit.
@@ -110,12 +162,15 @@ def check_format_errors(data_file: str, messages: List[Dict[str, str]], model: s
       To be sure that your entire training example fits in context,
       consider checking that the total token counts in the message contents are under 4,000.
       Each file is currently limited to 50 MB.
+
+    Pass convo_len when the token count is already known to avoid tokenizing the messages again.
     """
     format_errors = defaultdict(int)
     
     for message in messages:
         if not isinstance(message, dict):
             format_errors["message_data_type"] += 1
+            continue
 
         if "role" not in message or "content" not in message:
             format_errors["message_missing_key"] += 1
@@ -130,26 +185,340 @@ def check_format_errors(data_file: str, messages: List[Dict[str, str]], model: s
         if not content or not isinstance(content, str):
             format_errors["message_missing_content"] += 1
 
-    if not any(message.get("role", None) == "assistant" for message in messages):
+    if not any(message.get("role", None) == "assistant" for message in _dict_messages(messages)):
         format_errors["messages_missing_assistant_message"] += 1
 
-    convo_len = num_tokens_from_messages(messages, model)
-    if convo_len > 4096:
+    if convo_len is None:
+        convo_len = num_tokens_from_messages(messages, model)
+    if convo_len > MAX_TOKENS_PER_EXAMPLE:
         format_errors["messages_token_limit"] = 1
 
-    check_moderation(data_file, messages)
-
     return format_errors
 
 
-def print_distribution(values, name):
+def _init_worker(api_key: Optional[str], proxy: Optional[str], api_base: str, profile: bool = False):
+    # Spawned workers do not inherit the settings loaded by config.success(), nor whether profiling is on.
+    openai.api_key = api_key
+    openai.proxy = proxy
+    openai.api_base = api_base
+    profiling.enable(profile)
+
+
+def num_tokens_from_messages_cached(messages_list: List[List[Dict[str, str]]], model: str = "gpt-3.5-turbo-0613", cache: Optional[ResultCache] = None) -> List[Tuple[int, int]]:
+    """
+    Same as num_tokens_from_messages_batch, but only tokenize the lists of messages not found in the cache.
+    """
+    if cache is None:
+        return num_tokens_from_messages_batch(messages_list, model)
+
+    resolved_model = _get_message_token_params(model)[0]
+    encoding_name = _get_encoding(resolved_model).name
+    keys = [f"tokens:{resolved_model}:{encoding_name}:{content_hash(json.dumps(messages, sort_keys=True, ensure_ascii=False))}" for messages in messages_list]
+    cached = cache.get_many("tokens", keys)
+
+    missing = {}
+    for key, messages in zip(keys, messages_list):
+        if key not in cached:
+            missing.setdefault(key, messages)
+    if missing:
+        counted = {key: f"{num_tokens},{num_assistant_tokens}" for key, (num_tokens, num_assistant_tokens) in zip(missing, num_tokens_from_messages_batch(list(missing.values()), model))}
+        cache.put_many(counted)
+        cached.update(counted)
+    return [tuple(int(n) for n in cached[key].split(",")) for key in keys]
+
+
+def iter_jsonl_examples(jsonl_file: str, use_mmap: bool = False) -> Iterator[Tuple[str, bytes]]:
+    """
+    Stream (label, line) pairs out of a JSONL file with constant memory, the label is "<jsonl_file>:<line number>".
+    """
+    with open(jsonl_file, "rb") as fin:
+        if use_mmap and os.path.getsize(jsonl_file) > 0:
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line_no, line in enumerate(iter(mm.readline, b""), 1):
+                    if line.strip():
+                        yield f"{jsonl_file}:{line_no}", line
+        else:
+            for line_no, line in enumerate(fin, 1):
+                if line.strip():
+                    yield f"{jsonl_file}:{line_no}", line
+
+
+def _read_example(label: str, line: Optional[bytes]) -> bytes:
+    if line is not None:
+        return line
+    with open(label, "rb") as fin:
+        return fin.read()
+
+
+def _load_messages(line: bytes) -> Optional[List[Dict[str, str]]]:
+    """
+    Load the messages of a JSONL line or of a whole data file, read alike by _read_example.
+    Return None if it is not a valid JSON object.
+    """
+    profiling.count("check.bytes", len(line))
+    try:
+        example = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(example, dict):
+        return None
+    messages = example.get("messages", [])
+    # A messages value that is not a list is reported as a message of the wrong type.
+    return messages if isinstance(messages, list) else [messages]
+
+
+def qa_pairs_from_messages(messages: List[Dict[str, str]]) -> List[Tuple[str, str]]:
+    """
+    Return the (question, answer) pairs of an example, every user message directly followed by an assistant message.
+    """
+    return [
+        (message["content"], reply["content"]) for message, reply in zip(messages, messages[1:])
+        if isinstance(message, dict) and isinstance(reply, dict) and message.get("role", None) == "user" and reply.get("role", None) == "assistant"
+        and isinstance(message.get("content", None), str) and isinstance(reply.get("content", None), str)
+    ]
+
+
+def _fingerprint_qa_pairs(chunk_messages: List[List[Dict[str, str]]], model: str) -> List[Tuple[np.ndarray, np.ndarray, List[int]]]:
+    """
+    Return the exact hashes, MinHash signatures and token counts of the QA pairs of every example in the chunk.
+    """
+    chunk_pairs = [qa_pairs_from_messages(messages) for messages in chunk_messages]
+    flat_pairs = [pair for pairs in chunk_pairs for pair in pairs]
+    exact_hashes, signatures = dedup.fingerprint_texts([dedup.qa_pair_text(question, answer) for question, answer in flat_pairs], _get_encoding(_get_message_token_params(model)[0]))
+    # Same count as prepare_data.py: the tokens a QA pair adds to an example, without the reply priming.
+    pair_tokens = [num_tokens - 3 for num_tokens, _ in num_tokens_from_messages_batch([[{"role": "user", "content": question}, {"role": "assistant", "content": answer}] for question, answer in flat_pairs], model)]
+
+    fingerprints, start = [], 0
+    for pairs in chunk_pairs:
+        fingerprints.append((exact_hashes[start:start + len(pairs)], signatures[start:start + len(pairs)], pair_tokens[start:start + len(pairs)]))
+        start += len(pairs)
+    return fingerprints
+
+
+def _check_examples(examples: List[Tuple[str, Optional[bytes]]], model: str, moderation_concurrency: int, cache_path: Optional[str],
+                    find_duplicates: bool = False) -> Tuple[List[Dict], Dict[str, int]]:
+    """
+    Load, tokenize and check a chunk of (label, line) examples, return one compact result per example plus the cache statistics.
+    With find_duplicates, every result also carries the fingerprints of the example's QA pairs.
+    """
+    cache = ResultCache(cache_path) if cache_path else None
+
+    chunk_labels = []
+    chunk_messages = []
+    invalid_labels = set()
+    with profiling.stage("check.parse"):
+        for label, line in examples:
+            messages = _load_messages(_read_example(label, line))
+            if messages is None:
+                invalid_labels.add(label)
+                messages = []
+            chunk_labels.append(label)
+            chunk_messages.append(messages)
+    with profiling.stage("check.tokenize"):
+        chunk_tokens = num_tokens_from_messages_cached(chunk_messages, model, cache)
+    # Moderate the whole chunk at once so that batches are packed across data files.
+    moderation_items = [item for label, messages in zip(chunk_labels, chunk_messages) for item in _moderation_items(label, messages)]
+    with profiling.stage("check.moderation"):
+        chunk_flagged_results = moderation.check_moderation_batch(moderation_items, concurrency=moderation_concurrency, cache=cache)
+    chunk_fingerprints = [None] * len(chunk_messages)
+    if find_duplicates:
+        with profiling.stage("check.fingerprint"):
+            chunk_fingerprints = _fingerprint_qa_pairs(chunk_messages, model)
+    profiling.count("check.examples", len(chunk_labels))
+    profiling.count("check.messages", sum(len(messages) for messages in chunk_messages))
+    profiling.count("check.tokens", sum(num_tokens for num_tokens, _ in chunk_tokens))
+
+    results = []
+    with profiling.stage("check.format"):
+        for label, messages, (num_tokens, num_assistant_tokens), fingerprints in zip(chunk_labels, chunk_messages, chunk_tokens, chunk_fingerprints):
+            format_errors = check_format_errors(label, messages, model, convo_len=num_tokens)
+            if label in invalid_labels:
+                format_errors["example_invalid_json"] += 1
+            results.append({
+                "data_file": label,
+                "n_messages": len(messages),
+                "missing_system": not any(message.get("role", None) == "system" for message in _dict_messages(messages)),
+                "missing_user": not any(message.get("role", None) == "user" for message in _dict_messages(messages)),
+                "num_tokens": num_tokens,
+                "num_assistant_tokens": num_assistant_tokens,
+                "format_errors": dict(format_errors),
+                "flagged_results": chunk_flagged_results.get(label, []),
+                "qa_fingerprints": fingerprints
+            })
+
+    if cache is None:
+        return results, {}
+    cache.close()
+    return results, dict(cache.stats)
+
+
+def _check_examples_in_worker(examples: List[Tuple[str, Optional[bytes]]], model: str, moderation_concurrency: int, cache_path: Optional[str],
+                              find_duplicates: bool = False) -> Tuple[List[Dict], Dict[str, int], Optional[Dict]]:
+    # Hand the worker's profiling metrics of the chunk back along with its results, the parent merges them.
+    results, stats = _check_examples(examples, model, moderation_concurrency, cache_path, find_duplicates)
+    return results, stats, profiling.collect() if profiling.enabled() else None
+
+
+def _worker_pool(workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(openai.api_key, openai.proxy, openai.api_base, profiling.enabled()))
+
+
+def _iter_example_results(examples: Iterator[Tuple[str, Optional[bytes]]], n_examples: Optional[int], model: str, workers: int,
+                          moderation_concurrency: int, cache_path: Optional[str], cache_stats: Counter, find_duplicates: bool = False,
+                          executor: Optional[ProcessPoolExecutor] = None):
+    """
+    Yield the results of _check_examples in input order, sharding chunks across a process pool when workers > 1.
+    Only a bounded number of chunks is in flight, so streamed examples are never all held in memory.
+    A given executor is used as is and left open, so that successive calls share its workers.
+    """
+    if workers <= 1:
+        while True:
+            chunk = list(islice(examples, TOKENIZE_CHUNK_SIZE))
+            if not chunk:
+                return
+            results, stats = _check_examples(chunk, model, moderation_concurrency, cache_path, find_duplicates)
+            cache_stats.update(stats)
+            yield from results
+
+    # Keep chunks small enough that every worker gets several of them.
+    chunk_size = WORKER_CHUNK_SIZE if n_examples is None else max(1, min(TOKENIZE_CHUNK_SIZE, math.ceil(n_examples / (workers * 4))))
+    if executor is None:
+        with _worker_pool(workers) as executor:
+            yield from _iter_example_results(examples, n_examples, model, workers, moderation_concurrency, cache_path, cache_stats, find_duplicates, executor)
+        return
+    pending = deque()
+    while True:
+        chunk = list(islice(examples, chunk_size))
+        if not chunk:
+            break
+        pending.append(executor.submit(_check_examples_in_worker, chunk, model, moderation_concurrency, cache_path, find_duplicates))
+        if len(pending) >= workers * 2:
+            with profiling.stage("check.wait_workers"):
+                results, stats, metrics = pending.popleft().result()
+            cache_stats.update(stats)
+            profiling.merge(metrics)
+            yield from results
+    while pending:
+        with profiling.stage("check.wait_workers"):
+            results, stats, metrics = pending.popleft().result()
+        cache_stats.update(stats)
+        profiling.merge(metrics)
+        yield from results
+
+
+def _iter_cached_example_results(examples: Iterator[Tuple[str, Optional[bytes]]], model: str, workers: int, moderation_concurrency: int,
+                                 cache_path: str, cache_stats: Counter, window: int = 16 * TOKENIZE_CHUNK_SIZE):
+    """
+    Same as _iter_example_results, but the whole result of an example is cached by the hash of its bytes,
+    so only new or changed examples are sent to the workers at all. One process pool serves every window.
+    """
+    resolved_model = _get_message_token_params(model)[0]
+    prefix = f"check:{resolved_model}:{_get_encoding(resolved_model).name}:"
+    cache = ResultCache(cache_path)
+    try:
+        with _worker_pool(workers) if workers > 1 else nullcontext() as executor:
+            while True:
+                # The data files are read here once and handed to the workers as bytes.
+                with profiling.stage("check.read"):
+                    chunk = [(label, _read_example(label, line)) for label, line in islice(examples, window)]
+                if not chunk:
+                    return
+                with profiling.stage("check.cache_lookup"):
+                    keys = [prefix + content_hash(line) for _, line in chunk]
+                    stored = cache.get_many("check", keys)
+                missing = [example for example, key in zip(chunk, keys) if key not in stored]
+                fresh = _iter_example_results(iter(missing), len(missing), model, workers, moderation_concurrency, cache_path, cache_stats, executor=executor)
+                new_results = {}
+                try:
+                    for (label, _), key in zip(chunk, keys):
+                        if key in stored:
+                            result = json.loads(stored[key])
+                            result["data_file"] = label
+                        else:
+                            result = next(fresh)
+                            new_results[key] = json.dumps({k: v for k, v in result.items() if k not in ("data_file", "qa_fingerprints")})
+                        yield result
+                finally:
+                    fresh.close()
+                cache.put_many(new_results)
+    finally:
+        cache_stats.update(cache.stats)
+        cache.close()
+
+
+def compute_distributions(values: Dict[str, np.ndarray], percentiles: Sequence[float] = (5, 95), bins: int = 20) -> Dict[str, Dict]:
+    """
+    Compute min/max/mean/median, the given percentiles and a histogram of every equally long array in one vectorized pass.
+    """
+    names = list(values)
+    matrix = np.stack([values[name] for name in names])
+    mins, maxs = matrix.min(axis=1), matrix.max(axis=1)
+    means, medians = matrix.mean(axis=1), np.median(matrix, axis=1)
+    quantiles = np.percentile(matrix, percentiles, axis=1)
+
+    distributions = {}
+    for i, name in enumerate(names):
+        counts, edges = np.histogram(matrix[i], bins=bins)
+        distributions[name] = {
+            "min": int(mins[i]),
+            "max": int(maxs[i]),
+            "mean": float(means[i]),
+            "median": float(medians[i]),
+            "percentiles": {f"p{p:g}": float(quantiles[j, i]) for j, p in enumerate(percentiles)},
+            "histogram": {"counts": counts.tolist(), "edges": edges.tolist()}
+        }
+    return distributions
+
+
+def print_distribution(distribution: Dict, name: str):
     print(f"\n#### Distribution of {name}:")
-    print(f"min / max: {min(values)}, {max(values)}")
-    print(f"mean / median: {np.mean(values)}, {np.median(values)}")
-    print(f"p5 / p95: {np.quantile(values, 0.1)}, {np.quantile(values, 0.9)}\n")
+    print(f"min / max: {distribution['min']}, {distribution['max']}")
+    print(f"mean / median: {distribution['mean']}, {distribution['median']}")
+    print(f"{' / '.join(distribution['percentiles'])}: {', '.join(str(v) for v in distribution['percentiles'].values())}\n")
 
 
-def check_data_formatting(data_dir: str, model: str = "gpt-3.5-turbo-0613") -> int:
+def check_duplicates(duplicate_index: dedup.DuplicateIndex, pair_examples: np.ndarray, example_labels: List[str], kind: str,
+                     threshold: float, n_epochs: int, token_cost_1k: float, max_printed: int = 20) -> Dict:
+    """
+    Report the duplicate QA pairs found in the index and the training tokens they are billed for.
+    """
+    dup_of, exact = duplicate_index.find_duplicates(threshold)
+    summary = duplicate_index.summarize(dup_of, exact)
+    duplicated = np.nonzero(dup_of >= 0)[0]
+    # The position of a QA pair within its example, for the messages below.
+    example_starts = np.searchsorted(pair_examples, pair_examples)
+    for idx in duplicated[:max_printed]:
+        original = dup_of[idx]
+        print(f"{Fore.YELLOW}-> QA pair {idx - example_starts[idx] + 1} of {kind} {example_labels[pair_examples[idx]]} {'duplicates' if exact[idx] else 'nearly duplicates'} "
+              f"QA pair {original - example_starts[original] + 1} of {kind} {example_labels[pair_examples[original]]}.\n{Style.RESET_ALL}")
+    if len(duplicated) > max_printed:
+        print(f"{Fore.YELLOW}-> ... and {len(duplicated) - max_printed} more duplicate QA pairs.\n{Style.RESET_ALL}")
+
+    summary["threshold"] = threshold
+    summary["n_billing_tokens_saved"] = n_epochs * summary["n_duplicate_tokens"]
+    summary["training_cost_saved_usd"] = (summary["n_billing_tokens_saved"] / 1000) * token_cost_1k
+    color = Fore.YELLOW if len(duplicated) > 0 else Fore.GREEN
+    print(f"{color}-> Found {summary['n_exact_duplicates']} exact and {summary['n_near_duplicates']} near duplicates among {summary['n_items']} QA pairs (similarity >= {threshold}).\n{Style.RESET_ALL}")
+    if len(duplicated) > 0:
+        print(f"{color}-> Dropping them (prepare_data.py --dedup) saves ~{summary['n_duplicate_tokens']} tokens per epoch, "
+              f"~{summary['n_billing_tokens_saved']} billed tokens and ~${summary['training_cost_saved_usd']:.2f} over {n_epochs} epochs.\n{Style.RESET_ALL}")
+    return summary
+
+
+def _write_report(report_file: str, report: Dict):
+    report_dir = os.path.dirname(os.path.abspath(report_file))
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    with open(report_file, "w", encoding="utf-8") as fout:
+        json.dump(report, fout, indent=2)
+    print(f"{Fore.GREEN}-> Wrote the data check report to {report_file}.\n{Style.RESET_ALL}")
+
+
+def check_data_formatting(data_dir: str, model: str = "gpt-3.5-turbo-0613", workers: int = 1, moderation_concurrency: int = 8,
+                          cache_path: Optional[str] = None, cache_max_bytes: int = 1024 * 1024 * 1024,
+                          jsonl_file: Optional[str] = None, use_mmap: bool = False,
+                          percentiles: Sequence[float] = (5, 95), histogram_bins: int = 20, report_file: Optional[str] = None,
+                          dedup_threshold: Optional[float] = None, data_files: Optional[List[str]] = None) -> int:
     """
     Once you have compiled a dataset and before you create a fine-tuning job,
     it is important to check the data formatting.
@@ -166,54 +535,128 @@ def check_data_formatting(data_dir: str, model: str = "gpt-3.5-turbo-0613") -> i
       - Usage output: $0.016 / 1K Tokens
       
       For example, a gpt-3.5-turbo fine-tuning job with a training file of 100,000 tokens that is trained for 3 epochs would have an expected cost of $2.40.
+
+    * Parallelism
+
+      With workers > 1 the data files are sharded across a process pool, the report is identical to the serial one.
+      Each worker moderates its chunk of data files with up to moderation_concurrency requests in flight.
+
+    * Caching
+
+      With a cache_path, whole example results, token counts and moderation verdicts are stored on disk keyed
+      by content hash plus model/encoding, so a re-run only checks, tokenizes and moderates new or changed content.
+
+    * JSONL
+
+      With a jsonl_file, the training file itself is streamed line by line (memory-mapped with use_mmap)
+      instead of globbing the JSON files of data_dir, and errors are reported per line number.
+      An explicit list of data_files is checked in the given order instead of globbing data_dir.
+
+    * Report
+
+      The per-example statistics are computed over NumPy arrays, with the given percentiles and histogram_bins.
+      With a report_file, they are written as JSON together with the token, epoch and cost estimates.
+      Without a single example the check fails right away, the report then only carries the error.
+
+    * Duplicates
+
+      With a dedup_threshold, the QA pairs of all examples are checked for exact duplicates (after lowercasing and
+      collapsing whitespace) and for near duplicates whose MinHash-estimated Jaccard similarity over token shingles
+      reaches the threshold. The workers fingerprint the pairs, the LSH search over all of them runs at the end.
+
+    * Profiling
+
+      With modules/profiling.py enabled, parsing, tokenization, moderation and the other stages are timed and the
+      bytes, examples, messages and tokens counted, in the workers too: they send their metrics back with every chunk.
     """
     print(f"{Fore.GREEN}---------- ST DATA FORMATTING CHECK ----------\n{Style.RESET_ALL}")
 
-    data_files = glob.glob(os.path.join(data_dir, "*.json"))
-    data_files = sorted(data_files)
+    if jsonl_file is None:
+        if data_files is None:
+            data_files = sorted(glob.glob(os.path.join(data_dir, "*.json")))
+        examples, n_examples, kind = ((data_file, None) for data_file in data_files), len(data_files), "data file"
+    else:
+        examples, n_examples, kind = iter_jsonl_examples(jsonl_file, use_mmap), None, "line"
     
-    # Warnings and tokens counts
-    total_tokens = 0
+    # Warnings and tokens counts, per-example values are kept in compact int64 arrays
     n_missing_system = 0
     n_missing_user = 0
-    n_messages = []
-    convo_lens = []
-    assistant_message_lens = []
-    for data_file in data_files:
-        with open(data_file, "r") as fin:
-            messages = json.load(fin).get("messages", [])
-        
-        if not any(message["role"] == "system" for message in messages):
+    n_examples_with_errors = 0
+    n_flagged_messages = 0
+    format_error_totals = Counter()
+    n_messages = array("q")
+    convo_lens = array("q")
+    assistant_message_lens = array("q")
+    cache_stats = Counter()
+    duplicate_index = dedup.DuplicateIndex() if dedup_threshold is not None else None
+    example_labels = []
+    pair_examples = array("q")
+    if cache_path and duplicate_index is None:
+        example_results = _iter_cached_example_results(examples, model, workers, moderation_concurrency, cache_path, cache_stats)
+    else:
+        # Fingerprints are not cached, with dedup every example goes through the workers again.
+        example_results = _iter_example_results(examples, n_examples, model, workers, moderation_concurrency, cache_path, cache_stats, duplicate_index is not None)
+    for result in example_results:
+        data_file = result["data_file"]
+        if duplicate_index is not None:
+            exact_hashes, signatures, pair_tokens = result["qa_fingerprints"]
+            duplicate_index.add(exact_hashes, signatures, pair_tokens)
+            pair_examples.extend([len(example_labels)] * len(pair_tokens))
+            example_labels.append(data_file)
+        if result["missing_system"]:
             n_missing_system += 1
-        if not any(message["role"] == "user" for message in messages):
+        if result["missing_user"]:
             n_missing_user += 1
-        n_messages.append(len(messages))
-        num_tokens = num_tokens_from_messages(messages, model)
-        total_tokens += num_tokens
-        convo_lens.append(num_tokens)
-        assistant_message_lens.append(num_assistant_tokens_from_messages(messages, model))
+        n_messages.append(result["n_messages"])
+        convo_lens.append(result["num_tokens"])
+        assistant_message_lens.append(result["num_assistant_tokens"])
 
-        format_errors = check_format_errors(data_file, messages, model)
+        print_moderation_results(data_file, result["flagged_results"])
+        n_flagged_messages += len(result["flagged_results"])
+        format_errors = result["format_errors"]
         if format_errors:
-            print(f"{Fore.RED}-> Found errors in data file {data_file}:\n{Style.RESET_ALL}")
+            n_examples_with_errors += 1
+            format_error_totals.update(format_errors)
+            print(f"{Fore.RED}-> Found errors in {kind} {data_file}:\n{Style.RESET_ALL}")
             for k, v in format_errors.items():
                 if k == "messages_token_limit":
-                    print(f"{Fore.RED}-> The data file may be over the 4096 token limit, it will be truncated during fine-tuning.\n{Style.RESET_ALL}")
+                    print(f"{Fore.RED}-> The {kind} may be over the 4096 token limit, it will be truncated during fine-tuning.\n{Style.RESET_ALL}")
                 else:
                     print(f"{Fore.RED}-> {k}: {v}\n{Style.RESET_ALL}")
         else:
-            print(f"{Fore.GREEN}-> No errors found in data file {data_file}.\n{Style.RESET_ALL}")
+            print(f"{Fore.GREEN}-> No errors found in {kind} {data_file}.\n{Style.RESET_ALL}")
 
     if n_missing_system > 0:
-        print(f"{Fore.RED}-> {n_missing_system} data files missing system message.\n{Style.RESET_ALL}")
+        print(f"{Fore.RED}-> {n_missing_system} {kind}s missing system message.\n{Style.RESET_ALL}")
     if n_missing_user > 0:
-        print(f"{Fore.RED}-> {n_missing_user} data files missing user message.\n{Style.RESET_ALL}")
-    print_distribution(n_messages, "num_messages_per_data_file")
-    print_distribution(convo_lens, "num_total_tokens_per_data_file")
-    print_distribution(assistant_message_lens, "num_assistant_tokens_per_data_file")
+        print(f"{Fore.RED}-> {n_missing_user} {kind}s missing user message.\n{Style.RESET_ALL}")
+    n_messages = np.frombuffer(n_messages, dtype=np.int64)
+    convo_lens = np.frombuffer(convo_lens, dtype=np.int64)
+    assistant_message_lens = np.frombuffer(assistant_message_lens, dtype=np.int64)
+    n_train_examples = len(convo_lens)
+    total_tokens = int(convo_lens.sum())
+    if n_train_examples == 0:
+        # Neither distributions nor epochs make sense without a single example.
+        print(f"{Fore.RED}-> No examples found in {jsonl_file if jsonl_file is not None else data_dir}.\n{Style.RESET_ALL}")
+        if report_file:
+            _write_report(report_file, {
+                "source": jsonl_file if jsonl_file is not None else data_dir,
+                "model": model,
+                "n_examples": 0,
+                "error": "no examples"
+            })
+        print(f"{Fore.GREEN}---------- ED DATA FORMATTING CHECK ----------\n{Style.RESET_ALL}")
+        exit(-1)
+    with profiling.stage("check.distributions"):
+        distributions = compute_distributions({
+            "num_messages_per_data_file": n_messages,
+            "num_total_tokens_per_data_file": convo_lens,
+            "num_assistant_tokens_per_data_file": assistant_message_lens
+        }, percentiles, histogram_bins)
+    for name, distribution in distributions.items():
+        print_distribution(distribution, name)
 
     # Pricing and default n_epochs estimate
-    MAX_TOKENS_PER_EXAMPLE = 4096
     MIN_TARGET_EXAMPLES = 100
     MAX_TARGET_EXAMPLES = 25000
     TARGET_EPOCHS = 3
@@ -221,12 +664,11 @@ def check_data_formatting(data_dir: str, model: str = "gpt-3.5-turbo-0613") -> i
     MAX_EPOCHS = 25
 
     n_epochs = TARGET_EPOCHS
-    n_train_examples = len(data_files)
     if n_train_examples * TARGET_EPOCHS < MIN_TARGET_EXAMPLES:
         n_epochs = min(MAX_EPOCHS, MIN_TARGET_EXAMPLES // n_train_examples)
     elif n_train_examples * TARGET_EPOCHS > MAX_TARGET_EXAMPLES:
         n_epochs = max(MIN_EPOCHS, MAX_TARGET_EXAMPLES // n_train_examples)
-    n_billing_tokens_in_dataset = sum(min(MAX_TOKENS_PER_EXAMPLE, length) for length in convo_lens)
+    n_billing_tokens_in_dataset = int(np.minimum(convo_lens, MAX_TOKENS_PER_EXAMPLE).sum())
     print(f"{Fore.GREEN}-> Dataset has ~{n_billing_tokens_in_dataset} tokens that will be charged for during training.\n{Style.RESET_ALL}")
     print(f"{Fore.GREEN}-> By default, you'll train for {n_epochs} epochs on this dataset.\n{Style.RESET_ALL}")
     print(f"{Fore.GREEN}-> By default, you'll be charged for ~{n_epochs * n_billing_tokens_in_dataset} tokens.\n{Style.RESET_ALL}")
@@ -235,5 +677,40 @@ def check_data_formatting(data_dir: str, model: str = "gpt-3.5-turbo-0613") -> i
     training_cost = (total_tokens / 1000) * token_cost_1k * n_epochs
     print(f"{Fore.GREEN}-> Fine-Tune will cost ~${training_cost:.2f} (epochs = {n_epochs}).\n{Style.RESET_ALL}")
 
+    duplicates = None
+    if duplicate_index is not None:
+        with profiling.stage("check.dedup"):
+            duplicates = check_duplicates(duplicate_index, np.frombuffer(pair_examples, dtype=np.int64), example_labels, kind, dedup_threshold, n_epochs, token_cost_1k)
+
+    if cache_path:
+        cache = ResultCache(cache_path, cache_max_bytes)
+        n_evicted = cache.evict()
+        cache.close()
+        for namespace in ("check", "tokens", "moderation"):
+            print(f"{Fore.GREEN}-> Cache {namespace}: {cache_stats[f'{namespace}_hits']} hits / {cache_stats[f'{namespace}_misses']} misses.\n{Style.RESET_ALL}")
+        if n_evicted > 0:
+            print(f"{Fore.YELLOW}-> Evicted {n_evicted} cache entries to stay under {cache_max_bytes} bytes.\n{Style.RESET_ALL}")
+
+    if report_file:
+        report = {
+            "source": jsonl_file if jsonl_file is not None else data_dir,
+            "model": model,
+            "n_examples": n_train_examples,
+            "n_examples_with_errors": n_examples_with_errors,
+            "n_missing_system": n_missing_system,
+            "n_missing_user": n_missing_user,
+            "n_flagged_messages": n_flagged_messages,
+            "format_errors": dict(format_error_totals),
+            "distributions": distributions,
+            "total_tokens": total_tokens,
+            "n_billing_tokens_in_dataset": n_billing_tokens_in_dataset,
+            "n_epochs": n_epochs,
+            "n_billing_tokens": n_epochs * n_billing_tokens_in_dataset,
+            "training_cost_usd": training_cost,
+            "cache": dict(cache_stats),
+            "duplicates": duplicates
+        }
+        _write_report(report_file, report)
+
     print(f"{Fore.GREEN}---------- ED DATA FORMATTING CHECK ----------\n{Style.RESET_ALL}")
     return n_epochs
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import numpy as np
+import tiktoken
+
+from functools import lru_cache
+from itertools import chain
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# 64 MinHash permutations in 8 bands of 8 rows: pairs below ~0.77 estimated Jaccard similarity rarely share a band.
+NUM_PERM = 64
+NUM_BANDS = 8
+SHINGLE_SIZE = 5
+DEFAULT_THRESHOLD = 0.8
+# Shingles hashed by all permutations at once: 16384 x 64 x 8 bytes = 8 MB of temporaries, whatever the chunk size.
+SIGNATURE_BLOCK = 16384
+# Candidate pairs compared at once, each costs 2 * NUM_PERM bytes of signatures while compared.
+PAIR_BLOCK = 65536
+
+
+def qa_pair_text(question: str, answer: str) -> str:
+    return f"{question}\n{answer}"
+
+
+def normalize_text(text: str) -> str:
+    """
+    Lowercase and collapse whitespace, so that pairs differing only in case or spacing hash the same.
+    """
+    return " ".join(text.lower().split())
+
+
+def exact_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+@lru_cache(maxsize=None)
+def _permutations(num_perm: int, seed: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    # Multiply-shift hashing, ((a * x + b) mod 2^64) >> 32 with odd a, one (a, b) per permutation.
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+@lru_cache(maxsize=None)
+def _shingle_powers(shingle_size: int) -> np.ndarray:
+    return np.uint64(0x100000001B3) ** np.arange(shingle_size, dtype=np.uint64)
+
+
+def _shingle_hashes(token_lists: List[Sequence[int]], shingle_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Hash the shingles of every token list over one concatenated array, return them grouped per list plus each group's offset.
+    A list shorter than shingle_size is a single shingle on its own.
+    """
+    powers = _shingle_powers(shingle_size)
+    lengths = np.array([len(tokens) for tokens in token_lists], dtype=np.int64)
+    tokens = np.fromiter(chain.from_iterable(token_lists), dtype=np.uint64, count=int(lengths.sum()))
+    n_shingles = np.maximum(lengths - shingle_size + 1, 1)
+    offsets = np.concatenate(([0], np.cumsum(n_shingles)[:-1]))
+    shingles = np.empty(int(n_shingles.sum()), dtype=np.uint64)
+
+    full = lengths >= shingle_size
+    if full.any():
+        windows = np.lib.stride_tricks.sliding_window_view(tokens, shingle_size) @ powers
+        token_offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        within = np.arange(int(n_shingles[full].sum())) - np.repeat(np.cumsum(n_shingles[full]) - n_shingles[full], n_shingles[full])
+        shingles[np.repeat(offsets[full], n_shingles[full]) + within] = windows[np.repeat(token_offsets[full], n_shingles[full]) + within]
+    for i in np.nonzero(~full)[0]:
+        shingles[offsets[i]] = np.asarray(token_lists[i], dtype=np.uint64) @ powers[:lengths[i]]
+    return shingles, offsets
+
+
+def minhash_signatures(token_lists: List[Sequence[int]], num_perm: int = NUM_PERM, shingle_size: int = SHINGLE_SIZE) -> np.ndarray:
+    """
+    Return the (len(token_lists), num_perm) uint32 MinHash signatures of the token shingle sets.
+
+    Shingles are hashed block by block, SIGNATURE_BLOCK shingles at a time, and the minimum of every token list is
+    folded into its signature, so memory does not grow with the number of shingles of a chunk.
+    """
+    signatures = np.full((len(token_lists), num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+    if not token_lists:
+        return signatures
+    shingles, offsets = _shingle_hashes(token_lists, shingle_size)
+    a, b = _permutations(num_perm)
+    for start in range(0, len(shingles), SIGNATURE_BLOCK):
+        stop = min(start + SIGNATURE_BLOCK, len(shingles))
+        # The token lists with shingles in the block, the first one may have started in an earlier block.
+        first, last = np.searchsorted(offsets, start, side="right") - 1, np.searchsorted(offsets, stop, side="left")
+        hashes = ((shingles[start:stop, None] * a + b) >> np.uint64(32)).astype(np.uint32)
+        block_mins = np.minimum.reduceat(hashes, np.maximum(offsets[first:last] - start, 0), axis=0)
+        np.minimum(signatures[first:last], block_mins, out=signatures[first:last])
+    return signatures
+
+
+def fingerprint_texts(texts: List[str], encoding: tiktoken.Encoding) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the exact hashes (uint64) and MinHash signatures of the texts, shingled over their tiktoken tokens.
+    """
+    exact_hashes = np.array([exact_hash(text) for text in texts], dtype=np.uint64)
+    signatures = minhash_signatures(encoding.encode_batch([normalize_text(text) for text in texts], disallowed_special=()))
+    return exact_hashes, signatures
+
+
+def _bucket_pairs(bucket: np.ndarray) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Yield every pair of items sharing a bucket as (items, earlier items of their bucket), in blocks of about PAIR_BLOCK pairs.
+    """
+    order = np.argsort(bucket, kind="stable")
+    sorted_bucket = bucket[order]
+    starts = np.concatenate(([0], np.nonzero(sorted_bucket[1:] != sorted_bucket[:-1])[0] + 1))
+    bucket_start = np.repeat(starts, np.diff(np.concatenate((starts, [len(order)]))))
+    # The item at position p of its bucket pairs with the p items before it.
+    n_pairs = np.arange(len(order)) - bucket_start
+    cum_pairs = np.cumsum(n_pairs)
+    lo = 0
+    while lo < len(order):
+        done = cum_pairs[lo - 1] if lo > 0 else 0
+        # At least one item per block, an item pairs with at most its bucket size.
+        hi = max(lo + 1, int(np.searchsorted(cum_pairs, done + PAIR_BLOCK, side="right")))
+        counts = n_pairs[lo:hi]
+        if counts.sum() > 0:
+            within = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+            yield order[np.repeat(np.arange(lo, hi), counts)], order[np.repeat(bucket_start[lo:hi], counts) + within]
+        lo = hi
+
+
+def _find(parent: np.ndarray, items: np.ndarray) -> np.ndarray:
+    """
+    Return the roots of the items, halving the paths of the forest on the way.
+    """
+    roots = parent[items]
+    while True:
+        grand = parent[roots]
+        if np.array_equal(grand, roots):
+            return roots
+        parent[roots] = parent[grand]
+        roots = grand
+
+
+def _union(parent: np.ndarray, items: np.ndarray, partners: np.ndarray):
+    """
+    Join the clusters of every (item, partner) pair, the later root is hung below the earlier one.
+    """
+    while len(items) > 0:
+        item_roots, partner_roots = _find(parent, items), _find(parent, partners)
+        apart = item_roots != partner_roots
+        items, partners = items[apart], partners[apart]
+        # Several pairs may hang the same root, only the smallest wins this round, the others go round again.
+        np.minimum.at(parent, np.maximum(item_roots, partner_roots)[apart], np.minimum(item_roots, partner_roots)[apart])
+
+
+class DuplicateIndex:
+    """
+    Collect fingerprints chunk by chunk, then find exact and near duplicates among all of them at once.
+
+    Exact duplicates are found by sorting the hashes. Near duplicates are candidates sharing a whole LSH band
+    of their signatures, grouped by sorting every band, and kept only if their estimated Jaccard similarity
+    reaches the threshold. No pair of items is compared outside a shared band, pairs are compared in bounded blocks.
+    Each item is held as 8 bytes of hash, 4 * NUM_PERM bytes of signature and its token count.
+    """
+
+    def __init__(self):
+        self._exact_hashes = []
+        self._signatures = []
+        self._n_tokens = []
+
+    def add(self, exact_hashes: np.ndarray, signatures: np.ndarray, n_tokens: Sequence[int]):
+        self._exact_hashes.append(exact_hashes)
+        self._signatures.append(signatures)
+        self._n_tokens.append(np.asarray(n_tokens, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return sum(len(chunk) for chunk in self._exact_hashes)
+
+    def find_duplicates(self, threshold: float = DEFAULT_THRESHOLD, bands: int = NUM_BANDS) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return (dup_of, exact): dup_of[i] is the index of the earlier item that item i duplicates, -1 if it is kept,
+        and exact[i] tells whether that duplicate is exact.
+
+        Near duplicates are clustered: every pair of items sharing a band bucket is compared, pairs reaching the threshold
+        are joined, and every item of a cluster duplicates its earliest item, also when they only meet through others.
+        """
+        n = len(self)
+        dup_of = np.full(n, -1, dtype=np.int64)
+        exact = np.zeros(n, dtype=bool)
+        if n == 0:
+            return dup_of, exact
+        exact_hashes = np.concatenate(self._exact_hashes)
+        signatures = np.concatenate(self._signatures)
+
+        _, first, inverse = np.unique(exact_hashes, return_index=True, return_inverse=True)
+        originals = first[inverse]
+        exact[:] = originals != np.arange(n)
+        dup_of[exact] = originals[exact]
+
+        # Near duplicates among the remaining unique items only, unique is sorted by input order.
+        unique = np.sort(first)
+        unique_signatures = signatures[unique]
+        # Union-find forest over the unique items, a root is always the earliest item of its cluster.
+        parent = np.arange(len(unique))
+        rows = signatures.shape[1] // bands
+        for band in range(bands):
+            band_values = np.ascontiguousarray(unique_signatures[:, band * rows:(band + 1) * rows])
+            _, bucket = np.unique(band_values.view(np.dtype((np.void, band_values.dtype.itemsize * rows))).ravel(), return_inverse=True)
+            for items, partners in _bucket_pairs(bucket.ravel()):
+                # Pairs already clustered through an earlier band or pair need no comparison.
+                apart = _find(parent, items) != _find(parent, partners)
+                items, partners = items[apart], partners[apart]
+                similar = (unique_signatures[items] == unique_signatures[partners]).mean(axis=1) >= threshold
+                _union(parent, items[similar], partners[similar])
+
+        roots = _find(parent, np.arange(len(unique)))
+        near = roots != np.arange(len(unique))
+        dup_of[unique[near]] = unique[roots[near]]
+        return dup_of, exact
+
+    def summarize(self, dup_of: np.ndarray, exact: np.ndarray) -> Dict[str, int]:
+        n_tokens = np.concatenate(self._n_tokens) if self._n_tokens else np.empty(0, dtype=np.int64)
+        duplicated = dup_of >= 0
+        return {
+            "n_items": len(dup_of),
+            "n_exact_duplicates": int(exact.sum()),
+            "n_near_duplicates": int((duplicated & ~exact).sum()),
+            "n_duplicate_tokens": int(n_tokens[duplicated].sum())
+        }
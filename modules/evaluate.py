@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import aiohttp
+import asyncio
+import numpy as np
+import openai
+import re
+import time
+import ujson as json
+
+from colorama import Fore, Style
+from collections import Counter
+from modules import retry
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Usage pricing of fine-tuned gpt-3.5-turbo models, see the docstring of data_check.check_data_formatting.
+USAGE_INPUT_COST_1K = 0.012
+USAGE_OUTPUT_COST_1K = 0.016
+
+# Words, and CJK characters one by one since CJK text has no spaces to split on.
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN_PATTERN = re.compile(f"[{_CJK}]|[^\\W{_CJK}_]+")
+
+
+def load_eval_examples(eval_file: str, limit: Optional[int] = None) -> List[Tuple[List[Dict], str]]:
+    """
+    Read the held-out JSONL file written by prepare_data.py --eval_output, return (prompt messages, reference answer) pairs:
+    the prompt is every message before the last assistant message, which is the reference.
+    """
+    examples = []
+    with open(eval_file, "r", encoding="utf-8") as fin:
+        for line in fin:
+            if limit is not None and len(examples) >= limit:
+                break
+            if not line.strip():
+                continue
+            messages = json.loads(line)["messages"]
+            last = max((idx for idx, message in enumerate(messages) if message["role"] == "assistant"), default=None)
+            if last is None:
+                continue
+            examples.append((messages[:last], messages[last]["content"]))
+    return examples
+
+
+def answer_tokens(text: str) -> List[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def exact_match(prediction: str, reference: str) -> bool:
+    return answer_tokens(prediction) == answer_tokens(reference)
+
+
+def token_f1(prediction: str, reference: str) -> float:
+    """
+    SQuAD-style F1 over the lowercased word (or CJK character) bags of the prediction and the reference.
+    """
+    prediction_tokens, reference_tokens = answer_tokens(prediction), answer_tokens(reference)
+    if not prediction_tokens or not reference_tokens:
+        return float(prediction_tokens == reference_tokens)
+    n_common = sum((Counter(prediction_tokens) & Counter(reference_tokens)).values())
+    if n_common == 0:
+        return 0.0
+    precision, recall = n_common / len(prediction_tokens), n_common / len(reference_tokens)
+    return 2 * precision * recall / (precision + recall)
+
+
+async def _complete(messages: List[Dict], model: str, api_key: Optional[str], semaphore: asyncio.Semaphore, max_tokens: int,
+                    temperature: float, max_retries: int, base_delay: float, max_delay: float) -> Dict:
+    """
+    Send one chat completion, return its answer, usage and the latency of the attempt that succeeded, retries excluded.
+    """
+    attempts = 0
+
+    async def _attempt() -> Dict:
+        nonlocal attempts
+        attempts += 1
+        async with semaphore:
+            st = time.perf_counter()
+            response = await openai.ChatCompletion.acreate(model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, api_key=api_key)
+            return {
+                "prediction": response["choices"][0]["message"]["content"] or "",
+                "latency_s": time.perf_counter() - st,
+                "prompt_tokens": response["usage"]["prompt_tokens"],
+                "completion_tokens": response["usage"]["completion_tokens"],
+                "retries": attempts - 1
+            }
+
+    return await retry.call_with_retries(_attempt, what="Completion", max_retries=max_retries, base_delay=base_delay, max_delay=max_delay)
+
+
+async def _complete_all(examples: List[Tuple[List[Dict], str]], model: str, api_key: Optional[str], concurrency: int, max_tokens: int,
+                        temperature: float, max_retries: int, base_delay: float, max_delay: float) -> List[Dict]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _run(messages: List[Dict]) -> Dict:
+        try:
+            return await _complete(messages, model, api_key, semaphore, max_tokens, temperature, max_retries, base_delay, max_delay)
+        except Exception as e:
+            return {"error": f"{e.__class__.__name__}: {e}"}
+
+    # Share one pooled connection across all requests instead of a new session per request.
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        openai.aiosession.set(session)
+        return await asyncio.gather(*[_run(messages) for messages, _ in examples])
+
+
+def evaluate_model(eval_file: str, model: str, api_key: Optional[str] = None, concurrency: int = 8, limit: Optional[int] = None,
+                   max_tokens: int = 512, temperature: float = 0.0, percentiles: Sequence[float] = (50, 90, 99),
+                   max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                   report_file: Optional[str] = None, results_file: Optional[str] = None) -> Dict:
+    """
+    Replay the held-out examples against the model with at most concurrency requests in flight and report:
+
+      - Latency: percentiles of the successful attempt of each request, retries and backoff excluded.
+      - Throughput: requests/s and completion tokens/s over the whole run, plus the median completion tokens/s of a request.
+      - Cost: the prompt and completion tokens the API billed, at $0.012 / $0.016 per 1K tokens.
+      - Quality: exact match and token F1 of the answers against the reference answers, words and CJK characters
+        lowercased, a rough signal to compare checkpoints rather than an absolute measure.
+
+    Chat completions take one conversation per request, so requests are not batched but pipelined over one pooled session.
+    With a report_file the report is written as JSON, with a results_file every answer is written as a JSONL line.
+    """
+    examples = load_eval_examples(eval_file, limit)
+    if not examples:
+        raise ValueError(f"no example with an assistant answer in {eval_file}")
+    print(f"{Fore.GREEN}-> Evaluating {model} on {len(examples)} held-out examples, {concurrency} requests in flight...\n{Style.RESET_ALL}")
+
+    st = time.perf_counter()
+    results = asyncio.run(_complete_all(examples, model, api_key, concurrency, max_tokens, temperature, max_retries, base_delay, max_delay))
+    elapsed = time.perf_counter() - st
+
+    completed = [(result, reference) for result, (_, reference) in zip(results, examples) if "error" not in result]
+    n_failed = len(examples) - len(completed)
+    for result, reference in completed:
+        result["exact_match"] = exact_match(result["prediction"], reference)
+        result["token_f1"] = token_f1(result["prediction"], reference)
+
+    latencies = np.array([result["latency_s"] for result, _ in completed], dtype=np.float64)
+    prompt_tokens = sum(result["prompt_tokens"] for result, _ in completed)
+    completion_tokens = sum(result["completion_tokens"] for result, _ in completed)
+    request_tokens_per_s = [result["completion_tokens"] / result["latency_s"] for result, _ in completed if result["latency_s"] > 0]
+    cost = (prompt_tokens / 1000) * USAGE_INPUT_COST_1K + (completion_tokens / 1000) * USAGE_OUTPUT_COST_1K
+    report = {
+        "model": model,
+        "eval_file": eval_file,
+        "n_examples": len(examples),
+        "n_failed": n_failed,
+        "n_retries": sum(result["retries"] for result, _ in completed),
+        "concurrency": concurrency,
+        "elapsed_s": elapsed,
+        "requests_per_s": len(completed) / elapsed if elapsed > 0 else 0.0,
+        "latency_s": {
+            "mean": float(latencies.mean()) if len(latencies) else None,
+            **{f"p{p:g}": float(np.percentile(latencies, p)) if len(latencies) else None for p in percentiles}
+        },
+        "completion_tokens_per_s": completion_tokens / elapsed if elapsed > 0 else 0.0,
+        "request_completion_tokens_per_s_median": float(np.median(request_tokens_per_s)) if request_tokens_per_s else None,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost_usd": cost,
+        "cost_per_1k_requests_usd": cost / len(completed) * 1000 if completed else None,
+        "exact_match": float(np.mean([result["exact_match"] for result, _ in completed])) if completed else None,
+        "token_f1": float(np.mean([result["token_f1"] for result, _ in completed])) if completed else None
+    }
+
+    latency_summary = ", ".join(f"{name} {value * 1000:.0f}ms" for name, value in report["latency_s"].items() if value is not None)
+    print(f"{Fore.GREEN}-> {len(completed)}/{len(examples)} requests in {elapsed:.2f}s ({report['requests_per_s']:.1f} requests/s), latency {latency_summary}.{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}-> {completion_tokens} completion tokens, {report['completion_tokens_per_s']:.1f} tokens/s overall, "
+          f"{report['request_completion_tokens_per_s_median'] or 0:.1f} tokens/s per request (median).{Style.RESET_ALL}")
+    print(f"{Fore.GREEN}-> Cost: ~${cost:.4f} for {prompt_tokens} prompt + {completion_tokens} completion tokens, ~${report['cost_per_1k_requests_usd'] or 0:.2f} per 1K requests.{Style.RESET_ALL}")
+    if completed:
+        print(f"{Fore.GREEN}-> Exact match: {report['exact_match']:.2%}, token F1: {report['token_f1']:.2%}.\n{Style.RESET_ALL}")
+    if n_failed > 0:
+        first_error = next(result["error"] for result in results if "error" in result)
+        print(f"{Fore.RED}-> {n_failed} requests failed, first error: {first_error}\n{Style.RESET_ALL}")
+
+    if report_file is not None:
+        with open(report_file, "w", encoding="utf-8") as fout:
+            json.dump(report, fout, indent=2)
+        print(f"{Fore.GREEN}-> Wrote the eval report to {report_file}.\n{Style.RESET_ALL}")
+    if results_file is not None:
+        with open(results_file, "w", encoding="utf-8") as fout:
+            for (messages, reference), result in zip(examples, results):
+                fout.write(json.dumps({"question": messages[-1]["content"] if messages else "", "reference": reference, **result}, ensure_ascii=False))
+                fout.write("\n")
+        print(f"{Fore.GREEN}-> Wrote every answer to {results_file}.\n{Style.RESET_ALL}")
+    return report
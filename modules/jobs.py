@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import aiohttp
+import asyncio
+import datetime
+import openai
+import os
+
+from colorama import Fore, Style
+from functools import partial
+from modules import retry
+from modules.registry import TERMINAL_STATUSES, Registry
+from typing import Dict, List, Optional
+
+# Waiting in the queue or on file validation can take hours, back off faster there than on a running job.
+WATCH_BACKOFF = {"validating_files": 2.0, "queued": 2.0, "running": 1.5}
+
+
+async def _launch_jobs(registry: Registry, launches: List[Dict], api_keys: Dict[str, str], concurrency: int, max_retries: int) -> List[Optional[Dict]]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _launch(launch: Dict) -> Optional[Dict]:
+        params = {"training_file": launch["training_file"], "model": launch["model"], "hyperparameters": {"n_epochs": launch["n_epochs"]}}
+        if launch.get("validation_file", None) is not None:
+            params["validation_file"] = launch["validation_file"]
+        async with semaphore:
+            try:
+                job = await retry.call_with_retries(partial(openai.FineTuningJob.acreate, api_key=api_keys[launch["account"]], **params), what="Fine-tuning", max_retries=max_retries)
+            except Exception as e:
+                print(f"{Fore.RED}-> Failed to start a fine-tune job on <fid: {launch['training_file']}> for account {launch['account']}, err:{e}.\n{Style.RESET_ALL}")
+                return None
+        # Record the job as soon as it exists, so an interrupted run does not lose track of it.
+        registry.record_job(job["id"], launch["account"], launch["training_file"], launch["model"], job["status"],
+                            dataset_hash=launch["dataset_hash"], n_epochs=launch["n_epochs"], validation_file=launch.get("validation_file", None))
+        print(f"{Fore.GREEN}-> Started a fine-tune job <job_id:{job['id']}> on <fid: {launch['training_file']}> for account {launch['account']}!\n{Style.RESET_ALL}")
+        return registry.get_job(job["id"])
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        openai.aiosession.set(session)
+        return await asyncio.gather(*[_launch(launch) for launch in launches])
+
+
+def launch_jobs(registry: Registry, launches: List[Dict], api_keys: Dict[str, str], concurrency: int = 4, max_retries: int = 5) -> List[Optional[Dict]]:
+    """
+    Start a fine-tune job per launch (account, training_file, optional validation_file, dataset_hash, model, n_epochs) with at most
+    concurrency requests in flight, record every started job in the registry and return the job rows,
+    None for the launches that failed.
+    """
+    if not launches:
+        return []
+    return asyncio.run(_launch_jobs(registry, launches, api_keys, concurrency, max_retries))
+
+
+async def _refresh_jobs(registry: Registry, jobs: List[Dict], api_keys: Dict[str, str], concurrency: int, max_retries: int) -> List[Dict]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _refresh(job: Dict) -> Dict:
+        if job["account"] not in api_keys:
+            print(f"{Fore.YELLOW}-> No API key for account {job['account']} of the fine-tune job <job_id:{job['job_id']}>, showing its last known status.\n{Style.RESET_ALL}")
+            return job
+        async with semaphore:
+            try:
+                remote = await retry.call_with_retries(partial(openai.FineTuningJob.aretrieve, id=job["job_id"], api_key=api_keys[job["account"]]), what="Fine-tuning", max_retries=max_retries)
+            except Exception as e:
+                print(f"{Fore.RED}-> Failed to check the fine-tune job <job_id:{job['job_id']}>, err:{e}.\n{Style.RESET_ALL}")
+                return job
+        registry.update_job(job["job_id"], remote["status"], remote.get("fine_tuned_model", None))
+        return registry.get_job(job["job_id"])
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        openai.aiosession.set(session)
+        return await asyncio.gather(*[_refresh(job) for job in jobs])
+
+
+def refresh_jobs(registry: Registry, jobs: List[Dict], api_keys: Dict[str, str], concurrency: int = 4, max_retries: int = 5) -> List[Dict]:
+    """
+    Fetch the current status of the jobs that are not finished yet, update the registry and return all the job rows.
+    """
+    active = [job for job in jobs if job["status"] not in TERMINAL_STATUSES]
+    refreshed = {}
+    if active:
+        refreshed = {job["job_id"]: job for job in asyncio.run(_refresh_jobs(registry, active, api_keys, concurrency, max_retries))}
+    return [refreshed.get(job["job_id"], job) for job in jobs]
+
+
+async def _alist_events(job_id: str, api_key: str, limit: int, after: Optional[str]) -> Dict:
+    # The 0.27 bindings only have a blocking list_events, send the same request through the async requestor.
+    response = await openai.FineTuningJob._astatic_request("get", openai.FineTuningJob.events_url(job_id), api_key=api_key, limit=limit, after=after)
+    return response.data
+
+
+async def _fetch_new_events(job_id: str, api_key: str, cursor: Optional[str], page_size: int, max_retries: int) -> List[Dict]:
+    """
+    Page through the events, newest first, until the cursor event, and return the new ones oldest first.
+    """
+    new_events, after = [], None
+    while True:
+        page = await retry.call_with_retries(partial(_alist_events, job_id=job_id, api_key=api_key, limit=page_size, after=after), what="Fine-tuning", max_retries=max_retries)
+        for event in page["data"]:
+            if event["id"] == cursor:
+                return new_events[::-1]
+            new_events.append(event)
+        if not page.get("has_more", False) or not page["data"]:
+            return new_events[::-1]
+        after = page["data"][-1]["id"]
+
+
+async def _run_hook(command: str, job: Dict):
+    env = dict(os.environ,
+               FINE_TUNE_JOB_ID=job["job_id"],
+               FINE_TUNE_STATUS=job["status"],
+               FINE_TUNE_ACCOUNT=job["account"],
+               FINE_TUNED_MODEL=job["fine_tuned_model"] or "")
+    process = await asyncio.create_subprocess_shell(command, env=env)
+    if await process.wait() != 0:
+        print(f"{Fore.RED}-> The terminal hook of the fine-tune job <job_id:{job['job_id']}> exited with {process.returncode}.\n{Style.RESET_ALL}")
+
+
+async def _watch_jobs(registry: Registry, jobs: List[Dict], api_keys: Dict[str, str], concurrency: int, min_interval: float, max_interval: float,
+                      on_terminal: Optional[str], page_size: int, max_retries: int) -> Dict[str, int]:
+    semaphore = asyncio.Semaphore(concurrency)
+    n_events = {}
+
+    async def _watch(job: Dict):
+        api_key, interval = api_keys[job["account"]], min_interval
+        was_active = job["status"] not in TERMINAL_STATUSES
+        n_events[job["job_id"]] = 0
+        while True:
+            async with semaphore:
+                remote = await retry.call_with_retries(partial(openai.FineTuningJob.aretrieve, id=job["job_id"], api_key=api_key), what="Fine-tuning", max_retries=max_retries)
+                events = await _fetch_new_events(job["job_id"], api_key, job["last_event_id"], page_size, max_retries)
+            for event in events:
+                date = datetime.datetime.fromtimestamp(event["created_at"])
+                print(f"{date} - <job_id:{job['job_id']}> {event['message']}")
+            changed = bool(events) or remote["status"] != job["status"]
+            if events:
+                # Persist the cursor only once the events were shown, a crash re-shows them rather than losing them.
+                registry.set_event_cursor(job["job_id"], events[-1]["id"])
+                n_events[job["job_id"]] += len(events)
+            if remote["status"] != job["status"]:
+                registry.update_job(job["job_id"], remote["status"], remote.get("fine_tuned_model", None))
+            job = registry.get_job(job["job_id"])
+
+            if job["status"] in TERMINAL_STATUSES:
+                color = Fore.GREEN if job["status"] == "succeeded" else Fore.RED
+                print(f"{color}-> The fine-tune job <job_id:{job['job_id']}> of account {job['account']} {job['status']}, fine-tuned model: {job['fine_tuned_model']}.\n{Style.RESET_ALL}")
+                if on_terminal and was_active:
+                    await _run_hook(on_terminal, job)
+                return
+            # Poll again soon while the job makes progress, back off while nothing happens.
+            interval = min_interval if changed else min(max_interval, interval * WATCH_BACKOFF.get(job["status"], 2.0))
+            await asyncio.sleep(interval)
+
+    async def _watch_or_report(job: Dict):
+        try:
+            await _watch(job)
+        except Exception as e:
+            print(f"{Fore.RED}-> Stopped watching the fine-tune job <job_id:{job['job_id']}>, err:{e}.\n{Style.RESET_ALL}")
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        openai.aiosession.set(session)
+        await asyncio.gather(*[_watch_or_report(job) for job in jobs])
+    return n_events
+
+
+def watch_jobs(registry: Registry, jobs: List[Dict], api_keys: Dict[str, str], concurrency: int = 4, min_interval: float = 5.0, max_interval: float = 300.0,
+               on_terminal: Optional[str] = None, page_size: int = 100, max_retries: int = 5) -> Dict[str, int]:
+    """
+    Follow the jobs until every one of them is finished and return the number of new events shown per job.
+
+    Each job is polled from min_interval up to max_interval apart, backing off while its status and events
+    stay the same. Only the events after the cursor persisted in the registry are fetched, and the on_terminal
+    shell command runs once per job that finishes while watched, with FINE_TUNE_JOB_ID, FINE_TUNE_STATUS,
+    FINE_TUNE_ACCOUNT and FINE_TUNED_MODEL set in its environment.
+    """
+    jobs = [job for job in jobs if job["account"] in api_keys]
+    if not jobs:
+        return {}
+    return asyncio.run(_watch_jobs(registry, jobs, api_keys, concurrency, min_interval, max_interval, on_terminal, page_size, max_retries))
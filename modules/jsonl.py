@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os
+
+from colorama import Fore, Style
+from typing import List, Tuple
+
+# OpenAI currently limits each uploaded training file to 50 MB.
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+# Large buffers turn millions of small line writes into a few big ones.
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def shard_path(output_file: str, idx: int) -> str:
+    """
+    The first shard is the output file itself, the next ones are <name>_0001.jsonl, <name>_0002.jsonl, ...
+    """
+    if idx == 0:
+        return output_file
+    root, ext = os.path.splitext(output_file)
+    return f"{root}_{idx:04d}{ext}"
+
+
+class JsonlShardWriter:
+    """
+    Write JSONL lines into output_file, rolling over to additional shard files before a shard exceeds max_bytes.
+
+    Shards are written to temporary files and only replace the previous ones on close(),
+    so the previous shards stay readable while they are being rewritten.
+    """
+
+    def __init__(self, output_file: str, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.output_file = output_file
+        self.max_bytes = max_bytes
+        self.n_lines = 0
+        self._shard_paths = []
+        self._fout = None
+        self._shard_size = 0
+        output_dir = os.path.dirname(os.path.abspath(output_file))
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+    def _roll_over(self):
+        if self._fout is not None:
+            self._fout.close()
+        self._shard_paths.append(shard_path(self.output_file, len(self._shard_paths)))
+        self._fout = open(self._shard_paths[-1] + ".tmp", "wb", buffering=WRITE_BUFFER_SIZE)
+        self._shard_size = 0
+
+    def write_line(self, line: bytes) -> Tuple[int, int]:
+        """
+        Write one newline-terminated line, return the (shard index, byte offset) it was written at.
+        """
+        if self._fout is None or (self._shard_size > 0 and self._shard_size + len(line) > self.max_bytes):
+            self._roll_over()
+        if len(line) > self.max_bytes:
+            print(f"{Fore.YELLOW}-> A single example takes {len(line)} bytes, more than the {self.max_bytes} bytes limit of a shard.\n{Style.RESET_ALL}")
+        offset = self._shard_size
+        self._fout.write(line)
+        self._shard_size += len(line)
+        self.n_lines += 1
+        return len(self._shard_paths) - 1, offset
+
+    def close(self) -> List[str]:
+        """
+        Move the shards in place, drop leftover shards of a previous bigger output, and return the shard paths.
+        """
+        if self._fout is None:
+            self._roll_over()
+        self._fout.close()
+        for path in self._shard_paths:
+            os.replace(path + ".tmp", path)
+        idx = len(self._shard_paths)
+        while os.path.exists(shard_path(self.output_file, idx)):
+            os.remove(shard_path(self.output_file, idx))
+            idx += 1
+        return self._shard_paths
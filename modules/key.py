@@ -1,15 +1,41 @@
 # -*- coding: utf-8 -*-
-import openai
-
 from colorama import Fore, Style
 from dotenv import dotenv_values
+from functools import lru_cache
+from typing import Dict, Optional
+
+
+@lru_cache(maxsize=None)
+def load_envs(path: str = ".env") -> Dict[str, Optional[str]]:
+    """
+    Parse .env once per process, every caller shares the result.
+    """
+    return dotenv_values(path)
 
 
-def success():
-    envs = dotenv_values(".env")
+def success(envs: Optional[Dict[str, Optional[str]]] = None):
+    # Imported here so that reading the accounts alone does not pay for the openai package.
+    import openai
+
+    envs = envs if envs is not None else load_envs()
     if "OPENAI_API_KEY" not in envs:
         print(f"{Fore.RED}-> No env 'OPENAI_API_KEY' found in .env file\n{Style.RESET_ALL}")
         exit(-1)
     else:
         openai.api_key = envs["OPENAI_API_KEY"]
         print(f"{Fore.YELLOW}-> Loaded openai api key:{openai.api_key}\n{Style.RESET_ALL}")
+
+
+def accounts(envs: Optional[Dict[str, Optional[str]]] = None) -> Dict[str, str]:
+    """
+    Return the API key of every account in .env: OPENAI_API_KEY is account "default",
+    OPENAI_API_KEY_<NAME> is account "<name>".
+    """
+    envs = envs if envs is not None else load_envs()
+    api_keys = {}
+    for name, value in envs.items():
+        if name == "OPENAI_API_KEY":
+            api_keys["default"] = value
+        elif name.startswith("OPENAI_API_KEY_") and value:
+            api_keys[name[len("OPENAI_API_KEY_"):].lower()] = value
+    return api_keys
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import aiohttp
+import asyncio
+import openai
+import ujson as json
+
+from modules import retry
+from modules.cache import ResultCache, content_hash
+from typing import Dict, Hashable, List, Optional, Tuple
+
+# Moderation.create is called without a model, so the verdicts are those of the latest moderation model.
+MODERATION_MODEL = "text-moderation-latest"
+
+async def _moderate_batch(contents: List[str], semaphore: asyncio.Semaphore, max_retries: int, base_delay: float, max_delay: float) -> List[Dict]:
+    async def _attempt() -> List[Dict]:
+        async with semaphore:
+            response = await openai.Moderation.acreate(input=contents)
+            return response["results"]
+
+    return await retry.call_with_retries(_attempt, what="Moderation", max_retries=max_retries, base_delay=base_delay, max_delay=max_delay)
+
+
+async def _moderate_contents(contents: List[str], batch_size: int, concurrency: int, max_retries: int, base_delay: float, max_delay: float) -> List[Dict]:
+    semaphore = asyncio.Semaphore(concurrency)
+    # Share one pooled connection across all batches instead of a new session per request.
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        openai.aiosession.set(session)
+        batch_results = await asyncio.gather(*[
+            _moderate_batch(contents[batch_start:batch_start + batch_size], semaphore, max_retries, base_delay, max_delay)
+            for batch_start in range(0, len(contents), batch_size)
+        ])
+    return [result for results in batch_results for result in results]
+
+
+def check_moderation_batch(items: List[Tuple[Hashable, int, str]], batch_size: int = 32, concurrency: int = 8,
+                           max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                           cache: Optional[ResultCache] = None) -> Dict[Hashable, List[Dict]]:
+    """
+    Moderate (key, message_index, content) items from many data files with bounded concurrency.
+
+    Contents are packed into batches of batch_size regardless of which data file they come from,
+    requests failing with 429/5xx are retried with backoff, and the flagged results are attributed
+    back to their key (usually the data file) and message index.
+    With a cache, only contents without a stored verdict are sent to the moderation endpoint.
+    """
+    if not items:
+        return {}
+
+    # Verdicts are "" for compliant content and the JSON-encoded flagged categories otherwise.
+    content_keys = [f"moderation:{content_hash(MODERATION_MODEL, content)}" for _, _, content in items]
+    verdicts = cache.get_many("moderation", content_keys) if cache is not None else {}
+    pending = {}
+    for content_key, (_, _, content) in zip(content_keys, items):
+        if content_key not in verdicts:
+            pending.setdefault(content_key, content)
+
+    if pending:
+        results = asyncio.run(_moderate_contents(list(pending.values()), batch_size, concurrency, max_retries, base_delay, max_delay))
+        new_verdicts = {}
+        for content_key, result in zip(pending, results):
+            # 'flagged' will be set to true if the model classifies the content as violating OpenAI's usage policies.
+            if result["flagged"]:
+                new_verdicts[content_key] = json.dumps({name: result["category_scores"][name] for name, flagged in result["categories"].items() if flagged})
+            else:
+                new_verdicts[content_key] = ""
+        verdicts.update(new_verdicts)
+        if cache is not None:
+            cache.put_many(new_verdicts)
+
+    flagged_results = {}
+    for content_key, (key, index, content) in zip(content_keys, items):
+        if verdicts[content_key]:
+            flagged_results.setdefault(key, []).append({
+                "index": index,
+                "content": content[:50],
+                "categories": json.loads(verdicts[content_key])
+            })
+    return flagged_results
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import atexit
+import contextlib
+import os
+import sys
+import time
+import ujson as json
+
+from collections import Counter
+from colorama import Fore, Style
+from typing import Dict, Iterator, Optional
+try:
+    import resource
+except ImportError:
+    # Windows, peak memory is reported as 0 there.
+    resource = None
+
+# Off by default: stage() and count() then cost one function call, so hot loops can stay instrumented.
+_enabled = False
+_stage_seconds = Counter()
+_stage_calls = Counter()
+_counters = Counter()
+_started_at = time.perf_counter()
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def enable(on: bool = True):
+    global _enabled, _started_at
+    _enabled = on
+    _started_at = time.perf_counter()
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def _peak_rss_bytes(children: bool = False) -> int:
+    if not children and sys.platform.startswith("linux"):
+        # Linux carries ru_maxrss over fork and exec, a script started by a big process would report that one's peak.
+        # VmHWM starts over with the process image.
+        try:
+            with open("/proc/self/status", "rb") as fin:
+                for line in fin:
+                    if line.startswith(b"VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    if resource is None:
+        return 0
+    # ru_maxrss is in KB on Linux and in bytes on macOS.
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+@contextlib.contextmanager
+def _timed_stage(name: str) -> Iterator[None]:
+    st = time.perf_counter()
+    try:
+        yield
+    finally:
+        _stage_seconds[name] += time.perf_counter() - st
+        _stage_calls[name] += 1
+
+
+def stage(name: str):
+    """
+    Time the block under the stage name, nested stages are timed on their own and also count towards their parent.
+    """
+    return _timed_stage(name) if _enabled else _NULL_STAGE
+
+
+def count(name: str, n: int = 1):
+    if _enabled:
+        _counters[name] += n
+
+
+def collect() -> Dict:
+    """
+    Return the metrics recorded so far and start over, a worker process hands them to the parent after every chunk.
+    """
+    snapshot = {"stage_seconds": dict(_stage_seconds), "stage_calls": dict(_stage_calls), "counters": dict(_counters)}
+    _stage_seconds.clear()
+    _stage_calls.clear()
+    _counters.clear()
+    return snapshot
+
+
+def merge(snapshot: Optional[Dict]):
+    """
+    Add the metrics collected in a worker process: stage times are summed across workers, so they are CPU-like
+    seconds that can exceed the wall time of the run.
+    """
+    if not snapshot:
+        return
+    _stage_seconds.update(snapshot["stage_seconds"])
+    _stage_calls.update(snapshot["stage_calls"])
+    _counters.update(snapshot["counters"])
+
+
+def report(script: str) -> Dict:
+    return {
+        "script": script,
+        "wall_seconds": time.perf_counter() - _started_at,
+        "stages": {
+            name: {"seconds": _stage_seconds[name], "calls": _stage_calls[name]}
+            for name in sorted(_stage_seconds)
+        },
+        "counters": dict(sorted(_counters.items())),
+        "peak_rss_bytes": _peak_rss_bytes(),
+        "peak_rss_children_bytes": _peak_rss_bytes(children=True)
+    }
+
+
+def _prometheus_text(report: Dict) -> str:
+    script = report["script"]
+    lines = [
+        "# HELP fine_tune_wall_seconds Wall time of the run.",
+        "# TYPE fine_tune_wall_seconds gauge",
+        f'fine_tune_wall_seconds{{script="{script}"}} {report["wall_seconds"]}',
+        "# HELP fine_tune_stage_seconds Time spent per stage, summed over worker processes.",
+        "# TYPE fine_tune_stage_seconds gauge"
+    ]
+    lines += [f'fine_tune_stage_seconds{{script="{script}",stage="{name}"}} {stage_report["seconds"]}' for name, stage_report in report["stages"].items()]
+    lines += ["# HELP fine_tune_stage_calls Number of times a stage ran.", "# TYPE fine_tune_stage_calls gauge"]
+    lines += [f'fine_tune_stage_calls{{script="{script}",stage="{name}"}} {stage_report["calls"]}' for name, stage_report in report["stages"].items()]
+    lines += ["# HELP fine_tune_items Bytes, examples, tokens and other items processed.", "# TYPE fine_tune_items gauge"]
+    lines += [f'fine_tune_items{{script="{script}",name="{name}"}} {value}' for name, value in report["counters"].items()]
+    lines += [
+        "# HELP fine_tune_peak_rss_bytes Peak resident set size of the main process and of its largest worker.",
+        "# TYPE fine_tune_peak_rss_bytes gauge",
+        f'fine_tune_peak_rss_bytes{{script="{script}",process="main"}} {report["peak_rss_bytes"]}',
+        f'fine_tune_peak_rss_bytes{{script="{script}",process="children"}} {report["peak_rss_children_bytes"]}'
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def write_report(report_file: str, script: str) -> Dict:
+    """
+    Write the report as a Prometheus textfile when report_file ends with .prom, as JSON otherwise.
+    The file is replaced atomically, so a textfile collector never reads half of it.
+    """
+    run_report = report(script)
+    report_dir = os.path.dirname(os.path.abspath(report_file))
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    with open(report_file + ".tmp", "w", encoding="utf-8") as fout:
+        if report_file.endswith(".prom"):
+            fout.write(_prometheus_text(run_report))
+        else:
+            json.dump(run_report, fout, indent=2)
+    os.replace(report_file + ".tmp", report_file)
+    print(f"{Fore.GREEN}-> Wrote the profiling report to {report_file}.{Style.RESET_ALL}")
+    return run_report
+
+
+def _finish(script: str, report_file: Optional[str], profiler, cprofile_file: Optional[str]):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(cprofile_file)
+        print(f"{Fore.GREEN}-> Wrote the cProfile stats to {cprofile_file}.{Style.RESET_ALL}")
+    if report_file is not None:
+        write_report(report_file, script)
+
+
+def start(script: str, report_file: Optional[str] = None, cprofile_file: Optional[str] = None):
+    """
+    Turn the instrumentation on when a report_file is given, and run the main process under cProfile when a cprofile_file
+    is given (open it with pstats or snakeviz). Both are written when the script exits, also through exit(-1).
+    """
+    if report_file is not None:
+        enable()
+    profiler = None
+    if cprofile_file is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    atexit.register(_finish, script, report_file, profiler, cprofile_file)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import time
+import ujson as json
+
+from typing import Dict, List, Optional
+
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+# Every entry upgrades the schema by one version, PRAGMA user_version records how many were applied.
+_MIGRATIONS = [
+    """
+    CREATE TABLE datasets (
+        dataset_hash TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        n_epochs INTEGER,
+        checked_at REAL
+    );
+    CREATE TABLE files (
+        file_id TEXT NOT NULL,
+        account TEXT NOT NULL,
+        dataset_hash TEXT,
+        path TEXT NOT NULL,
+        uploaded_at REAL NOT NULL,
+        PRIMARY KEY (file_id, account)
+    );
+    CREATE INDEX files_dataset ON files (dataset_hash, account);
+    CREATE TABLE jobs (
+        job_id TEXT PRIMARY KEY,
+        account TEXT NOT NULL,
+        dataset_hash TEXT,
+        training_file TEXT NOT NULL,
+        model TEXT NOT NULL,
+        n_epochs INTEGER,
+        status TEXT NOT NULL,
+        fine_tuned_model TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX jobs_status ON jobs (status);
+    CREATE INDEX jobs_dataset ON jobs (dataset_hash, account);
+    CREATE INDEX jobs_file ON jobs (training_file);
+    CREATE TABLE settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    """,
+    # Id of the newest event already shown per job, the watcher only fetches events after it.
+    """
+    ALTER TABLE jobs ADD COLUMN last_event_id TEXT;
+    """,
+    # File id of the validation file the job was started with, if any.
+    """
+    ALTER TABLE jobs ADD COLUMN validation_file TEXT;
+    """
+]
+
+
+class Registry:
+    """
+    Local SQLite store of checked datasets, uploaded files and fine-tune jobs across accounts,
+    indexed by dataset hash, file id and job id. Safe to open from concurrent runs.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        if self._conn.execute("PRAGMA user_version").fetchone()[0] < len(_MIGRATIONS):
+            self._migrate()
+
+    def _migrate(self):
+        """
+        Apply the missing migrations in one write transaction. Concurrent first opens race for them, so the version is
+        read again once the write lock is held and a migration another run applied meanwhile is skipped.
+        """
+        # Manage the transaction by hand, executescript() would commit it before running the migration.
+        self._conn.isolation_level = None
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+                for i, migration in enumerate(_MIGRATIONS[version:], version + 1):
+                    for statement in migration.split(";"):
+                        if statement.strip():
+                            self._conn.execute(statement)
+                    self._conn.execute(f"PRAGMA user_version = {i}")
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        finally:
+            self._conn.isolation_level = ""
+
+    def close(self):
+        self._conn.close()
+
+    def _write(self, sql: str, params=()):
+        with self._conn:
+            self._conn.execute(sql, params)
+
+    def get_setting(self, key: str) -> Optional[str]:
+        row = self._conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row["value"]
+
+    def set_setting(self, key: str, value: str):
+        self._write("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+    def record_dataset(self, dataset_hash: str, path: str, n_epochs: Optional[int] = None):
+        self._write(
+            "INSERT INTO datasets (dataset_hash, path, n_epochs, checked_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (dataset_hash) DO UPDATE SET path = excluded.path, "
+            "n_epochs = COALESCE(excluded.n_epochs, datasets.n_epochs), checked_at = COALESCE(excluded.checked_at, datasets.checked_at)",
+            (dataset_hash, path, n_epochs, time.time() if n_epochs is not None else None)
+        )
+
+    def get_dataset(self, dataset_hash: str) -> Optional[Dict]:
+        row = self._conn.execute("SELECT * FROM datasets WHERE dataset_hash = ?", (dataset_hash,)).fetchone()
+        return None if row is None else dict(row)
+
+    def record_file(self, file_id: str, account: str, path: str, dataset_hash: Optional[str]):
+        self._write(
+            "INSERT OR REPLACE INTO files (file_id, account, dataset_hash, path, uploaded_at) VALUES (?, ?, ?, ?, ?)",
+            (file_id, account, dataset_hash, path, time.time())
+        )
+
+    def find_file(self, dataset_hash: str, account: str) -> Optional[Dict]:
+        row = self._conn.execute(
+            "SELECT * FROM files WHERE dataset_hash = ? AND account = ? ORDER BY uploaded_at DESC LIMIT 1", (dataset_hash, account)
+        ).fetchone()
+        return None if row is None else dict(row)
+
+    def latest_file(self, account: Optional[str] = None) -> Optional[Dict]:
+        if account is None:
+            row = self._conn.execute("SELECT * FROM files ORDER BY uploaded_at DESC LIMIT 1").fetchone()
+        else:
+            row = self._conn.execute("SELECT * FROM files WHERE account = ? ORDER BY uploaded_at DESC LIMIT 1", (account,)).fetchone()
+        return None if row is None else dict(row)
+
+    def record_job(self, job_id: str, account: str, training_file: str, model: str, status: str,
+                   dataset_hash: Optional[str] = None, n_epochs: Optional[int] = None, fine_tuned_model: Optional[str] = None,
+                   validation_file: Optional[str] = None):
+        now = time.time()
+        self._write(
+            "INSERT INTO jobs (job_id, account, dataset_hash, training_file, validation_file, model, n_epochs, status, fine_tuned_model, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (job_id) DO UPDATE SET status = excluded.status, fine_tuned_model = excluded.fine_tuned_model, updated_at = excluded.updated_at",
+            (job_id, account, dataset_hash, training_file, validation_file, model, n_epochs, status, fine_tuned_model, now, now)
+        )
+
+    def update_job(self, job_id: str, status: str, fine_tuned_model: Optional[str] = None):
+        self._write(
+            "UPDATE jobs SET status = ?, fine_tuned_model = COALESCE(?, fine_tuned_model), updated_at = ? WHERE job_id = ?",
+            (status, fine_tuned_model, time.time(), job_id)
+        )
+
+    def set_event_cursor(self, job_id: str, event_id: str):
+        self._write("UPDATE jobs SET last_event_id = ? WHERE job_id = ?", (event_id, job_id))
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return None if row is None else dict(row)
+
+    def list_jobs(self, account: Optional[str] = None, dataset_hash: Optional[str] = None, active_only: bool = False, limit: Optional[int] = None) -> List[Dict]:
+        sql, params = "SELECT * FROM jobs WHERE 1 = 1", []
+        if account is not None:
+            sql, params = sql + " AND account = ?", params + [account]
+        if dataset_hash is not None:
+            sql, params = sql + " AND dataset_hash = ?", params + [dataset_hash]
+        if active_only:
+            sql, params = sql + f" AND status NOT IN ({','.join('?' * len(TERMINAL_STATUSES))})", params + list(TERMINAL_STATUSES)
+        sql += " ORDER BY created_at DESC"
+        if limit is not None:
+            sql, params = sql + " LIMIT ?", params + [limit]
+        return [dict(row) for row in self._conn.execute(sql, params).fetchall()]
+
+    def import_legacy_state(self, tmp_dir: str, account: str = "default"):
+        """
+        Adopt the single-value file_id.txt / ft_id.txt / n_epochs.txt files and the uploads/index.json
+        content-hash index of older versions once, then drop them. A concurrent run may adopt and drop them first,
+        recording them twice is harmless.
+        """
+        index_file = os.path.join(tmp_dir, "uploads", "index.json")
+        try:
+            with open(index_file, "r", encoding="utf-8") as f:
+                for dataset_hash, file_id in json.load(f).items():
+                    self.record_file(file_id, account, "<legacy>", dataset_hash)
+            os.remove(index_file)
+        except FileNotFoundError:
+            pass
+        legacy_files = {name: os.path.join(tmp_dir, f"{name}.txt") for name in ("file_id", "ft_id", "n_epochs")}
+        values = {}
+        for name, path in legacy_files.items():
+            try:
+                with open(path, "r") as f:
+                    values[name] = f.read().strip()
+            except FileNotFoundError:
+                pass
+        if values.get("n_epochs", "").isdigit():
+            self.set_setting("last_n_epochs", values["n_epochs"])
+        if values.get("file_id", None):
+            self.record_file(values["file_id"], account, "<legacy>", None)
+        if values.get("ft_id", None):
+            self.record_job(values["ft_id"], account, values.get("file_id", None) or "<legacy>", "gpt-3.5-turbo-0613", "unknown")
+        for path in legacy_files.values():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import openai
+import random
+import time
+
+from colorama import Fore, Style
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Optional
+
+# Retry on rate limiting and server side failures, everything else is a bug in the request.
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain
+)
+# The same for requests sent without the openai package.
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, RETRYABLE_ERRORS):
+        return True
+    return isinstance(e, openai.error.APIError) and e.http_status is not None and e.http_status >= 500
+
+
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header, either delay-seconds or an HTTP-date, return None if there is none or it makes no sense.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def backoff_delay(e: Exception, attempt: int, base_delay: float = 1.0, max_delay: float = 60.0) -> float:
+    """
+    Honor the Retry-After header when the server sends one, otherwise use exponential backoff with full jitter.
+    """
+    headers = getattr(e, "headers", None) or {}
+    retry_after = retry_after_seconds(headers.get("retry-after", None) or headers.get("Retry-After", None))
+    if retry_after is not None:
+        return min(max_delay, retry_after)
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def _retry_delay(e: Exception, what: str, attempt: int, max_retries: int, base_delay: float, max_delay: float) -> float:
+    """
+    Return how long to wait before the next attempt after e, or raise e if it is not worth another one.
+    """
+    if attempt >= max_retries or not is_retryable(e):
+        raise e
+    delay = backoff_delay(e, attempt, base_delay, max_delay)
+    print(f"{Fore.YELLOW}-> {what} request failed ({e.__class__.__name__}), retry {attempt + 1}/{max_retries} in {delay:.2f}s.\n{Style.RESET_ALL}")
+    return delay
+
+
+async def call_with_retries(fn: Callable[[], Awaitable[Any]], *, what: str, max_retries: int, base_delay: float = 1.0, max_delay: float = 60.0) -> Any:
+    """
+    Await fn() until it succeeds, retrying rate limits and server errors up to max_retries times with backoff_delay.
+    Nothing is held while sleeping, so fn itself takes the semaphore that bounds the requests in flight, if any.
+    """
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except Exception as e:
+            delay = _retry_delay(e, what, attempt, max_retries, base_delay, max_delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+def call_with_retries_sync(fn: Callable[[], Any], *, what: str, max_retries: int, base_delay: float = 1.0, max_delay: float = 60.0) -> Any:
+    """
+    Same as call_with_retries for blocking calls.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            delay = _retry_delay(e, what, attempt, max_retries, base_delay, max_delay)
+        time.sleep(delay)
+        attempt += 1
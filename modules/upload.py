@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+import aiohttp
+import asyncio
+import hashlib
+import openai
+import os
+import ujson as json
+
+from colorama import Fore, Style
+from modules import retry
+from modules.registry import Registry
+from typing import Dict, Optional
+
+# The uploads endpoint accepts parts of up to 64 MB.
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+
+class UploadError(Exception):
+
+    def __init__(self, message: str, status: Optional[int] = None, headers: Optional[Dict] = None):
+        super().__init__(message)
+        self.status = status
+        # Read by retry.backoff_delay for the Retry-After header.
+        self.headers = headers
+
+
+def file_digests(path: str, block_size: int = 8 * 1024 * 1024):
+    """
+    Return the (sha256, md5) hex digests of a file, reading it once.
+    """
+    sha256, md5 = hashlib.sha256(), hashlib.md5()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(block_size), b""):
+            sha256.update(block)
+            md5.update(block)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+def _read_part(path: str, part_size: int, idx: int) -> bytes:
+    with open(path, "rb") as fin:
+        fin.seek(idx * part_size)
+        return fin.read(part_size)
+
+
+def _save_json(path: str, data: Dict):
+    # Write then rename, so an interrupted run never leaves a truncated state file behind.
+    with open(path + ".tmp", "w", encoding="utf-8") as fout:
+        json.dump(data, fout)
+    os.replace(path + ".tmp", path)
+
+
+def _load_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return None
+
+
+def _proxy() -> Optional[str]:
+    if isinstance(openai.proxy, dict):
+        return openai.proxy.get("https", None) or openai.proxy.get("http", None)
+    return openai.proxy
+
+
+async def _request(session: aiohttp.ClientSession, method: str, url: str, max_retries: int, payload: Optional[Dict] = None, form_factory=None) -> Dict:
+    """
+    Send a JSON payload or a multipart form built by form_factory, retrying 429/5xx responses and dropped connections.
+    """
+    attempt = 0
+    while True:
+        try:
+            # Multipart bodies are consumed by a request, every attempt needs a fresh one.
+            data = form_factory() if form_factory is not None else None
+            async with session.request(method, url, json=payload, data=data, proxy=_proxy()) as response:
+                body = await response.json(content_type=None)
+                if response.status < 400:
+                    return body
+                message = body.get("error", {}).get("message", body) if isinstance(body, dict) else body
+                error = UploadError(f"{method} {url} -> {response.status}: {message}", response.status, dict(response.headers))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            error = UploadError(f"{method} {url} -> {e.__class__.__name__}: {e}")
+        if attempt >= max_retries or (error.status is not None and error.status not in retry.RETRYABLE_STATUSES):
+            raise error
+        delay = retry.backoff_delay(error, attempt)
+        print(f"{Fore.YELLOW}-> {error}, retry {attempt + 1}/{max_retries} in {delay:.2f}s.\n{Style.RESET_ALL}")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _upload_parts(path: str, state: Dict, state_file: str, parallel: int, max_retries: int, api_key: str) -> Dict:
+    base_url = openai.api_base.rstrip("/")
+    headers = {"Authorization": f"Bearer {api_key}"}
+    n_parts = max(1, -(-state["bytes"] // state["part_size"]))
+    semaphore = asyncio.Semaphore(parallel)
+
+    async with aiohttp.ClientSession(headers=headers, connector=aiohttp.TCPConnector(limit=parallel)) as session:
+        if state.get("upload_id", None) is None:
+            upload = await _request(session, "POST", f"{base_url}/uploads", max_retries, payload={
+                "purpose": "fine-tune",
+                "filename": os.path.basename(path),
+                "bytes": state["bytes"],
+                "mime_type": "application/jsonl"
+            })
+            state["upload_id"], state["parts"] = upload["id"], {}
+            _save_json(state_file, state)
+        upload_url = f"{base_url}/uploads/{state['upload_id']}"
+
+        async def _upload_part(idx: int):
+            async with semaphore:
+                data = _read_part(path, state["part_size"], idx)
+                part_sha256 = hashlib.sha256(data).hexdigest()
+                done = state["parts"].get(str(idx), None)
+                # A part only counts as done if the bytes on disk still match the recorded checksum.
+                if done is not None and done["sha256"] == part_sha256:
+                    return
+
+                def _form():
+                    form = aiohttp.FormData()
+                    form.add_field("data", data, filename=f"part_{idx:05d}", content_type="application/octet-stream")
+                    return form
+
+                part = await _request(session, "POST", f"{upload_url}/parts", max_retries, form_factory=_form)
+                state["parts"][str(idx)] = {"id": part["id"], "sha256": part_sha256}
+                _save_json(state_file, state)
+                print(f"{Fore.BLUE}-> Uploaded part {len(state['parts'])}/{n_parts} of {path}.\n{Style.RESET_ALL}")
+
+        await asyncio.gather(*[_upload_part(idx) for idx in range(n_parts)])
+
+        return await _request(session, "POST", f"{upload_url}/complete", max_retries, payload={
+            "part_ids": [state["parts"][str(idx)]["id"] for idx in range(n_parts)],
+            "md5": state["md5"]
+        })
+
+
+def upload_file(path: str, tmp_dir: str, parallel: int = 4, part_size: int = DEFAULT_PART_SIZE, max_retries: int = 5,
+                api_key: Optional[str] = None, account: str = "default", registry: Optional[Registry] = None) -> str:
+    """
+    Upload a training file in parts over parallel connections and return its file id.
+
+    Progress is recorded in <tmp_dir>/uploads/<sha256>.json after every part, so an interrupted upload
+    resumes with the missing parts only. With a registry, a file whose content hash was already uploaded
+    to the same account is not sent again, and the new file id is recorded under the content hash.
+    """
+    uploads_dir = os.path.join(tmp_dir, "uploads")
+    if not os.path.exists(uploads_dir):
+        os.makedirs(uploads_dir)
+
+    sha256, md5 = file_digests(path)
+    if registry is not None:
+        uploaded = registry.find_file(sha256, account)
+        if uploaded is not None:
+            print(f"{Fore.GREEN}-> The content of {path} was already uploaded to account {account} as <fid: {uploaded['file_id']}>, skip uploading.\n{Style.RESET_ALL}")
+            return uploaded["file_id"]
+
+    # Parts belong to an upload of one account, keep the resume state of each account apart.
+    state_file = os.path.join(uploads_dir, f"{sha256}.json" if account == "default" else f"{sha256}.{account}.json")
+    state = _load_json(state_file)
+    if state is None or state.get("part_size") != part_size:
+        state = {"path": path, "sha256": sha256, "md5": md5, "bytes": os.path.getsize(path), "part_size": part_size, "upload_id": None, "parts": {}}
+    elif state.get("upload_id", None) is not None:
+        print(f"{Fore.YELLOW}-> Resuming upload <upload_id: {state['upload_id']}> of {path}, {len(state['parts'])} parts already done.\n{Style.RESET_ALL}")
+
+    try:
+        upload = asyncio.run(_upload_parts(path, state, state_file, parallel, max_retries, api_key or openai.api_key))
+    except UploadError as e:
+        # Pending uploads expire after an hour, start over with a fresh one next time.
+        if state.get("upload_id", None) is not None and e.status in (400, 404):
+            state["upload_id"], state["parts"] = None, {}
+            _save_json(state_file, state)
+        raise
+    if upload.get("status", None) != "completed":
+        raise UploadError(f"upload <upload_id: {state['upload_id']}> ended up {upload.get('status', None)}")
+
+    file_id = upload["file"]["id"]
+    if registry is not None:
+        registry.record_file(file_id, account, path, sha256)
+    os.remove(state_file)
+    return file_id
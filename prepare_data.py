@@ -1,11 +1,221 @@
 # -*- coding: utf-8 -*-
 import argparse
+import io
+import numpy as np
 import os
 import ujson as json
 
 from colorama import just_fix_windows_console, Fore, Style
 just_fix_windows_console()
-from copy import deepcopy
+from collections import Counter
+from itertools import islice
+from modules import data_check, dedup, profiling
+from modules.cache import ResultCache, content_hash
+from modules.jsonl import JsonlShardWriter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Large buffers keep the number of read/write syscalls low on multi-GB QA dumps.
+IO_BUFFER_SIZE = 1024 * 1024
+
+
+def iter_qa_pairs(lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Parse "Q:"/"A:" lines into (question, answer) pairs one at a time, a question without an answer is dropped.
+    """
+    question = None
+    for line in lines:
+        if question is not None and line.startswith("A:"):
+            yield question, line[2:].rstrip()
+            question = None
+        elif question is None and line.startswith("Q:"):
+            question = line[2:].rstrip()
+
+
+def count_qa_pairs(raw_data_file: str, dropped: Optional[np.ndarray] = None, eval_ratio: float = 0.0) -> int:
+    """
+    Count the QA pairs that end up in the training data: neither dropped as duplicates nor held out for evaluation.
+    """
+    with open(raw_data_file, "r", encoding="utf-8", buffering=IO_BUFFER_SIZE) as fin:
+        qa_pairs = iter_qa_pairs(fin)
+        if dropped is not None:
+            qa_pairs = drop_qa_pairs(qa_pairs, dropped)
+        return sum(1 for question, _ in qa_pairs if not is_eval_pair(question, eval_ratio))
+
+
+def qa_pair_to_messages(question: str, answer: str) -> Tuple[Dict[str, str], Dict[str, str]]:
+    return {"role": "user", "content": question}, {"role": "assistant", "content": answer}
+
+
+def example_prefix_suffix(base_instructions: Dict) -> Tuple[str, str]:
+    """
+    Split the serialized base instruction around the point where the QA messages get appended,
+    so that an example can be written message by message instead of being built in memory.
+    """
+    head = {k: v for k, v in base_instructions.items() if k != "messages"}
+    prefix = json.dumps(head, ensure_ascii=False)[:-1]
+    if head:
+        prefix += ","
+    prefix += '"messages":[' + ",".join(json.dumps(message, ensure_ascii=False) for message in base_instructions.get("messages", []))
+    return prefix, "]}"
+
+
+def write_example(fout, prefix: str, suffix: str, qa_pairs: Iterable[Tuple[str, str]]) -> int:
+    """
+    Stream one example holding the base instruction plus every QA pair, return the number of QA pairs written.
+    """
+    n_pairs = 0
+    fout.write(prefix)
+    # The base instruction carries at least the system message, unless someone trimmed it.
+    separator = "," if prefix[-1] != "[" else ""
+    for question, answer in qa_pairs:
+        user_message, assistant_message = qa_pair_to_messages(question, answer)
+        fout.write(separator)
+        fout.write(json.dumps(user_message, ensure_ascii=False))
+        fout.write(",")
+        fout.write(json.dumps(assistant_message, ensure_ascii=False))
+        separator = ","
+        n_pairs += 1
+    fout.write(suffix)
+    return n_pairs
+
+
+def iter_fixed_batches(qa_pairs: Iterator[Tuple[str, str]], n_instructions: int, n_batches: int = 10) -> Iterator[Iterable[Tuple[str, str]]]:
+    """
+    Split the QA pairs into batches of n_instructions // n_batches pairs, at least one pair per batch.
+    """
+    batch_size = max(1, n_instructions // n_batches)
+    for _ in range(0, n_instructions, batch_size):
+        yield islice(qa_pairs, batch_size)
+
+
+def iter_qa_pair_tokens(qa_pairs: Iterable[Tuple[str, str]], model: str, cache: Optional[ResultCache] = None) -> Iterator[Tuple[str, str, int]]:
+    """
+    Attach the number of tokens a QA pair adds to an example, tokenizing the pairs in batches,
+    only those without a cached count when a cache is given.
+    """
+    while True:
+        chunk = list(islice(qa_pairs, data_check.TOKENIZE_CHUNK_SIZE))
+        if not chunk:
+            return
+        with profiling.stage("prepare.tokenize"):
+            counts = data_check.num_tokens_from_messages_cached([list(qa_pair_to_messages(question, answer)) for question, answer in chunk], model, cache)
+        profiling.count("prepare.tokens", sum(num_tokens for num_tokens, _ in counts))
+        for (question, answer), (num_tokens, _) in zip(chunk, counts):
+            # Drop the reply priming, it is paid once per example and already part of the base instruction count.
+            yield question, answer, num_tokens - 3
+
+
+def is_content_cut(question: str, answer: str, cut_every: int) -> bool:
+    """
+    Whether an example ends after this QA pair, decided by the pair's content alone: about one pair in cut_every.
+    """
+    return int(content_hash(question, answer)[:8], 16) % cut_every == 0
+
+
+def is_eval_pair(question: str, eval_ratio: float) -> bool:
+    """
+    Whether a QA pair is held out for evaluation, decided by its question alone: the split is the same on every run
+    and a question asked twice never lands on both sides.
+    """
+    return eval_ratio > 0 and int(content_hash("eval", question)[:8], 16) < eval_ratio * 0x100000000
+
+
+def hold_out_qa_pairs(qa_pairs: Iterable[Tuple[str, str]], eval_ratio: float, fout, prefix: str, suffix: str, holdout_stats: Counter) -> Iterator[Tuple[str, str]]:
+    """
+    Write the held-out QA pairs to fout as one JSONL example each, base instruction included, and pass the others through.
+    """
+    for question, answer in qa_pairs:
+        if is_eval_pair(question, eval_ratio):
+            write_example(fout, prefix, suffix, [(question, answer)])
+            fout.write("\n")
+            holdout_stats["eval"] += 1
+        else:
+            yield question, answer
+
+
+def iter_packed_examples(qa_pair_tokens: Iterator[Tuple[str, str, int]], budget: float, strategy: str = "greedy", window: int = 10000,
+                         cut_every: Optional[int] = None) -> Iterator[Tuple[List[Tuple[str, str]], int]]:
+    """
+    Pack QA pairs into examples holding at most budget QA tokens, yield (qa_pairs, qa_tokens) per example.
+
+    "greedy" fills examples in input order and keeps only one example in memory,
+    "ffd" runs first-fit-decreasing bin-packing over windows of up to window QA pairs.
+    A QA pair larger than the budget on its own still gets an example of its own.
+    With cut_every, greedy examples also end after content-defined QA pairs (see is_content_cut),
+    so inserting or appending pairs only changes the examples around them.
+    """
+    if strategy == "greedy":
+        example, example_tokens = [], 0
+        for question, answer, n_tokens in qa_pair_tokens:
+            if example and example_tokens + n_tokens > budget:
+                yield example, example_tokens
+                example, example_tokens = [], 0
+            example.append((question, answer))
+            example_tokens += n_tokens
+            if cut_every is not None and is_content_cut(question, answer, cut_every):
+                yield example, example_tokens
+                example, example_tokens = [], 0
+        if example:
+            yield example, example_tokens
+    elif strategy == "ffd":
+        while True:
+            items = list(islice(qa_pair_tokens, window))
+            if not items:
+                return
+            items.sort(key=lambda item: item[2], reverse=True)
+            bins = []
+            for question, answer, n_tokens in items:
+                for example in bins:
+                    if example[1] + n_tokens <= budget:
+                        example[0].append((question, answer))
+                        example[1] += n_tokens
+                        break
+                else:
+                    bins.append([[(question, answer)], n_tokens])
+            for example, example_tokens in bins:
+                yield example, example_tokens
+    else:
+        raise ValueError(f"unknown packing strategy {strategy}")
+
+
+def find_duplicate_qa_pairs(raw_data_file: str, model: str, threshold: float = dedup.DEFAULT_THRESHOLD) -> Tuple[np.ndarray, Dict[str, int]]:
+    """
+    Fingerprint every QA pair of the raw data in a first streaming pass, return a mask of the pairs that duplicate
+    an earlier one (exactly or with estimated Jaccard similarity >= threshold) and the dedup statistics.
+    """
+    duplicate_index = dedup.DuplicateIndex()
+    encoding = data_check._get_encoding(data_check._get_message_token_params(model)[0])
+    with open(raw_data_file, "r", encoding="utf-8", buffering=IO_BUFFER_SIZE) as fin:
+        qa_pair_tokens = iter_qa_pair_tokens(iter_qa_pairs(fin), model)
+        while True:
+            chunk = list(islice(qa_pair_tokens, data_check.TOKENIZE_CHUNK_SIZE))
+            if not chunk:
+                break
+            exact_hashes, signatures = dedup.fingerprint_texts([dedup.qa_pair_text(question, answer) for question, answer, _ in chunk], encoding)
+            duplicate_index.add(exact_hashes, signatures, [n_tokens for _, _, n_tokens in chunk])
+    dup_of, exact = duplicate_index.find_duplicates(threshold)
+    return dup_of >= 0, duplicate_index.summarize(dup_of, exact)
+
+
+def drop_qa_pairs(qa_pairs: Iterable[Tuple[str, str]], dropped: np.ndarray) -> Iterator[Tuple[str, str]]:
+    for idx, qa_pair in enumerate(qa_pairs):
+        if not dropped[idx]:
+            yield qa_pair
+
+
+def track_packing(packed_examples: Iterator[Tuple[List[Tuple[str, str]], int]], base_tokens: int, budget: int, packing_stats: Counter) -> Iterator[List[Tuple[str, str]]]:
+    """
+    Pass the packed examples through while counting useful QA tokens against the tokens billed per epoch.
+    """
+    # Training truncates examples to the first MAX_TOKENS_PER_EXAMPLE tokens, those are all that get billed or learned from.
+    max_qa_tokens = max(0, data_check.MAX_TOKENS_PER_EXAMPLE - base_tokens)
+    for example, example_tokens in packed_examples:
+        packing_stats["examples"] += 1
+        packing_stats["oversized"] += example_tokens > budget
+        packing_stats["useful_tokens"] += min(max_qa_tokens, example_tokens)
+        packing_stats["truncated_tokens"] += max(0, example_tokens - max_qa_tokens)
+        packing_stats["billed_tokens"] += min(data_check.MAX_TOKENS_PER_EXAMPLE, base_tokens + example_tokens)
+        yield example
 
 
 if __name__ == "__main__":
@@ -13,7 +223,19 @@ if __name__ == "__main__":
     parser.add_argument("--raw_data", type=str, help="raw data file", default="./test/raw_data/qa.txt")
     parser.add_argument("--base_system_instruction", type=str, help="system instruction should appear in every example", default="./test/raw_data/fine_tune_instructions_base.json")
     parser.add_argument("--output", type=str, help="output dir to store structured data files", default="./data")
+    parser.add_argument("--max_tokens", type=int, help="pack QA pairs into examples of at most this many tokens, system prompt included", default=None)
+    parser.add_argument("--packing", type=str, help="packing strategy used with --max_tokens: greedy | ffd", default="greedy")
+    parser.add_argument("--packing_window", type=int, help="number of QA pairs bin-packed together by the ffd strategy", default=10000)
+    parser.add_argument("--model", type=str, help="model whose tokenizer is used to count tokens", default="gpt-3.5-turbo-0613")
+    parser.add_argument("--jsonl_output", type=str, help="write the final JSONL training file directly instead of JSON files into --output", default=None)
+    parser.add_argument("--dedup", action="store_true", help="drop QA pairs that exactly or nearly duplicate an earlier one")
+    parser.add_argument("--dedup_threshold", type=float, help="min estimated Jaccard similarity of token shingles for near duplicates", default=dedup.DEFAULT_THRESHOLD)
+    parser.add_argument("--eval_output", type=str, help="hold out QA pairs into this JSONL file for fine_tune.py --action=eval, they are left out of the training data", default=None)
+    parser.add_argument("--eval_ratio", type=float, help="fraction of QA pairs held out with --eval_output, picked by a hash of the question", default=0.05)
+    parser.add_argument("--profile_report", type=str, help="write stage timings, counters and peak memory to this JSON file, or Prometheus textfile if it ends with .prom", default=None)
+    parser.add_argument("--cprofile", type=str, help="dump cProfile stats of the run to this file", default=None)
     args = parser.parse_args()
+    profiling.start("prepare", args.profile_report, args.cprofile)
     raw_data_file = args.raw_data
     base_system_instruction_file = args.base_system_instruction
     output_dir = args.output
@@ -21,48 +243,90 @@ if __name__ == "__main__":
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    with open(raw_data_file, "r", encoding="utf-8") as f1, open(base_system_instruction_file, "r", encoding="utf-8") as f2:
-
-        instructions = []
-        idx = -1
-        match = False
-        for line in f1.readlines():
-            if match and line.startswith("A:"):
-                instructions[idx]["A"] = line[2:].rstrip()
-                match = False
-            elif not match and line.startswith("Q:"):
-                instructions.append({"Q": line[2:].rstrip()})
-                idx += 1
-                match = True
-        print(f"{Fore.GREEN}-> Loaded {len(instructions)} QA pairs.{Style.RESET_ALL}")
-
+    with open(base_system_instruction_file, "r", encoding="utf-8") as f2:
         base_instructions = json.loads(f2.read())
+    prefix, suffix = example_prefix_suffix(base_instructions)
+
+    if args.dedup:
+        # The first pass only keeps fingerprints, the QA pairs themselves are streamed again below.
+        with profiling.stage("prepare.dedup"):
+            dropped, dedup_stats = find_duplicate_qa_pairs(raw_data_file, args.model, args.dedup_threshold)
+        print(f"{Fore.GREEN}-> Dropped {dedup_stats['n_exact_duplicates']} exact and {dedup_stats['n_near_duplicates']} near duplicates of {dedup_stats['n_items']} QA pairs "
+              f"(similarity >= {args.dedup_threshold}), ~{dedup_stats['n_duplicate_tokens']} fewer tokens billed per epoch.{Style.RESET_ALL}")
+
+    eval_ratio = args.eval_ratio if args.eval_output is not None else 0.0
+    if not 0 <= eval_ratio < 1:
+        print(f"{Fore.RED}-> --eval_ratio must be in [0, 1), got {eval_ratio}.{Style.RESET_ALL}")
+        exit(-1)
+    holdout_stats = Counter()
+    with open(raw_data_file, "r", encoding="utf-8", buffering=IO_BUFFER_SIZE) as f1, \
+            open(args.eval_output or os.devnull, "w", encoding="utf-8", buffering=IO_BUFFER_SIZE) as f4:
+        qa_pairs = iter_qa_pairs(f1)
+        if args.dedup:
+            qa_pairs = drop_qa_pairs(qa_pairs, dropped)
+        if eval_ratio > 0:
+            qa_pairs = hold_out_qa_pairs(qa_pairs, eval_ratio, f4, prefix, suffix, holdout_stats)
+
+        if args.max_tokens is None:
+            # A cheap first pass to size the batches, the second pass streams the QA pairs straight into the data files.
+            with profiling.stage("prepare.count"):
+                n_instructions = count_qa_pairs(raw_data_file, dropped if args.dedup else None, eval_ratio)
+            print(f"{Fore.GREEN}-> Loaded {n_instructions} QA pairs.{Style.RESET_ALL}")
+            examples = iter_fixed_batches(qa_pairs, n_instructions)
+        else:
+            base_tokens = data_check.num_tokens_from_messages(base_instructions.get("messages", []), args.model)
+            budget = args.max_tokens - base_tokens
+            if budget <= 0:
+                print(f"{Fore.RED}-> The base instruction alone takes {base_tokens} tokens, no room left under --max_tokens={args.max_tokens}.{Style.RESET_ALL}")
+                exit(-1)
+            packed_examples = iter_packed_examples(iter_qa_pair_tokens(qa_pairs, args.model), budget, args.packing, args.packing_window)
+            packing_stats = Counter()
+            examples = track_packing(packed_examples, base_tokens, budget, packing_stats)
 
         feed_instructions = 0
-        idx = 0
-        batch_size = len(instructions) // 10
-        for batch_start in range(0, len(instructions), batch_size):
-            idx += 1
-
-            _base_instructions = deepcopy(base_instructions)
-            batched_instructions = instructions[batch_start:batch_start + batch_size]
-            feed_instructions += len(batched_instructions)
-            with open(os.path.join(output_dir, f"fine_tune_instructions_{idx:04d}.json"), "w", encoding="utf-8") as f3:
-                for x in batched_instructions:
-                    _base_instructions["messages"].append(
-                        {
-                            "role": "user",
-                            "content": x["Q"]
-                        }
-                    )
-                    _base_instructions["messages"].append(
-                        {
-                            "role": "assistant",
-                            "content": x["A"]
-                        }
-                    )
-                json.dump(_base_instructions, f3, indent=2, ensure_ascii=False)
-
-            print(f"{Fore.GREEN}-> Generated {os.path.join(output_dir, f'fine_tune_instructions_{idx:04d}.json')}.{Style.RESET_ALL}")
-
-        assert feed_instructions == len(instructions), "Check Your Shit Code!"
+        # Reading, tokenizing and packing the QA pairs happen lazily as the examples are written, they are part of this stage.
+        with profiling.stage("prepare.examples"):
+            if args.jsonl_output is None:
+                for idx, example in enumerate(examples, 1):
+                    # Serialized in memory like the JSONL lines below, so that the bytes are counted without a stat.
+                    buffer = io.StringIO()
+                    feed_instructions += write_example(buffer, prefix, suffix, example)
+                    data = buffer.getvalue().encode("utf-8")
+                    with open(os.path.join(output_dir, f"fine_tune_instructions_{idx:04d}.json"), "wb", buffering=IO_BUFFER_SIZE) as f3:
+                        f3.write(data)
+                    profiling.count("prepare.examples")
+                    profiling.count("prepare.bytes_written", len(data))
+
+                    print(f"{Fore.GREEN}-> Generated {os.path.join(output_dir, f'fine_tune_instructions_{idx:04d}.json')}.{Style.RESET_ALL}")
+            else:
+                # Skip the per-example JSON files and the json2jsonl.py pass, stream every example as one line of the training file.
+                writer = JsonlShardWriter(args.jsonl_output)
+                for example in examples:
+                    line = io.StringIO()
+                    feed_instructions += write_example(line, prefix, suffix, example)
+                    line.write("\n")
+                    data = line.getvalue().encode("utf-8")
+                    writer.write_line(data)
+                    profiling.count("prepare.examples")
+                    profiling.count("prepare.bytes_written", len(data))
+                for shard in writer.close():
+                    print(f"{Fore.GREEN}-> Generated {shard}.{Style.RESET_ALL}")
+
+        # Held-out QA pairs after the last training pair are only written once the QA pairs run out.
+        leftover = next(qa_pairs, None)
+        assert leftover is None, "Check Your Shit Code!"
+
+    profiling.count("prepare.bytes_read", os.path.getsize(raw_data_file))
+    profiling.count("prepare.qa_pairs", feed_instructions)
+    profiling.count("prepare.eval_pairs", holdout_stats["eval"])
+    if args.eval_output is not None:
+        print(f"{Fore.GREEN}-> Held out {holdout_stats['eval']} QA pairs for evaluation into {args.eval_output}.{Style.RESET_ALL}")
+    if args.max_tokens is None:
+        assert feed_instructions == n_instructions, "Check Your Shit Code!"
+    else:
+        print(f"{Fore.GREEN}-> Packed {feed_instructions} QA pairs into {packing_stats['examples']} examples of at most {args.max_tokens} tokens ({args.packing}).{Style.RESET_ALL}")
+        if packing_stats["oversized"] > 0:
+            print(f"{Fore.YELLOW}-> {packing_stats['oversized']} QA pairs do not fit into the token budget on their own, they got an example each, "
+              f"{packing_stats['truncated_tokens']} of their tokens are past the {data_check.MAX_TOKENS_PER_EXAMPLE} tokens training keeps.{Style.RESET_ALL}")
+        if packing_stats["billed_tokens"] > 0:
+            print(f"{Fore.GREEN}-> Packing efficiency: {packing_stats['useful_tokens']} useful QA tokens / {packing_stats['billed_tokens']} billed tokens per epoch = {packing_stats['useful_tokens'] / packing_stats['billed_tokens']:.2%}.{Style.RESET_ALL}")
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+import argparse
+import bisect
+import heapq
+import os
+import ujson as json
+
+from colorama import just_fix_windows_console, Fore, Style
+just_fix_windows_console()
+from collections import Counter
+from itertools import islice
+from modules import profiling
+from modules.cache import content_hash
+from modules.jsonl import MAX_UPLOAD_BYTES, JsonlShardWriter
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+SPLIT_MODES = ("hash", "reservoir")
+# Example keys are the first 64 bits of a content hash, uniform in [0, KEY_RANGE).
+KEY_RANGE = 1 << 64
+
+
+def example_key(line: bytes, seed: str = "split") -> int:
+    """
+    Sampling key of an example, decided by its content alone: the split is the same on every run, whatever the line order,
+    and an example duplicated in the training file never lands on both sides.
+    """
+    return int(content_hash("split", seed, line.strip())[:16], 16)
+
+
+def length_bucket(num_tokens: int, boundaries: Sequence[int]) -> int:
+    """
+    Index of the token-length bucket: 0 below boundaries[0], len(boundaries) from boundaries[-1] on.
+    """
+    return bisect.bisect_right(boundaries, num_tokens)
+
+
+def bucket_label(bucket: int, boundaries: Sequence[int]) -> str:
+    if not boundaries:
+        return "all"
+    if bucket == 0:
+        return f"< {boundaries[0]}"
+    if bucket == len(boundaries):
+        return f">= {boundaries[-1]}"
+    return f"{boundaries[bucket - 1]}-{boundaries[bucket] - 1}"
+
+
+def _load_messages(line: bytes) -> List[Dict[str, str]]:
+    """
+    The messages of a JSONL line, none if it is not a valid JSON object: the check action reports those.
+    """
+    try:
+        example = json.loads(line)
+    except ValueError:
+        return []
+    return example.get("messages", []) if isinstance(example, dict) else []
+
+
+def iter_bucketed_examples(lines: Iterable[bytes], boundaries: Optional[Sequence[int]], model: str) -> Iterator[Tuple[bytes, int]]:
+    """
+    Attach the token-length bucket to every line, tokenizing the lines in batches; a single bucket without boundaries,
+    then nothing gets tokenized.
+    """
+    if not boundaries:
+        for line in lines:
+            yield line, 0
+        return
+    from modules import data_check
+
+    lines = iter(lines)
+    while True:
+        chunk = list(islice(lines, data_check.TOKENIZE_CHUNK_SIZE))
+        if not chunk:
+            return
+        with profiling.stage("split.tokenize"):
+            counts = data_check.num_tokens_from_messages_batch([_load_messages(line) for line in chunk], model)
+        profiling.count("split.tokens", sum(num_tokens for num_tokens, _ in counts))
+        for line, (num_tokens, _) in zip(chunk, counts):
+            yield line, length_bucket(num_tokens, boundaries)
+
+
+def split_by_hash(examples: Iterator[Tuple[bytes, int]], validation_ratio: float, train_writer: JsonlShardWriter, validation_writer: JsonlShardWriter,
+                  seed: str, split_stats: Dict[str, Counter]):
+    """
+    Send every example with a key below validation_ratio of the key range to the validation file, the others to the training file.
+    Constant memory, and every bucket gets validation_ratio of its examples in expectation.
+    """
+    threshold = int(validation_ratio * KEY_RANGE)
+    for line, bucket in examples:
+        if example_key(line, seed) < threshold:
+            validation_writer.write_line(line)
+            split_stats["validation"][bucket] += 1
+        else:
+            train_writer.write_line(line)
+            split_stats["train"][bucket] += 1
+
+
+def allocate(validation_size: int, bucket_sizes: Dict[int, int]) -> Dict[int, int]:
+    """
+    Share validation_size out across the buckets in proportion to their sizes, largest remainders first.
+    """
+    n_examples = sum(bucket_sizes.values())
+    quotas = {bucket: validation_size * size / n_examples for bucket, size in bucket_sizes.items()}
+    allocation = {bucket: int(quota) for bucket, quota in quotas.items()}
+    remainders = sorted(bucket_sizes, key=lambda bucket: (allocation[bucket] - quotas[bucket], bucket))
+    for bucket in remainders[:validation_size - sum(allocation.values())]:
+        allocation[bucket] += 1
+    return allocation
+
+
+def split_by_reservoir(examples: Iterator[Tuple[bytes, int]], validation_size: int, train_writer: JsonlShardWriter, validation_writer: JsonlShardWriter,
+                       seed: str, split_stats: Dict[str, Counter]):
+    """
+    Draw exactly validation_size examples, spread over the buckets in proportion to their sizes, in one pass.
+
+    Every bucket keeps the validation_size examples with the smallest keys seen so far (bottom-k sampling, a reservoir
+    whose random priorities are content hashes), an example pushed out of a reservoir goes to the training file right away.
+    Once the bucket sizes are known, each bucket hands its allocated number of smallest-key examples to the validation file
+    and the rest of its reservoir to the training file. Memory is bounded by validation_size lines per bucket.
+    """
+    reservoirs: Dict[int, List[Tuple[int, int, bytes]]] = {}
+    bucket_sizes = Counter()
+    for idx, (line, bucket) in enumerate(examples):
+        bucket_sizes[bucket] += 1
+        # A max-heap on the key through negated keys, the root is the example to push out first.
+        item = (-example_key(line, seed), idx, line)
+        reservoir = reservoirs.setdefault(bucket, [])
+        if len(reservoir) < validation_size:
+            heapq.heappush(reservoir, item)
+            continue
+        _, _, evicted = heapq.heappushpop(reservoir, item)
+        train_writer.write_line(evicted)
+        split_stats["train"][bucket] += 1
+
+    if not bucket_sizes:
+        return
+    allocation = allocate(min(validation_size, sum(bucket_sizes.values())), bucket_sizes)
+    validation, train = [], []
+    for bucket, reservoir in reservoirs.items():
+        reservoir.sort(reverse=True)
+        validation += [(idx, bucket, line) for _, idx, line in reservoir[:allocation[bucket]]]
+        train += [(idx, bucket, line) for _, idx, line in reservoir[allocation[bucket]:]]
+    # Both leftovers keep the order of the input file.
+    for name, writer, items in (("validation", validation_writer, validation), ("train", train_writer, train)):
+        for _, bucket, line in sorted(items, key=lambda item: item[0]):
+            writer.write_line(line)
+            split_stats[name][bucket] += 1
+
+
+def split_jsonl(jsonl_file: str, train_file: str, validation_file: str, mode: str = "hash", validation_ratio: float = 0.1,
+                validation_size: int = 1000, boundaries: Optional[Sequence[int]] = None, model: str = "gpt-3.5-turbo-0613",
+                seed: str = "split", max_bytes: int = MAX_UPLOAD_BYTES) -> Tuple[List[str], List[str], Dict[str, Counter]]:
+    """
+    Stream the training file once and split its examples into a training and a validation file, reproducibly.
+
+      - hash: an example goes to the validation file when its content hash falls below validation_ratio, constant memory.
+      - reservoir: exactly validation_size examples go to the validation file, stratified by token-length bucket when
+        boundaries are given, at most validation_size lines per bucket in memory.
+
+    Return the shards of both files and the number of examples per side and bucket.
+    """
+    split_stats = {"train": Counter(), "validation": Counter()}
+    train_writer, validation_writer = JsonlShardWriter(train_file, max_bytes), JsonlShardWriter(validation_file, max_bytes)
+    with open(jsonl_file, "rb") as fin:
+        lines = (line if line.endswith(b"\n") else line + b"\n" for line in fin if line.strip())
+        examples = iter_bucketed_examples(lines, boundaries, model)
+        with profiling.stage("split.split"):
+            if mode == "hash":
+                split_by_hash(examples, validation_ratio, train_writer, validation_writer, seed, split_stats)
+            elif mode == "reservoir":
+                split_by_reservoir(examples, validation_size, train_writer, validation_writer, seed, split_stats)
+            else:
+                raise ValueError(f"unknown split mode {mode}, expected one of {', '.join(SPLIT_MODES)}")
+    train_shards, validation_shards = train_writer.close(), validation_writer.close()
+    profiling.count("split.bytes_read", os.path.getsize(jsonl_file))
+    profiling.count("split.train_examples", sum(split_stats["train"].values()))
+    profiling.count("split.validation_examples", sum(split_stats["validation"].values()))
+    return train_shards, validation_shards, split_stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fine-Tuning-Data-Splitting Utility")
+    parser.add_argument("--input", type=str, help="JSONL training file to split", default="./data/fine_tune_instructions.jsonl")
+    parser.add_argument("--train_output", type=str, help="JSONL file receiving the training examples", default="./data/train.jsonl")
+    parser.add_argument("--validation_output", type=str, help="JSONL file receiving the validation examples", default="./data/validation.jsonl")
+    parser.add_argument("--mode", type=str, help="hash: a fraction picked by content hash, constant memory | reservoir: an exact number of examples", default="hash")
+    parser.add_argument("--validation_ratio", type=float, help="fraction of examples sent to the validation file in hash mode", default=0.1)
+    parser.add_argument("--validation_size", type=int, help="number of examples sent to the validation file in reservoir mode", default=1000)
+    parser.add_argument("--stratify", action="store_true", help="stratify the split by token-length bucket, exactly in reservoir mode, in expectation in hash mode")
+    parser.add_argument("--length_buckets", type=str, help="comma-separated token-length boundaries of the buckets used with --stratify", default="512,1024,2048,3072")
+    parser.add_argument("--model", type=str, help="model whose tokenizer is used to count tokens", default="gpt-3.5-turbo-0613")
+    parser.add_argument("--seed", type=str, help="another seed draws another split of the same examples", default="split")
+    parser.add_argument("--max_mb", type=float, help="size limit of each output file, bigger outputs roll over to extra shards", default=MAX_UPLOAD_BYTES / (1024 * 1024))
+    parser.add_argument("--profile_report", type=str, help="write stage timings, counters and peak memory to this JSON file, or Prometheus textfile if it ends with .prom", default=None)
+    parser.add_argument("--cprofile", type=str, help="dump cProfile stats of the run to this file", default=None)
+    args = parser.parse_args()
+    profiling.start("split", args.profile_report, args.cprofile)
+
+    if args.mode not in SPLIT_MODES:
+        print(f"{Fore.RED}-> Unknown split mode: {args.mode}, expected one of {', '.join(SPLIT_MODES)}.{Style.RESET_ALL}")
+        exit(-1)
+    if args.mode == "hash" and not 0 < args.validation_ratio < 1:
+        print(f"{Fore.RED}-> --validation_ratio must be in (0, 1), got {args.validation_ratio}.{Style.RESET_ALL}")
+        exit(-1)
+    if args.mode == "reservoir" and args.validation_size <= 0:
+        print(f"{Fore.RED}-> --validation_size must be positive, got {args.validation_size}.{Style.RESET_ALL}")
+        exit(-1)
+    outputs = {os.path.abspath(args.train_output), os.path.abspath(args.validation_output)}
+    if len(outputs) < 2 or os.path.abspath(args.input) in outputs:
+        print(f"{Fore.RED}-> --input, --train_output and --validation_output must be three different files.{Style.RESET_ALL}")
+        exit(-1)
+    boundaries = sorted(int(boundary) for boundary in args.length_buckets.split(",")) if args.stratify else None
+
+    train_shards, validation_shards, split_stats = split_jsonl(
+        args.input, args.train_output, args.validation_output, mode=args.mode, validation_ratio=args.validation_ratio,
+        validation_size=args.validation_size, boundaries=boundaries, model=args.model, seed=args.seed, max_bytes=int(args.max_mb * 1024 * 1024)
+    )
+    for shard in train_shards + validation_shards:
+        print(f"{Fore.GREEN}-> Generated {shard}.{Style.RESET_ALL}")
+
+    n_train, n_validation = sum(split_stats["train"].values()), sum(split_stats["validation"].values())
+    if n_train + n_validation == 0:
+        print(f"{Fore.YELLOW}-> No example found in {args.input}.{Style.RESET_ALL}")
+        exit(-1)
+    print(f"{Fore.GREEN}-> Split {n_train + n_validation} examples into {n_train} training and {n_validation} validation examples ({n_validation / (n_train + n_validation):.2%}).{Style.RESET_ALL}")
+    if boundaries:
+        for bucket in sorted(set(split_stats["train"]) | set(split_stats["validation"])):
+            n_bucket = split_stats["train"][bucket] + split_stats["validation"][bucket]
+            print(f"{Fore.GREEN}-> {bucket_label(bucket, boundaries):>12} tokens: {split_stats['train'][bucket]} training, "
+                  f"{split_stats['validation'][bucket]} validation ({split_stats['validation'][bucket] / n_bucket:.2%}).{Style.RESET_ALL}")
+    if len(train_shards) > 1 or len(validation_shards) > 1:
+        print(f"{Fore.YELLOW}-> An output rolled over to several shards, OpenAI takes one validation file per job.{Style.RESET_ALL}")